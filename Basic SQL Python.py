@@ -1,21 +1,26 @@
 import os
 import duckdb
 import polars as pl
-import re
+from online_tables import read_table, stale_schema_files, open_snapshot, snapshot_location
 
 # Define paths
 BASE_DIR = os.path.join(os.getcwd(), 'THD Data Warehouse')
 DATA_TABLES_DIR = os.path.join(BASE_DIR, 'Data_Tables')
-parquet_file_path = os.path.join(DATA_TABLES_DIR, 'online_sales.parquet')
+# Query the published version of online_sales (a fiscal-week partitioned dataset directory), so an upload
+# running meanwhile cannot change the files under the query
+snapshot = open_snapshot()
+parquet_file_path = snapshot_location('online_sales', snapshot)
 
 # Check if Parquet file exists
-if not os.path.exists(parquet_file_path):
-    raise FileNotFoundError(f"Parquet file not found at: {parquet_file_path}")
+if parquet_file_path is None or not os.path.exists(parquet_file_path):
+    raise FileNotFoundError(f"No published version of online_sales in {DATA_TABLES_DIR}")
 
 # Verify the required columns exist using Polars
 print("Checking Parquet file schema...")
-df_schema = pl.read_parquet(parquet_file_path, n_rows=1)
-required_columns = ["online sales $ ly +", "online sales $ +", "online order units +", "week"]
+# read_table resolves the schema registry, so partitions at older schema versions read like current ones
+sales = read_table('online_sales', snapshot=snapshot)
+df_schema = sales.head(1).collect()
+required_columns = ["online sales $ ly +", "online sales $ +", "online order units +", "week", "fiscal_week_key"]
 
 # Check for missing columns
 missing_columns = [col for col in required_columns if col not in df_schema.columns]
@@ -26,16 +31,25 @@ if missing_columns:
 if len(df_schema) == 0:
     raise ValueError("Parquet file is empty.")
 
-# SQL query: group by week, sum sales and units
+# DuckDB scans the partitions directly when they all share the current schema; otherwise it queries
+# the columns resolved by read_table as an Arrow table
+if stale_schema_files('online_sales', parquet_file_path):
+    sales_arrow = sales.select(["fiscal_week_key", "week", "online sales $ ly +", "online sales $ +", "online order units +"]).collect().to_arrow()
+    sales_source = "sales_arrow"
+else:
+    sales_source = f"read_parquet('{os.path.join(parquet_file_path, '**', '*.parquet')}', hive_partitioning = true)"
+
+# SQL query: group by week, sum sales and units (fiscal_week_key is yyyyww, so it orders weeks correctly)
 query = f"""
 SELECT 
+    fiscal_week_key,
     week,
     SUM("online order units +") AS order_unit,
     SUM("online sales $ ly +") AS Sales_LY,
     SUM("online sales $ +") AS Sales_TY
-FROM read_parquet('{parquet_file_path}')
-GROUP BY week
-ORDER BY week
+FROM {sales_source}
+GROUP BY fiscal_week_key, week
+ORDER BY fiscal_week_key
 """
 
 # Execute the query
@@ -47,14 +61,6 @@ except Exception as e:
     print(f"Error executing query: {e}")
     exit(1)
 
-# Extract numeric week number from 'week' column (e.g., "Fiscal Week 1 of 2025" -> 1)
-def extract_week_number(week_str):
-    match = re.search(r'Week (\d{1,2}) of', week_str)
-    return int(match.group(1)) if match else 0
-
-result_df['week_number'] = result_df['week'].apply(extract_week_number)
-result_df = result_df.sort_values(by='week_number')
-
 # Display all weekly sales and units, formatted with commas and 2 decimals
 print("\nWeekly Sales and Units Totals:")
 for _, row in result_df.iterrows():
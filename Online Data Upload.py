@@ -1,25 +1,75 @@
 import polars as pl
+import pyarrow.parquet as pq
 import os
 import psutil
 import time
-import pandas as pd
 import openpyxl
 import argparse
 import json
 import shutil
-from datetime import datetime
+import fnmatch
+import hashlib
+import multiprocessing
+import subprocess
+import sys
+import tempfile
+import atexit
+import itertools
+import errno
+import ctypes
+import ctypes.util
+import gzip
+import zipfile
+import select
+import struct
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta
 from typing import Dict, Optional, List
 from polars import DataType
+from polars.io.plugins import register_io_source
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Table locations, the schema registry, snapshots and reader pins are shared with the reports (online_tables.py)
+import online_tables
+from online_tables import (
+    BASE_DIR, DATA_TABLES_DIR, PARQUET_VERSIONS_DIR, CURRENT_MANIFEST, READER_PINS_DIR, STAGING_DIR, DEFAULT_STAGING_DIR,
+    FISCAL_WEEK_PATTERN, FISCAL_WEEK_ENUM, WEEK_KEY_EXPR, SCHEMA_REGISTRY, SCHEMA_VERSION_KEY,
+    labels_in_enum, schema_version, file_schema_version, apply_schema_rules, temp_table_path, publish_file,
+    dataset_dir, table_name, table_location, table_files, versions_dir, load_versions, resolve_version,
+    hive_columns, scan_table_path, version_location, load_current_manifest, reader_pins, pin_snapshot,
+    release_snapshot_pins, pinned_versions, open_snapshot, snapshot_location, read_table, stale_schema_files,
+)
 
 # Constants
-BASE_DIR = os.path.join(os.getcwd(), 'THD Data Warehouse')
-DATA_TABLES_DIR = os.path.join(BASE_DIR, 'Data_Tables')
-PARQUET_VERSIONS_DIR = os.path.join(BASE_DIR, 'parquet_versions')
 log_file = os.path.join(BASE_DIR, 'process.log')
+INGEST_MANIFEST = os.path.join(BASE_DIR, 'ingest_manifest.json')
+LOOKUP_INDEX_DIR = os.path.join(DATA_TABLES_DIR, '_lookup_index')
+# Snapshot retention: newest snapshot of each of the last N days and of each of the last M weeks that have a
+# snapshot (days and weeks without one do not count, so old snapshots are not kept longer by idle periods)
+SNAPSHOT_KEEP_DAILY = int(os.environ.get("THD_SNAPSHOT_KEEP_DAILY", 7))
+SNAPSHOT_KEEP_WEEKLY = int(os.environ.get("THD_SNAPSHOT_KEEP_WEEKLY", 8))
 os.makedirs(DATA_TABLES_DIR, exist_ok=True)
 os.makedirs(PARQUET_VERSIONS_DIR, exist_ok=True)
 
-# File configurations: (file prefix, column types, output Parquet name, is_excel, search_columns, sheet_name, start_row)
+# File configurations: (file prefix, column types, output Parquet name, is_excel, search_columns, sheet_name, start_row, options)
+# search_columns are the table's composite upsert key: existing rows whose key appears in the input are replaced
+# options:
+#   include_columns / exclude_columns: fnmatch patterns applied while the source is parsed; pruned columns are never materialized
+#   partition_by: "fiscal_week" stores the table as a hive-partitioned dataset (fiscal_year=YYYY/fiscal_week=WW) instead of one file
+#   cluster_by: columns each written file is sorted by, so row-group min/max statistics stay narrow
+#   lookup_index: {lookup_rows argument: column} kept in a sidecar value -> row group index for point lookups
+#   change_detection: partitioned tables compare row hashes per key and rewrite only inserted or changed rows;
+#     the before/after rows of changed keys go to THD Data Warehouse/change_log/<table>/
+#   strict_schema: the column types are the CSV's complete schema (no inference); values that fail to parse
+#     load as nulls and are listed with file, line and column in THD Data Warehouse/rejects/<table>/
+#   expectations: data quality rules checked on each source file's rows as read, and (after_transform) on the
+#     rows the table keeps from it (see expectation_rules)
+#   storage_profile: name of the STORAGE_PROFILES entry (codec, level, row groups, dictionary, statistics)
+#     the table's files are written with
 file_configs = [
     (
         "pythononlinewebsiteanalysis",
@@ -52,7 +102,17 @@ file_configs = [
         False,
         ["day", "oms id +"],
         None,
-        1
+        1,
+        {
+            "partition_by": "fiscal_week",
+            "cluster_by": ["oms id +", "day"],
+            "lookup_index": {"oms_ids": "oms id +", "upcs": "online upc cd +"},
+            "change_detection": True,
+            "strict_schema": True,
+            "expectations": {
+                "max_nulls": {"day": 0, "oms id +": 0, "week": 0},
+            },
+        }
     ),
     (
         "pythononlinesales",
@@ -89,7 +149,17 @@ file_configs = [
         False,
         ["day", "oms id +"],
         None,
-        1
+        1,
+        {
+            "partition_by": "fiscal_week",
+            "cluster_by": ["oms id +", "day"],
+            "lookup_index": {"oms_ids": "oms id +", "upcs": "online upc +"},
+            "change_detection": True,
+            "strict_schema": True,
+            "expectations": {
+                "max_nulls": {"day": 0, "oms id +": 0, "week": 0},
+            },
+        }
     ),
     (
         "pythononlineclassification",
@@ -110,7 +180,14 @@ file_configs = [
         False,
         None,
         None,
-        1
+        1,
+        {
+            "expectations": {
+                "max_nulls": {"oms id +": 0, "online upc +": 0},
+                # The 12-character UPC filter must leave rows
+                "after_transform": {"row_count": [1, None]},
+            },
+        }
     ),
     (
         "BA_VendorContentScorecard",
@@ -168,7 +245,11 @@ file_configs = [
         True,
         None,
         "Summary",
-        28
+        28,
+        {
+            # Blank-header padding columns between the scorecard metrics
+            "exclude_columns": ["", "_duplicated_*"],
+        }
     ),
     (
         "onlinestores",
@@ -201,7 +282,8 @@ file_configs = [
         False,
         None,
         None,
-        1
+        1,
+        {}
     ),
     (
         "PythonCalendar_Full",
@@ -212,7 +294,8 @@ file_configs = [
         False,
         None,
         None,
-        1
+        1,
+        {}
     ),
     (
         "FG Status Report",
@@ -295,13 +378,22 @@ file_configs = [
         True,
         None,
         "Sheet1",
-        1
+        1,
+        {
+            "expectations": {
+                # The report replaces the whole table, so an empty one would wipe it
+                "row_count": [1, None],
+            },
+        }
     ),
 ]
 
+# CSV exports may also arrive gzipped or zipped; they are read without being unpacked to disk
+CSV_EXTENSIONS = ('.csv', '.csv.gz', '.zip')
+
 # Find all files based on prefix (case-insensitive)
 def find_files(prefix: str, is_excel: bool) -> List[str]:
-    ext = '.xlsx' if is_excel else '.csv'
+    ext = '.xlsx' if is_excel else CSV_EXTENSIONS
     matching_files = [
         os.path.join(BASE_DIR, file)
         for file in os.listdir(BASE_DIR)
@@ -311,23 +403,1347 @@ def find_files(prefix: str, is_excel: bool) -> List[str]:
         return []
     return sorted(matching_files)
 
-# Convert Excel sheet to temporary CSV
-def excel_to_csv(excel_file: str, sheet_name: str = "Sheet1", start_row: int = 1) -> str:
-    wb = openpyxl.load_workbook(excel_file)
-    if sheet_name not in wb.sheetnames:
-        raise KeyError(f"Worksheet {sheet_name} does not exist in {excel_file}. Available sheets: {wb.sheetnames}")
-    sheet = wb[sheet_name]
-    headers = [cell.value for cell in sheet[start_row] if cell.value is not None]
-    data = []
-    for row in sheet.iter_rows(min_row=start_row + 1):
-        row_data = [cell.value if cell.value is not None else '' for cell in row]
-        if len(row_data) > len(headers):
-            row_data = row_data[:len(headers)]
-        data.append(row_data)
-    df = pd.DataFrame(data, columns=headers)
-    temp_csv = os.path.join(BASE_DIR, f"temp_{os.path.basename(excel_file).replace('.xlsx', '.csv')}")
-    df.to_csv(temp_csv, index=False)
-    return temp_csv
+# Ingest manifest: one entry per source file already loaded, keyed by file name
+def load_ingest_manifest() -> Dict[str, dict]:
+    if not os.path.exists(INGEST_MANIFEST):
+        return {}
+    with open(INGEST_MANIFEST, 'r') as f:
+        return json.load(f)
+
+def save_ingest_manifest(manifest: Dict[str, dict]) -> None:
+    temp_manifest = temp_table_path(os.path.basename(INGEST_MANIFEST) + ".tmp")
+    with open(temp_manifest, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    publish_file(temp_manifest, INGEST_MANIFEST)
+
+def file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# True when the file was already committed to this table and has not changed since
+def is_already_ingested(manifest: Dict[str, dict], path: str, parquet_name: str) -> bool:
+    entry = manifest.get(os.path.basename(path))
+    if not entry or entry["table"] != parquet_name:
+        return False
+    stat = os.stat(path)
+    if entry["size"] != stat.st_size:
+        return False
+    if entry["mtime"] == stat.st_mtime:
+        return True
+    # Same size but touched (e.g. re-copied): only the content hash can tell
+    if file_hash(path) != entry["hash"]:
+        return False
+    entry["mtime"] = stat.st_mtime
+    return True
+
+def record_ingest(manifest: Dict[str, dict], path: str, parquet_name: str, usage: Dict) -> None:
+    stat = os.stat(path)
+    manifest[os.path.basename(path)] = {
+        "hash": file_hash(path),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "table": parquet_name,
+        "rows_added": usage["rows_added"],
+        "rows_removed": usage["rows_removed"],
+        "final_row_count": usage["final_row_count"],
+        "committed_at": datetime.now().isoformat(timespec="seconds"),
+    }
+
+# Rows per batch when streaming Excel sheets
+EXCEL_BATCH_ROWS = 50000
+
+# Name Excel header cells the way scan_csv would: blank headers become "" and repeats get _duplicated_N
+def excel_headers(header_row: tuple) -> List[str]:
+    header_row = list(header_row)
+    while header_row and header_row[-1] is None:
+        header_row.pop()
+    headers = []
+    seen = set()
+    duplicate_count = 0
+    for value in header_row:
+        name = '' if value is None else str(value)
+        if name in seen:
+            name = f"{name}_duplicated_{duplicate_count}"
+            duplicate_count += 1
+        seen.add(name)
+        headers.append(name)
+    return headers
+
+# Build a typed DataFrame from one batch of Excel column values
+def excel_batch_frame(headers: List[str], columns: List[list], dtype_dict: Dict[str, DataType]) -> pl.DataFrame:
+    series = {}
+    for name, values in zip(headers, columns):
+        dtype = dtype_dict.get(name, pl.Utf8)
+        if dtype == pl.Utf8 or dtype == pl.Categorical:
+            values = [None if value is None else str(value) for value in values]
+            s = pl.Series(name, values, dtype=pl.Utf8)
+            if dtype == pl.Categorical:
+                s = s.cast(pl.Categorical)
+        else:
+            s = pl.Series(name, values, dtype=dtype, strict=False)
+        series[name] = s
+    return pl.DataFrame(series)
+
+# Columns kept after a config's include/exclude column spec
+def select_columns(columns: List[str], include: Optional[List[str]] = None, exclude: Optional[List[str]] = None) -> List[str]:
+    kept = [col for col in columns if not include or any(fnmatch.fnmatchcase(col, pattern) for pattern in include)]
+    if exclude:
+        kept = [col for col in kept if not any(fnmatch.fnmatchcase(col, pattern) for pattern in exclude)]
+    return kept
+
+# Stream an Excel sheet as typed batches without loading the whole workbook
+def iter_excel_batches(
+    excel_file: str,
+    dtype_dict: Dict[str, DataType],
+    sheet_name: str = "Sheet1",
+    start_row: int = 1,
+    batch_rows: int = EXCEL_BATCH_ROWS,
+    include_columns: Optional[List[str]] = None,
+    exclude_columns: Optional[List[str]] = None,
+    prune_stats: Optional[Dict] = None
+):
+    wb = openpyxl.load_workbook(excel_file, read_only=True, data_only=True)
+    try:
+        if sheet_name not in wb.sheetnames:
+            raise KeyError(f"Worksheet {sheet_name} does not exist in {excel_file}. Available sheets: {wb.sheetnames}")
+        rows = wb[sheet_name].iter_rows(min_row=start_row, values_only=True)
+        header_row = next(rows, None)
+        if header_row is None:
+            return
+        all_headers = excel_headers(header_row)
+        headers = select_columns(all_headers, include_columns, exclude_columns)
+        kept_idx = [all_headers.index(name) for name in headers]
+        pruned_idx = sorted(set(range(len(all_headers))) - set(kept_idx))
+        if prune_stats is not None:
+            prune_stats.update({"columns_total": len(all_headers), "columns_pruned": len(pruned_idx), "cells_kept": 0, "cells_pruned": 0, "bytes_pruned": 0, "build_time": 0.0})
+        columns = [[] for _ in headers]
+        row_count = 0
+        batches_yielded = 0
+        for row in rows:
+            if all(value is None for value in row):
+                continue
+            for col_values, k in zip(columns, kept_idx):
+                col_values.append(row[k] if k < len(row) else None)
+            if prune_stats is not None:
+                # Each skipped cell would have cost an 8-byte slot plus its text
+                prune_stats["cells_pruned"] += len(pruned_idx)
+                prune_stats["bytes_pruned"] += 8 * len(pruned_idx) + sum(
+                    len(str(row[k])) for k in pruned_idx if k < len(row) and row[k] is not None
+                )
+            row_count += 1
+            if row_count == batch_rows:
+                yield build_excel_batch(headers, columns, dtype_dict, prune_stats)
+                batches_yielded += 1
+                columns = [[] for _ in headers]
+                row_count = 0
+        if row_count or not batches_yielded:
+            yield build_excel_batch(headers, columns, dtype_dict, prune_stats)
+    finally:
+        wb.close()
+
+# Type one Excel batch, timing it for the pruning report
+def build_excel_batch(headers: List[str], columns: List[list], dtype_dict: Dict[str, DataType], prune_stats: Optional[Dict]) -> pl.DataFrame:
+    build_start = time.perf_counter()
+    frame = excel_batch_frame(headers, columns, dtype_dict)
+    if prune_stats is not None:
+        prune_stats["build_time"] += time.perf_counter() - build_start
+        prune_stats["cells_kept"] += frame.height * frame.width
+    return frame
+
+# Read an Excel sheet as a LazyFrame over the streamed batches (no temporary CSV): the schema comes from the
+# header row, and the plan pulls one batch of rows at a time, so the whole sheet is never held before
+# downstream work starts
+def read_excel_lazy(
+    excel_file: str,
+    dtype_dict: Dict[str, DataType],
+    sheet_name: str = "Sheet1",
+    start_row: int = 1,
+    include_columns: Optional[List[str]] = None,
+    exclude_columns: Optional[List[str]] = None,
+    prune_stats: Optional[Dict] = None
+) -> pl.LazyFrame:
+    wb = openpyxl.load_workbook(excel_file, read_only=True, data_only=True)
+    try:
+        if sheet_name not in wb.sheetnames:
+            raise KeyError(f"Worksheet {sheet_name} does not exist in {excel_file}. Available sheets: {wb.sheetnames}")
+        header_row = next(wb[sheet_name].iter_rows(min_row=start_row, max_row=start_row, values_only=True), None)
+    finally:
+        wb.close()
+    if header_row is None:
+        raise ValueError(f"No header row found at row {start_row} of {sheet_name} in {excel_file}")
+    headers = select_columns(excel_headers(header_row), include_columns, exclude_columns)
+    schema = {name: dtype_dict.get(name, pl.Utf8) for name in headers}
+    
+    def read_batches(with_columns, predicate, n_rows, batch_size):
+        rows = 0
+        for batch in iter_excel_batches(
+            excel_file, dtype_dict, sheet_name=sheet_name, start_row=start_row,
+            include_columns=include_columns, exclude_columns=exclude_columns, prune_stats=prune_stats
+        ):
+            if with_columns is not None:
+                batch = batch.select(with_columns)
+            if predicate is not None:
+                batch = batch.filter(predicate)
+            if n_rows is not None:
+                batch = batch.head(n_rows - rows)
+            rows += batch.height
+            yield batch
+            if n_rows is not None and rows >= n_rows:
+                break
+    
+    return register_io_source(read_batches, schema=schema, explain_name=f"{os.path.basename(excel_file)}:{sheet_name}")
+
+# Column counts and estimated bytes skipped by the column spec, for the run summary
+def record_pruning(prune_stats: Optional[Dict], csv_file: str, all_columns: List[str], kept: List[str]) -> None:
+    if prune_stats is None:
+        return
+    pruned = len(all_columns) - len(kept)
+    prune_stats.update({
+        "columns_total": len(all_columns),
+        "columns_pruned": pruned,
+        "bytes_pruned": int(source_bytes(csv_file) * pruned / max(len(all_columns), 1)),
+    })
+
+# Compressed CSV sources. Polars decompresses .csv.gz itself while it parses. A zip member is decompressed
+# as a stream and parsed in blocks of whole lines (exports have no line breaks inside quoted fields), so
+# neither an extracted copy nor the whole text exists at any point; members of one archive are separate
+# scans that the engine reads in parallel.
+ZIP_BLOCK_BYTES = 64 * 1024 * 1024
+
+# CSV members of a zip archive, in name order
+def zip_csv_members(path: str) -> List[str]:
+    with zipfile.ZipFile(path) as archive:
+        return sorted(info.filename for info in archive.infolist() if not info.is_dir() and info.filename.lower().endswith('.csv'))
+
+# Uncompressed size of a source file
+def source_bytes(path: str) -> int:
+    name = path.lower()
+    if name.endswith('.zip'):
+        with zipfile.ZipFile(path) as archive:
+            return sum(info.file_size for info in archive.infolist() if info.filename.lower().endswith('.csv'))
+    size = os.path.getsize(path)
+    if name.endswith('.gz'):
+        with open(path, 'rb') as f:
+            f.seek(-4, os.SEEK_END)
+            isize = struct.unpack("<I", f.read(4))[0]
+        # The gzip trailer stores the size modulo 4 GiB; compressed files that large are estimated at 4x
+        return isize if size < 1 << 30 else max(isize, size * 4)
+    return size
+
+# Decompressed byte stream of a source (the first member of a zip), for sampling
+def open_source(path: str):
+    name = path.lower()
+    if name.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if name.endswith('.zip'):
+        archive = zipfile.ZipFile(path)
+        return archive.open(zip_csv_members(path)[0])
+    return open(path, 'rb')
+
+# Lazy scan of one zip member; the schema is fixed up front from the member's first MB (as scan_csv infers it)
+def scan_zip_member(path: str, member: str, **csv_kwargs) -> pl.LazyFrame:
+    with zipfile.ZipFile(path) as archive, archive.open(member) as f:
+        head = f.read(1 << 20)
+    schema = pl.read_csv(head[:head.rfind(b"\n") + 1] or head, **csv_kwargs).schema
+    ignore_errors = csv_kwargs.get("ignore_errors", False)
+    
+    def read_blocks(with_columns, predicate, n_rows, batch_size):
+        rows = 0
+        with zipfile.ZipFile(path) as archive, archive.open(member) as f:
+            header = f.readline()
+            rest = b""
+            while n_rows is None or rows < n_rows:
+                data = f.read(ZIP_BLOCK_BYTES)
+                text = rest + data
+                if not text:
+                    break
+                cut = text.rfind(b"\n") + 1 if data else len(text)
+                rest = text[cut:]
+                if not cut:
+                    continue
+                block = pl.read_csv(header + text[:cut], schema=schema, columns=with_columns, ignore_errors=ignore_errors)
+                if predicate is not None:
+                    block = block.filter(predicate)
+                if n_rows is not None:
+                    block = block.head(n_rows - rows)
+                rows += block.height
+                yield block
+    
+    return register_io_source(read_blocks, schema=schema, explain_name=f"{os.path.basename(path)}:{member}")
+
+# Lazy CSV scan of a plain, gzipped or zipped source with scan_csv's options; a row index spans all members
+def scan_csv_source(path: str, row_index_name: Optional[str] = None, **csv_kwargs) -> pl.LazyFrame:
+    if not path.lower().endswith('.zip'):
+        return pl.scan_csv(path, row_index_name=row_index_name, **csv_kwargs)
+    members = zip_csv_members(path)
+    if not members:
+        raise ValueError(f"No CSV files inside {path}")
+    frame = pl.concat([scan_zip_member(path, member, **csv_kwargs) for member in members], how="diagonal_relaxed")
+    return frame.with_row_index(row_index_name) if row_index_name else frame
+
+# Read a CSV lazily, projecting away pruned columns so they are never parsed into memory
+def read_csv_lazy(
+    csv_file: str,
+    dtype_dict: Dict[str, DataType],
+    include_columns: Optional[List[str]] = None,
+    exclude_columns: Optional[List[str]] = None,
+    prune_stats: Optional[Dict] = None
+) -> pl.LazyFrame:
+    df_lazy = scan_csv_source(csv_file, schema_overrides=dtype_dict, ignore_errors=True)
+    if not include_columns and not exclude_columns:
+        return df_lazy
+    all_columns = df_lazy.collect_schema().names()
+    kept = select_columns(all_columns, include_columns, exclude_columns)
+    record_pruning(prune_stats, csv_file, all_columns, kept)
+    return df_lazy.select(kept)
+
+# Strict CSV reading (option strict_schema): the config's dtype_dict is the file's complete schema, so the
+# file is read in one parallel pass as text with no inference and every column is converted in the same
+# plan. A value that fails to convert still loads as null, and its row is flagged with its row number in
+# REJECTED_LINE_COLUMN; split_rejects / report_rejects then write file, line, column and the raw value to
+# THD Data Warehouse/rejects/<table>/. Kept columns missing from the schema are an error.
+REJECTS_DIR = os.path.join(BASE_DIR, 'rejects')
+REJECTED_LINE_COLUMN = "__rejected_line"
+
+# Text -> declared type; values that do not parse become null
+def parse_text(column: str, dtype: DataType) -> pl.Expr:
+    text = pl.col(column)
+    if dtype == pl.Datetime:
+        return text.str.to_datetime(time_unit=getattr(dtype, "time_unit", None) or "us", strict=False)
+    if dtype == pl.Date:
+        return text.str.to_date(strict=False)
+    if dtype == pl.Boolean:
+        return text.str.to_lowercase().replace_strict({"true": True, "false": False}, default=None, return_dtype=pl.Boolean)
+    return text.cast(dtype, strict=False)
+
+# Declared type of each source column, resolving the registry's alias rules (None when undeclared)
+def strict_schema(columns: List[str], dtype_dict: Dict[str, DataType], parquet_name: str) -> Dict[str, Optional[DataType]]:
+    aliases = {
+        old: new for entry in SCHEMA_REGISTRY.get(table_name(parquet_name), [])
+        for rule in entry["rules"] for old, new in rule.get("alias", {}).items()
+    }
+    return {col: dtype_dict.get(col, dtype_dict.get(aliases.get(col))) for col in columns}
+
+def read_csv_strict(
+    csv_file: str,
+    dtype_dict: Dict[str, DataType],
+    parquet_name: str,
+    include_columns: Optional[List[str]] = None,
+    exclude_columns: Optional[List[str]] = None,
+    prune_stats: Optional[Dict] = None
+) -> pl.LazyFrame:
+    df_lazy = scan_csv_source(csv_file, infer_schema=False, row_index_name=REJECTED_LINE_COLUMN)
+    all_columns = [col for col in df_lazy.collect_schema().names() if col != REJECTED_LINE_COLUMN]
+    kept = select_columns(all_columns, include_columns, exclude_columns)
+    if include_columns or exclude_columns:
+        record_pruning(prune_stats, csv_file, all_columns, kept)
+    schema = strict_schema(kept, dtype_dict, parquet_name)
+    undeclared = [col for col, dtype in schema.items() if dtype is None]
+    if undeclared:
+        raise ValueError(f"Columns of {os.path.basename(csv_file)} missing from the strict schema of {table_name(parquet_name)}: {undeclared[:5]}")
+    parsed = {col: dtype for col, dtype in schema.items() if dtype != pl.Utf8}
+    failed = pl.any_horizontal([pl.col(col).is_not_null() & parse_text(col, dtype).is_null() for col, dtype in parsed.items()]) if parsed else pl.lit(False)
+    return df_lazy.select(
+        [parse_text(col, parsed[col]).alias(col) if col in parsed else pl.col(col) for col in kept]
+        + [pl.when(failed).then(pl.col(REJECTED_LINE_COLUMN)).alias(REJECTED_LINE_COLUMN)]
+    )
+
+# Take the strict reader's flag column off a collected frame, adding flagged row numbers to rejected
+# ({source index: [row numbers]})
+def split_rejects(frame: pl.DataFrame, rejected: Dict[int, list]) -> pl.DataFrame:
+    if REJECTED_LINE_COLUMN not in frame.columns:
+        return frame
+    flagged = frame.filter(pl.col(REJECTED_LINE_COLUMN).is_not_null())
+    if flagged.height:
+        source = pl.col(BATCH_SOURCE_COLUMN) if BATCH_SOURCE_COLUMN in frame.columns else pl.lit(0, dtype=pl.Int32)
+        for source_index, rows in flagged.group_by(source.alias(BATCH_SOURCE_COLUMN)).agg(pl.col(REJECTED_LINE_COLUMN)).iter_rows():
+            rejected.setdefault(source_index, []).extend(rows)
+    return frame.drop(REJECTED_LINE_COLUMN)
+
+# Write the rejected values of each source file to the rejects sidecar; only the flagged rows are re-read.
+# Returns {source index: rejected values}
+def report_rejects(rejected: Dict[int, list], input_paths: List[str], parquet_name: str, dtype_dict: Dict[str, DataType]) -> Dict[int, int]:
+    counts = {}
+    rejected_at = datetime.now()
+    for source_index, rows in sorted(rejected.items()):
+        csv_file = input_paths[source_index]
+        # Row numbers count across the members of a zip; each rejected value is reported against its member
+        if csv_file.lower().endswith('.zip'):
+            text_lazy = pl.concat([
+                scan_zip_member(csv_file, member, infer_schema=False).with_row_index("__member_row")
+                .with_columns(pl.lit(f"{os.path.basename(csv_file)}:{member}").alias("__member"))
+                for member in zip_csv_members(csv_file)
+            ], how="diagonal_relaxed").with_row_index(REJECTED_LINE_COLUMN)
+        else:
+            text_lazy = pl.scan_csv(csv_file, infer_schema=False, row_index_name=REJECTED_LINE_COLUMN).with_columns(
+                pl.col(REJECTED_LINE_COLUMN).alias("__member_row"), pl.lit(os.path.basename(csv_file)).alias("__member")
+            )
+        flagged = text_lazy.join(
+            pl.LazyFrame({REJECTED_LINE_COLUMN: rows}).cast({REJECTED_LINE_COLUMN: text_lazy.collect_schema()[REJECTED_LINE_COLUMN]}),
+            on=REJECTED_LINE_COLUMN, how="semi"
+        ).collect()
+        schema = strict_schema([col for col in flagged.columns if col not in (REJECTED_LINE_COLUMN, "__member_row", "__member")], dtype_dict, parquet_name)
+        cells = pl.concat([
+            flagged.filter(pl.col(col).is_not_null() & parse_text(col, dtype).is_null()).select(
+                pl.col("__member").alias("file"),
+                # Header is line 1
+                (pl.col("__member_row").cast(pl.Int64) + 2).alias("line"),
+                pl.lit(col).alias("column"),
+                pl.col(col).alias("value"),
+                pl.lit(str(dtype)).alias("expected_type"),
+            )
+            for col, dtype in schema.items() if dtype is not None and dtype != pl.Utf8
+        ]).with_columns(pl.lit(rejected_at).alias("rejected_at"))
+        path = os.path.join(REJECTS_DIR, table_name(parquet_name), f"{rejected_at.strftime('%Y%m%d_%H%M%S_%f')}_{os.path.splitext(os.path.basename(csv_file))[0]}.parquet")
+        temp_path = temp_table_path(os.path.basename(path) + '.tmp')
+        cells.write_parquet(temp_path)
+        publish_file(temp_path, path)
+        counts[source_index] = cells.height
+        print(f"Rejected {cells.height} values on {len(rows)} lines of {os.path.basename(csv_file)} (loaded as nulls); details in {path}")
+        with open(log_file, 'a') as log:
+            log.write(f"Rejected {cells.height} values on {len(rows)} lines of {csv_file} -> {path} at {datetime.now().strftime('%H:%M:%S %Z on %m/%d/%Y')}\n")
+    return counts
+
+# Data quality expectations (option expectations), measured on the rows each source file contributes as
+# read, before the table's own filtering and de-duplication:
+#   row_count: [min, max] rows (None: no bound)
+#   unique: columns no two rows may share
+#   max_nulls: {column: most null values allowed}
+#   domain: {column: allowed values}
+#   str_length: {column: [min, max] characters of the non-null values}
+#   after_transform: rules of the same kinds measured on the rows the table keeps after its filtering and
+#     de-duplication (a unique rule on the de-duplication key would always pass there, so checks of the raw
+#     export belong in the main group)
+#   on_failure: "warn" (default) reports failures in the run summary, "fail" stops the commit
+# Every rule is one aggregate in a group_by per source file, collected together with the rows themselves
+# so the source is read once for all of them
+
+# Rules as (name, aggregate, lowest allowed, highest allowed); the aggregate is the row count or the
+# number of offending rows. after_transform rules are named "<rule> after transform"
+def expectation_rules(expectations: Dict, after_transform: bool = False) -> List[tuple]:
+    if after_transform:
+        return [(f"{name} after transform", expr, low, high) for name, expr, low, high in expectation_rules(expectations.get("after_transform") or {})]
+    rules = []
+    if "row_count" in expectations:
+        low, high = expectations["row_count"]
+        rules.append(("row_count", pl.len(), low, high))
+    if expectations.get("unique"):
+        columns = expectations["unique"]
+        rules.append((f"unique({', '.join(columns)})", pl.len() - pl.struct(columns).n_unique(), 0, 0))
+    for col, limit in expectations.get("max_nulls", {}).items():
+        rules.append((f"max_nulls({col})", pl.col(col).null_count(), 0, limit))
+    for col, values in expectations.get("domain", {}).items():
+        rules.append((f"domain({col})", (~pl.col(col).cast(pl.Utf8).is_in([str(value) for value in values])).sum(), 0, 0))
+    for col, (low, high) in expectations.get("str_length", {}).items():
+        length = pl.col(col).cast(pl.Utf8).str.len_chars()
+        outside = pl.lit(False)
+        if low is not None:
+            outside = outside | (length < low)
+        if high is not None:
+            outside = outside | (length > high)
+        rules.append((f"str_length({col})", outside.sum(), 0, 0))
+    return rules
+
+# Lazy aggregation of every rule per source file (None when the config has no expectations): the main
+# rules over the source rows, the after_transform rules over the table's rows
+def expectation_frame(source_frame: pl.LazyFrame, table_frame: pl.LazyFrame, expectations: Optional[Dict]) -> Optional[pl.LazyFrame]:
+    groups = [
+        frame.group_by(BATCH_SOURCE_COLUMN).agg([expr.alias(name) for name, expr, _, _ in rules])
+        for frame, rules in ((source_frame, expectation_rules(expectations or {})), (table_frame, expectation_rules(expectations or {}, after_transform=True)))
+        if rules
+    ]
+    if not groups:
+        return None
+    return groups[0] if len(groups) == 1 else groups[0].join(groups[1], on=BATCH_SOURCE_COLUMN, how="full", coalesce=True)
+
+# Check the measured values against their limits: {source index: [{rule, value, expected, passed}]}.
+# Failures are printed and logged; with on_failure "fail" they raise before anything is written
+def check_expectations(measured: Optional[pl.DataFrame], expectations: Optional[Dict], input_paths: List[str], parquet_name: str) -> Dict[int, list]:
+    if measured is None:
+        return {}
+    by_source = {row[BATCH_SOURCE_COLUMN]: row for row in measured.iter_rows(named=True)}
+    results = {}
+    failures = []
+    for source_index, path in enumerate(input_paths):
+        # A file without rows has no group; every rule then measures 0
+        row = by_source.get(source_index, {})
+        checks = []
+        for name, _, low, high in expectation_rules(expectations) + expectation_rules(expectations, after_transform=True):
+            value = row.get(name) or 0
+            passed = (low is None or value >= low) and (high is None or value <= high)
+            expected = f"{'' if low is None else low}..{'' if high is None else high} rows" if name.startswith("row_count") else f"at most {high}"
+            checks.append({"rule": name, "value": value, "expected": expected, "passed": passed})
+            if not passed:
+                failures.append(f"{os.path.basename(path)}: {name} = {value} (expected {expected})")
+        results[source_index] = checks
+    if failures:
+        print(f"Expectations failed for {table_name(parquet_name)}: " + "; ".join(failures))
+        with open(log_file, 'a') as log:
+            log.write(f"Expectations failed for {table_name(parquet_name)}: {'; '.join(failures)} at {datetime.now().strftime('%H:%M:%S %Z on %m/%d/%Y')}\n")
+        if expectations.get("on_failure") == "fail":
+            raise ValueError(f"Expectations failed for {table_name(parquet_name)}, nothing committed: " + "; ".join(failures))
+    return results
+
+# Estimated savings from column pruning for the run summary
+def prune_report(prune_stats: Dict, read_time: float) -> Dict:
+    if not prune_stats.get("columns_pruned"):
+        return {}
+    if "cells_kept" in prune_stats:
+        # Excel: pruned cells would have cost the same per-cell typing time as the kept ones
+        time_saved = prune_stats["build_time"] * prune_stats["cells_pruned"] / max(prune_stats["cells_kept"], 1)
+    else:
+        kept = prune_stats["columns_total"] - prune_stats["columns_pruned"]
+        time_saved = read_time * prune_stats["columns_pruned"] / max(kept, 1)
+    return {
+        "columns_pruned": prune_stats["columns_pruned"],
+        "columns_total": prune_stats["columns_total"],
+        "bytes_saved": prune_stats["bytes_pruned"],
+        "time_saved": time_saved,
+    }
+
+# Fiscal-week partitioning: "Fiscal Week 8 of 2025" -> fiscal_year=2025/fiscal_week=8
+PARTITION_COLUMNS = ["fiscal_year", "fiscal_week"]
+
+def partition_path(dataset: str, fiscal_year: int, fiscal_week: int) -> str:
+    return os.path.join(dataset, f"fiscal_year={fiscal_year}", f"fiscal_week={fiscal_week}", "part-0.parquet")
+
+# Week labels not in FISCAL_WEEK_ENUM are moved from week to a flag column while the source is read, so the
+# Enum cast never sees them and the check runs on the rows as they are collected instead of in a read of its own
+UNKNOWN_WEEK_COLUMN = "__unknown_week"
+
+# fiscal_week_key is derived here too, from the label as read, so flagged weeks still get their key and partition
+def flag_unknown_weeks(frame: pl.LazyFrame) -> pl.LazyFrame:
+    names = frame.collect_schema().names()
+    if "week" not in names:
+        return frame
+    unknown = ~pl.col("week").cast(pl.Utf8).is_in(FISCAL_WEEK_ENUM.categories.implode())
+    return frame.with_columns(
+        pl.when(unknown).then(pl.col("week").cast(pl.Utf8)).alias(UNKNOWN_WEEK_COLUMN),
+        pl.when(unknown).then(None).otherwise(pl.col("week").cast(pl.Utf8)).cast(FISCAL_WEEK_ENUM).alias("week"),
+        *([] if "fiscal_week_key" in names else [WEEK_KEY_EXPR.alias("fiscal_week_key")]),
+    )
+
+# Put the flagged labels back into week (as Utf8 text) and drop the flag column; works on lazy and collected frames
+def restore_unknown_weeks(frame):
+    if UNKNOWN_WEEK_COLUMN not in frame.collect_schema().names():
+        return frame
+    return frame.with_columns(
+        pl.coalesce(pl.col("week").cast(pl.Utf8), pl.col(UNKNOWN_WEEK_COLUMN)).alias("week")
+    ).drop(UNKNOWN_WEEK_COLUMN)
+
+# Take the flag column off a collected frame. Unrecognized week labels are warned about and kept as text:
+# week stays the Enum only when every label is known
+def split_unknown_weeks(frame: pl.DataFrame, input_paths: List[str]) -> pl.DataFrame:
+    if UNKNOWN_WEEK_COLUMN not in frame.columns:
+        return frame
+    unknown_weeks = frame[UNKNOWN_WEEK_COLUMN].drop_nulls().unique().sort().to_list()
+    if not unknown_weeks:
+        return frame.drop(UNKNOWN_WEEK_COLUMN)
+    source_names = ", ".join(os.path.basename(path) for path in input_paths)
+    print(f"Warning: week labels outside the ordered week type in {source_names} are kept as text: {unknown_weeks[:5]}")
+    with open(log_file, 'a') as log:
+        log.write(f"Warning: {len(unknown_weeks)} week labels outside the ordered week type in {source_names} kept as text at {datetime.now().strftime('%H:%M:%S %Z on %m/%d/%Y')}\n")
+    return restore_unknown_weeks(frame)
+
+# Cast a fiscal week's text labels back to the Enum when it knows them (rows split by week out of a batch
+# that also had unknown labels, or read back through pyarrow as Categorical)
+def order_weeks(frame: pl.DataFrame) -> pl.DataFrame:
+    if "week" not in frame.columns or frame.schema["week"] == FISCAL_WEEK_ENUM:
+        return frame
+    frame = frame.with_columns(pl.col("week").cast(pl.Utf8))
+    return frame.with_columns(pl.col("week").cast(FISCAL_WEEK_ENUM)) if labels_in_enum(frame, "week", FISCAL_WEEK_ENUM) else frame
+
+# Add the fiscal_year / fiscal_week partition keys from fiscal_week_key (0 when the week is missing)
+def with_fiscal_partitions(df):
+    key = pl.col("fiscal_week_key")
+    return df.with_columns(
+        (key // 100).fill_null(0).alias("fiscal_year"),
+        (key % 100).fill_null(0).alias("fiscal_week"),
+    )
+
+# Existing partitions of a dataset as {(fiscal_year, fiscal_week): path}
+def list_partitions(dataset: str) -> Dict[tuple, str]:
+    partitions = {}
+    if not os.path.isdir(dataset):
+        return partitions
+    for year_dir in os.listdir(dataset):
+        if not year_dir.startswith("fiscal_year="):
+            continue
+        for week_dir in os.listdir(os.path.join(dataset, year_dir)):
+            if not week_dir.startswith("fiscal_week="):
+                continue
+            key = (int(year_dir.split("=", 1)[1]), int(week_dir.split("=", 1)[1]))
+            path = partition_path(dataset, *key)
+            if os.path.exists(path):
+                partitions[key] = path
+    return partitions
+
+# Row groups of clustered tables are kept small so a point lookup reads little beyond the matching rows
+CLUSTERED_ROW_GROUP_ROWS = 16384
+
+# Storage profiles: how a table's files are encoded. A table picks one with the storage_profile option;
+# without one, clustered tables use "clustered" and the rest "default". "Online Storage Profiles.py"
+# benchmarks the profiles against a live table and recommends one.
+#   compression / compression_level: parquet codec and level (None: the codec's default level)
+#   row_group_size: rows per row group (None: the writer's default)
+#   statistics: column min/max statistics, which filtered scans and lookups use to skip row groups
+#   dictionary: dictionary-encode columns (True, False, or a list of the columns to encode)
+STORAGE_PROFILES = {
+    "default": {"compression": "snappy", "compression_level": None, "row_group_size": None, "statistics": True, "dictionary": True},
+    "clustered": {"compression": "snappy", "compression_level": None, "row_group_size": CLUSTERED_ROW_GROUP_ROWS, "statistics": True, "dictionary": True},
+    "scan": {"compression": "zstd", "compression_level": 3, "row_group_size": 131072, "statistics": True, "dictionary": True},
+    "clustered_zstd": {"compression": "zstd", "compression_level": 3, "row_group_size": CLUSTERED_ROW_GROUP_ROWS, "statistics": True, "dictionary": True},
+    "archive": {"compression": "zstd", "compression_level": 19, "row_group_size": 1048576, "statistics": True, "dictionary": True},
+    "fast_write": {"compression": "lz4", "compression_level": None, "row_group_size": None, "statistics": False, "dictionary": False},
+}
+# Snapshot files no longer part of the live table are rewritten with this profile by --archive_snapshots
+ARCHIVE_STORAGE_PROFILE = "archive"
+STORAGE_PROFILE_KEY = "thd_storage_profile"
+
+# Storage profile name of a table's options
+def storage_profile_name(options: Optional[Dict] = None) -> str:
+    options = options or {}
+    name = options.get("storage_profile") or ("clustered" if options.get("cluster_by") else "default")
+    if name not in STORAGE_PROFILES:
+        raise ValueError(f"Unknown storage_profile {name!r}; expected one of {', '.join(STORAGE_PROFILES)}")
+    return name
+
+# Write a table file stamped with the table's current schema version and storage profile; tables with
+# cluster_by are sorted first so each row group covers a narrow key range. Profiles that turn dictionary
+# encoding off (or limit it to some columns) go through the pyarrow writer, which needs the frame in memory
+def write_table_file(frame, path: str, parquet_name: str, options: Optional[Dict] = None, metadata: Optional[Dict[str, str]] = None) -> None:
+    options = options or {}
+    frame = frame.lazy()
+    profile_name = storage_profile_name(options)
+    profile = STORAGE_PROFILES[profile_name]
+    metadata = {**(metadata or {}), SCHEMA_VERSION_KEY: str(schema_version(parquet_name)), STORAGE_PROFILE_KEY: profile_name}
+    if options.get("cluster_by"):
+        frame = frame.sort(options["cluster_by"])
+    if profile["dictionary"] is True:
+        frame.sink_parquet(path, compression=profile["compression"], compression_level=profile["compression_level"],
+                           statistics=profile["statistics"], row_group_size=profile["row_group_size"], metadata=metadata)
+    else:
+        write_arrow_file(frame.collect().to_arrow(), path, profile_name, metadata)
+
+# Write an arrow table with a storage profile through the pyarrow writer, adding metadata to the table's own
+def write_arrow_file(table, path: str, profile_name: str, metadata: Dict[str, str]) -> None:
+    profile = STORAGE_PROFILES[profile_name]
+    metadata = {**metadata, STORAGE_PROFILE_KEY: profile_name}
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), **{key.encode(): value.encode() for key, value in metadata.items()}})
+    pq.write_table(table, path, compression=profile["compression"], compression_level=profile["compression_level"],
+                   row_group_size=profile["row_group_size"], write_statistics=profile["statistics"], use_dictionary=profile["dictionary"])
+
+# Publish several staged files as one change. The live files being replaced are kept as links under
+# Data_Tables until every rename has gone through; if one fails, the files already published are put back
+# (and new ones removed), so the table is left all old or all new. Each rename is atomic for readers of the
+# live paths, but they can see some files new and others old while the loop runs; open_snapshot() readers
+# only switch at the _current.json publish after the commit.
+def publish_files(staged: List[tuple]) -> None:
+    replaced = []
+    try:
+        for n, (temp_path, live_path) in enumerate(staged):
+            previous = None
+            if os.path.exists(live_path):
+                previous = os.path.join(DATA_TABLES_DIR, f".replaced_{os.getpid()}_{n}_{os.path.basename(live_path)}")
+                link_or_copy(live_path, previous)
+            replaced.append((live_path, previous))
+            publish_file(temp_path, live_path)
+    except BaseException:
+        for live_path, previous in reversed(replaced):
+            # rename() between two links of one file does nothing: the live file was never replaced
+            if previous is not None and os.path.exists(live_path) and os.path.samefile(previous, live_path):
+                os.remove(previous)
+            elif previous is not None:
+                os.replace(previous, live_path)
+            elif os.path.exists(live_path):
+                os.remove(live_path)
+        raise
+    for _, previous in replaced:
+        if previous is not None:
+            os.remove(previous)
+
+# One-time split of a legacy single-file table into fiscal-week partitions
+def migrate_to_partitions(parquet_file: str, dataset: str, dtype_dict: Dict[str, DataType], options: Optional[Dict] = None) -> None:
+    if not os.path.exists(parquet_file) or os.path.isdir(dataset):
+        return
+    print(f"Migrating {parquet_file} to fiscal-week partitions under {dataset}")
+    legacy_df = pl.read_parquet(parquet_file)
+    legacy_df = legacy_df.with_columns([
+        pl.col(col).cast(dtype) for col, dtype in dtype_dict.items()
+        if col in legacy_df.columns and legacy_df.schema[col] != dtype
+    ])
+    legacy_df = apply_schema_rules(legacy_df, parquet_file, file_schema_version(parquet_file))
+    staging = dataset + "_migrating"
+    for (fiscal_year, fiscal_week), part_df in with_fiscal_partitions(legacy_df).partition_by(PARTITION_COLUMNS, as_dict=True, include_key=False).items():
+        path = partition_path(staging, fiscal_year, fiscal_week)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_table_file(order_weeks(part_df), path, parquet_file, options)
+    os.replace(staging, dataset)
+    os.remove(parquet_file)
+    with open(log_file, 'a') as log:
+        log.write(f"Migrated {parquet_file} ({legacy_df.height} rows) to partitioned dataset {dataset} at {datetime.now().strftime('%H:%M:%S %Z on %m/%d/%Y')}\n")
+
+# Exact composite keys of the incoming rows; the upsert replaces existing rows with these keys
+def get_upsert_keys(new_df: pl.DataFrame, key_columns: List[str]) -> pl.DataFrame:
+    return new_df.select(key_columns).drop_nulls().unique()
+
+# Keys from --search_conditions: a list of {column: value} objects gives exact keys,
+# a dict of value lists means every combination of the listed values
+def keys_from_search_conditions(search_conditions, key_columns: List[str], parquet_file: str) -> pl.DataFrame:
+    if isinstance(search_conditions, dict):
+        keys = None
+        for col, values in search_conditions.items():
+            values_df = pl.DataFrame({col: values})
+            keys = values_df if keys is None else keys.join(values_df, how="cross")
+    else:
+        keys = pl.DataFrame(search_conditions)
+    # Validate search conditions
+    for col in keys.columns:
+        if col not in key_columns:
+            raise ValueError(f"Invalid search column '{col}' for {parquet_file}. Allowed: {key_columns}")
+    return keys.unique()
+
+# Cast key columns to the stored column types so the anti-join matches
+def align_keys(keys: pl.DataFrame, schema) -> pl.DataFrame:
+    casts = []
+    for col in keys.columns:
+        dtype = schema.get(col)
+        if dtype is None or keys.schema[col] == dtype:
+            continue
+        if keys.schema[col] == pl.Utf8 and isinstance(dtype, pl.Datetime):
+            casts.append(pl.col(col).str.to_datetime(time_unit=dtype.time_unit))
+        else:
+            casts.append(pl.col(col).cast(dtype))
+    return keys.with_columns(casts) if casts else keys
+
+# Drop existing rows whose composite key appears in keys (streaming anti-join, no literal lists in the plan)
+def anti_join_keys(existing_lazy: pl.LazyFrame, keys: pl.DataFrame, schema=None) -> pl.LazyFrame:
+    keys = align_keys(keys, schema if schema is not None else existing_lazy.collect_schema())
+    return existing_lazy.join(keys.lazy(), on=keys.columns, how="anti")
+
+# Row-hash change detection (option change_detection): every row is hashed over its non-key columns and
+# each key's digest is the sum of its row hashes plus its row count, so a key whose incoming rows match
+# the stored rows (in any order) is left alone instead of being deleted and rewritten
+ROW_HASH_COLUMN = "__row_hash"
+CHANGE_LOG_DIR = os.path.join(BASE_DIR, 'change_log')
+
+# Per-key digest over hash_columns ({column: dtype}); columns the frame lacks hash as nulls
+def key_digests(frame: pl.LazyFrame, key_columns: List[str], hash_columns: Dict) -> pl.LazyFrame:
+    names = frame.collect_schema().names()
+    return (
+        frame.with_columns([pl.lit(None, dtype=dtype).alias(col) for col, dtype in hash_columns.items() if col not in names])
+        .group_by(key_columns)
+        .agg(pl.struct(list(hash_columns)).hash(seed=0).sum().alias(ROW_HASH_COLUMN), pl.len().alias("rows"))
+    )
+
+# Incoming keys labelled "insert" (no stored rows), "update" (stored rows differ) or "unchanged";
+# incoming must already be cast to the stored column types
+def classify_changes(incoming: pl.LazyFrame, existing: Optional[pl.LazyFrame], key_columns: List[str]) -> pl.DataFrame:
+    incoming = incoming.drop(BATCH_SOURCE_COLUMN, strict=False)
+    if existing is None:
+        return incoming.select(key_columns).unique().with_columns(pl.lit("insert").alias("change")).collect()
+    hash_columns = {
+        col: dtype for col, dtype in list(existing.collect_schema().items()) + list(incoming.collect_schema().items())
+        if col not in key_columns
+    }
+    stored = key_digests(existing, key_columns, hash_columns).rename({ROW_HASH_COLUMN: "stored_hash", "rows": "stored_rows"})
+    return (
+        key_digests(incoming, key_columns, hash_columns)
+        .join(stored, on=key_columns, how="left")
+        .select(key_columns + [
+            pl.when(pl.col("stored_rows").is_null()).then(pl.lit("insert"))
+            .when((pl.col(ROW_HASH_COLUMN) == pl.col("stored_hash")) & (pl.col("rows") == pl.col("stored_rows"))).then(pl.lit("unchanged"))
+            .otherwise(pl.lit("update"))
+            .alias("change")
+        ])
+        .collect()
+    )
+
+# Append the stored ("before") and incoming ("after") rows of updated keys to change_log/<table>/, one file
+# per partition and commit, so restated numbers can be traced to the file that restated them
+def write_change_log(
+    table: str,
+    partition: tuple,
+    before: pl.LazyFrame,
+    after: pl.LazyFrame,
+    sources: Optional[List[str]],
+    changed_at: datetime
+) -> int:
+    source_file = (
+        pl.col(BATCH_SOURCE_COLUMN).replace_strict(dict(enumerate(sources)), default=None, return_dtype=pl.Utf8)
+        if sources and BATCH_SOURCE_COLUMN in after.collect_schema() else pl.lit(None, dtype=pl.Utf8)
+    )
+    log_df = pl.concat([
+        before.with_columns(pl.lit("before").alias("change"), pl.lit(None, dtype=pl.Utf8).alias("source_file")),
+        after.with_columns(pl.lit("after").alias("change"), source_file.alias("source_file")).drop(BATCH_SOURCE_COLUMN, strict=False),
+    ], how="diagonal_relaxed").with_columns(
+        pl.lit(changed_at).alias("changed_at"),
+        pl.lit(partition[0], dtype=pl.Int64).alias("fiscal_year"),
+        pl.lit(partition[1], dtype=pl.Int64).alias("fiscal_week"),
+    ).collect()
+    path = os.path.join(CHANGE_LOG_DIR, table, f"{changed_at.strftime('%Y%m%d_%H%M%S_%f')}_{partition[0]}_{partition[1]}.parquet")
+    temp_path = temp_table_path(os.path.basename(path) + '.tmp')
+    log_df.write_parquet(temp_path, compression="zstd")
+    publish_file(temp_path, path)
+    return log_df.height
+
+# Upsert into a fiscal-week partitioned dataset, rewriting only the partitions that change
+def upsert_partitions(
+    new_df: pl.DataFrame,
+    dataset: str,
+    key_columns: Optional[List[str]],
+    external_keys: Optional[pl.DataFrame] = None,
+    options: Optional[Dict] = None,
+    sources: Optional[List[str]] = None
+) -> Dict:
+    incoming = {
+        key: order_weeks(part)
+        for key, part in with_fiscal_partitions(new_df).partition_by(PARTITION_COLUMNS, as_dict=True, include_key=False).items()
+    }
+    return upsert_partition_frames(incoming, dataset, key_columns, external_keys, options, new_df.height, sources)
+
+# Upsert incoming rows given per partition as {(fiscal_year, fiscal_week): DataFrame or LazyFrame};
+# each partition's keys are computed and applied on their own. Incoming rows may carry BATCH_SOURCE_COLUMN
+# (index into sources); with change_detection, unchanged keys are skipped and partitions without inserted
+# or updated keys are not rewritten, and change_counts gives {source index: {"insert"|"update"|"unchanged": rows}}
+def upsert_partition_frames(
+    incoming: Dict[tuple, object],
+    dataset: str,
+    key_columns: Optional[List[str]],
+    external_keys: Optional[pl.DataFrame] = None,
+    options: Optional[Dict] = None,
+    row_count: int = 0,
+    sources: Optional[List[str]] = None
+) -> Dict:
+    table = os.path.basename(dataset)
+    existing = list_partitions(dataset)
+    # Incoming keys only ever match their own week; external search conditions can reach any partition
+    candidates = set(incoming) | (set(existing) if external_keys is not None else set())
+    # Search conditions replace every matching key, so they bypass change detection
+    detect = bool((options or {}).get("change_detection") and key_columns and external_keys is None)
+    changed_at = datetime.now()
+    
+    rows_removed = 0
+    partitions_written = 0
+    upsert_keys = 0
+    change_counts = {}
+    rows_logged = 0
+    # Rewritten partitions are published together once all of them are written (see publish_files)
+    staged = []
+    try:
+        for key in sorted(candidates):
+            fiscal_year, fiscal_week = key
+            path = partition_path(dataset, fiscal_year, fiscal_week)
+            part_df = incoming[key].lazy() if key in incoming else None
+            existing_lazy = None
+            existing_count = 0
+            if key in existing:
+                # Rewritten partitions are brought up to the current schema on the way through; row count and
+                # schema come from the footer
+                existing_lazy = apply_schema_rules(pl.scan_parquet(path), table, file_schema_version(path))
+                existing_schema = existing_lazy.collect_schema()
+                existing_count = pq.read_metadata(path).num_rows
+                if part_df is not None:
+                    part_schema = part_df.collect_schema()
+                    part_df = part_df.with_columns([
+                        pl.col(col).cast(dtype) for col, dtype in existing_schema.items()
+                        if col in part_schema and part_schema[col] != dtype
+                    ])
+        
+            part_keys = None
+            part_rows = 0
+            if part_df is not None and detect:
+                with telemetry_span("change_detection", table=table, partition=f"{fiscal_year}/{fiscal_week}") as span:
+                    # The partition is hashed and then rewritten: read it once
+                    if existing_lazy is not None:
+                        existing_lazy = existing_lazy.collect().lazy()
+                    labels = classify_changes(part_df, existing_lazy, key_columns)
+                    source = pl.col(BATCH_SOURCE_COLUMN) if BATCH_SOURCE_COLUMN in part_df.collect_schema() else pl.lit(0, dtype=pl.Int32)
+                    counts = (
+                        part_df.join(labels.lazy(), on=key_columns, how="left", nulls_equal=True)
+                        .group_by(source.alias(BATCH_SOURCE_COLUMN), "change").len().collect()
+                    )
+                    for source_index, change, count in counts.iter_rows():
+                        source_counts = change_counts.setdefault(source_index, {"insert": 0, "update": 0, "unchanged": 0})
+                        source_counts[change] += count
+                    updated = labels.filter(pl.col("change") == "update").select(key_columns)
+                    if updated.height:
+                        rows_logged += write_change_log(
+                            table, key,
+                            existing_lazy.join(updated.lazy(), on=key_columns, how="semi"),
+                            part_df.join(updated.lazy(), on=key_columns, how="semi"),
+                            sources, changed_at
+                        )
+                    changed = labels.filter(pl.col("change") != "unchanged").select(key_columns)
+                    part_keys = changed.drop_nulls()
+                    part_df = part_df.join(changed.lazy(), on=key_columns, how="semi", nulls_equal=True) if changed.height else None
+                    part_rows = counts.filter(pl.col("change") != "unchanged")["len"].sum()
+                    span["rows_in"] = counts["len"].sum()
+                    span["rows_out"] = part_rows
+            elif part_df is not None:
+                part_rows = part_df.select(pl.len()).collect().item()
+                if key_columns:
+                    part_keys = get_upsert_keys(part_df, key_columns).collect()
+            upsert_keys += part_keys.height if part_keys is not None else 0
+            if part_df is None and external_keys is None:
+                continue
+        
+            # One pass over the partition: the anti-join streams into the new file, and the kept and removed
+            # counts follow from the row counts in the old and new footers
+            frames = []
+            if existing_lazy is not None:
+                if external_keys is not None:
+                    frames.append(anti_join_keys(existing_lazy, external_keys, existing_schema))
+                elif part_keys is not None:
+                    frames.append(anti_join_keys(existing_lazy, part_keys, existing_schema))
+                else:
+                    frames.append(existing_lazy)
+            if part_df is not None:
+                frames.append(part_df.drop(BATCH_SOURCE_COLUMN, strict=False))
+        
+            with telemetry_span("write", table=table, partition=f"{fiscal_year}/{fiscal_week}") as span:
+                temp_parquet = temp_table_path(f"temp_{table}_{fiscal_year}_{fiscal_week}.parquet")
+                staged.append((temp_parquet, path))
+                write_table_file(pl.concat(frames, how="vertical_relaxed"), temp_parquet, table, options)
+                written = pq.read_metadata(temp_parquet).num_rows
+                span["rows_in"] = existing_count + part_rows
+                span["rows_out"] = written
+                span["rows_removed"] = existing_count + part_rows - written
+                # Search conditions that match nothing in this partition leave it as it was
+                if part_df is None and written == existing_count:
+                    os.remove(temp_parquet)
+                    staged.pop()
+                    continue
+            rows_removed += existing_count + part_rows - written
+            partitions_written += 1
+        publish_files(staged)
+    finally:
+        for temp_parquet, _ in staged:
+            if os.path.exists(temp_parquet):
+                os.remove(temp_parquet)
+    
+    partition_count = len(list_partitions(dataset))
+    # Footer row counts: partitions at older schema versions cannot be scanned as one dataset
+    final_row_count = sum(pq.read_metadata(path).num_rows for path in list_partitions(dataset).values())
+    if detect:
+        rows_added = sum(counts["insert"] + counts["update"] for counts in change_counts.values())
+        rows_unchanged = sum(counts["unchanged"] for counts in change_counts.values())
+        print(f"Upserted {rows_added} of {row_count} rows into {partitions_written} of {partition_count} partitions of {table} "
+              f"({rows_unchanged} unchanged rows skipped, {rows_logged} rows written to the change log)")
+        with open(log_file, 'a') as log:
+            log.write(f"Change detection on {table}: {rows_added} rows inserted or updated, {rows_unchanged} unchanged, "
+                      f"{rows_logged} change log rows at {datetime.now().strftime('%H:%M:%S %Z on %m/%d/%Y')}\n")
+    else:
+        rows_added = row_count
+        print(f"Upserted {row_count} rows into {partitions_written} of {partition_count} partitions of {table}")
+    return {
+        "rows_removed": rows_removed,
+        "rows_added": rows_added,
+        "final_row_count": final_row_count,
+        "partitions_written": partitions_written,
+        "upsert_keys": upsert_keys,
+        "change_counts": change_counts,
+    }
+
+# Snapshots: parquet_versions/<table>/<version>/ holds hardlinks to the table's files at commit time.
+# Every write replaces files (temp + os.replace), so unchanged files are shared by all versions and
+# changed ones keep their old inode alive only in the versions that reference them.
+def save_versions(parquet_name: str, versions: List[dict]) -> None:
+    manifest_path = os.path.join(versions_dir(parquet_name), 'versions.json')
+    temp_manifest = temp_table_path(f"{table_name(parquet_name)}_versions.json.tmp")
+    with open(temp_manifest, 'w') as f:
+        json.dump(versions, f, indent=2)
+    publish_file(temp_manifest, manifest_path)
+
+# Hardlink when the filesystem allows it, otherwise fall back to a copy
+def link_or_copy(src: str, dst: str) -> None:
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+# Record the table's current files as a new version; returns the version directory
+def snapshot_table(parquet_name: str, source: str = "") -> Optional[str]:
+    location = table_location(parquet_name)
+    if location is None:
+        return None
+    version = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    version_path = os.path.join(versions_dir(parquet_name), version)
+    kind = "dataset" if os.path.isdir(location) else "file"
+    live_files = table_files(location)
+    files = list(live_files)
+    for rel, path in live_files.items():
+        link_or_copy(path, os.path.join(version_path, rel))
+    versions = load_versions(parquet_name)
+    versions.append({
+        "version": version,
+        "created_at": datetime.now().isoformat(),
+        "kind": kind,
+        "files": files,
+        "source": os.path.basename(source),
+    })
+    save_versions(parquet_name, versions)
+    publish_version(parquet_name, versions[-1])
+    apply_retention(parquet_name)
+    return version_path
+
+# Capture the live state first if it changed after the newest snapshot (or was never snapshotted)
+def ensure_baseline_snapshot(parquet_name: str) -> None:
+    location = table_location(parquet_name)
+    if location is None:
+        return
+    if os.path.isdir(location):
+        live_mtime = max((os.path.getmtime(os.path.join(root, name)) for root, _, names in os.walk(location) for name in names), default=0)
+    else:
+        live_mtime = os.path.getmtime(location)
+    versions = load_versions(parquet_name)
+    if not versions or datetime.fromtimestamp(live_mtime) > datetime.fromisoformat(versions[-1]["created_at"]):
+        snapshot_table(parquet_name, source="baseline")
+
+# Versions retention drops from a version list: it keeps the newest version of each of the last keep_daily
+# days and keep_weekly ISO weeks that have a version (not calendar days), the latest version, and pinned ones
+def retention_removals(parquet_name: str, versions: List[dict], keep_daily: Optional[int] = None, keep_weekly: Optional[int] = None) -> List[str]:
+    keep_daily = SNAPSHOT_KEEP_DAILY if keep_daily is None else keep_daily
+    keep_weekly = SNAPSHOT_KEEP_WEEKLY if keep_weekly is None else keep_weekly
+    if not versions:
+        return []
+    newest_per_day = {}
+    newest_per_week = {}
+    for entry in versions:
+        created = datetime.fromisoformat(entry["created_at"])
+        newest_per_day[created.date()] = entry["version"]
+        newest_per_week[tuple(created.isocalendar())[:2]] = entry["version"]
+    # Never drop the newest version or one a running reader has pinned
+    keep = {versions[-1]["version"]} | pinned_versions(parquet_name)
+    keep.update(newest_per_day[day] for day in sorted(newest_per_day, reverse=True)[:keep_daily])
+    keep.update(newest_per_week[week] for week in sorted(newest_per_week, reverse=True)[:keep_weekly])
+    return [entry["version"] for entry in versions if entry["version"] not in keep]
+
+# Delete the versions retention does not keep; returns their names
+def apply_retention(parquet_name: str, keep_daily: Optional[int] = None, keep_weekly: Optional[int] = None) -> List[str]:
+    versions = load_versions(parquet_name)
+    removed = retention_removals(parquet_name, versions, keep_daily, keep_weekly)
+    for version in removed:
+        shutil.rmtree(os.path.join(versions_dir(parquet_name), version), ignore_errors=True)
+    if removed:
+        save_versions(parquet_name, [entry for entry in versions if entry["version"] not in removed])
+    return removed
+
+# Publish a committed snapshot as the table's entry in _current.json (see load_current_manifest)
+def publish_version(parquet_name: str, entry: Dict) -> None:
+    lock_path = acquire_table_lock(os.path.basename(CURRENT_MANIFEST))
+    try:
+        current = load_current_manifest()
+        current[table_name(parquet_name)] = entry
+        temp_manifest = temp_table_path(os.path.basename(CURRENT_MANIFEST) + '.tmp')
+        with open(temp_manifest, 'w') as f:
+            json.dump(current, f, indent=2)
+        publish_file(temp_manifest, CURRENT_MANIFEST)
+    finally:
+        release_table_lock(lock_path)
+
+# Rewrite a table's older files at the current schema version (deferred half of a registry change)
+def compact_table(name: str) -> int:
+    stale = stale_schema_files(name)
+    if not stale:
+        return 0
+    ensure_baseline_snapshot(name)
+    options = table_options(name)
+    # Every rewritten file is published together once all of them are written (see publish_files)
+    staged = []
+    try:
+        for n, path in enumerate(stale):
+            temp_parquet = temp_table_path(f"temp_compact_{table_name(name)}_{n}.parquet")
+            staged.append((temp_parquet, path))
+            write_table_file(apply_schema_rules(pl.scan_parquet(path), name, file_schema_version(path)), temp_parquet, name, options)
+        publish_files(staged)
+    finally:
+        for temp_parquet, _ in staged:
+            if os.path.exists(temp_parquet):
+                os.remove(temp_parquet)
+    if options.get("lookup_index"):
+        refresh_lookup_index(name, list(options["lookup_index"].values()))
+    snapshot_table(name, source="compaction")
+    print(f"Compacted {len(stale)} files of {table_name(name)} to schema version {schema_version(name)}")
+    with open(log_file, 'a') as log:
+        log.write(f"Compacted {len(stale)} files of {table_name(name)} to schema version {schema_version(name)} at {datetime.now().strftime('%H:%M:%S %Z on %m/%d/%Y')}\n")
+    return len(stale)
+
+# Rewrite the snapshot files a table's live version no longer uses with ARCHIVE_STORAGE_PROFILE. Rows,
+# order and file metadata (schema version included) are kept. A file shared by several versions is one
+# inode, so it is rewritten once and relinked into every version; files still live are left alone
+def archive_snapshots(name: str) -> int:
+    location = table_location(name)
+    live_inodes = {os.stat(path).st_ino for path in table_files(location).values()} if location else set()
+    by_inode = {}
+    for entry in load_versions(name):
+        for rel in entry["files"]:
+            path = os.path.join(versions_dir(name), entry["version"], rel)
+            if os.path.exists(path) and os.stat(path).st_ino not in live_inodes:
+                by_inode.setdefault(os.stat(path).st_ino, []).append(path)
+    bytes_before = bytes_after = 0
+    archived = 0
+    for paths in by_inode.values():
+        metadata = pq.read_metadata(paths[0]).metadata or {}
+        if metadata.get(STORAGE_PROFILE_KEY.encode()) == ARCHIVE_STORAGE_PROFILE.encode():
+            continue
+        temp_parquet = temp_table_path(f"archive_{table_name(name)}.parquet.tmp")
+        kept = {key.decode(): value.decode() for key, value in metadata.items() if key != b"ARROW:schema"}
+        write_arrow_file(pq.read_table(paths[0]), temp_parquet, ARCHIVE_STORAGE_PROFILE, kept)
+        bytes_before += os.path.getsize(paths[0])
+        bytes_after += os.path.getsize(temp_parquet)
+        for path in paths:
+            link_or_copy(temp_parquet, path + ".tmp")
+            os.replace(path + ".tmp", path)
+        os.remove(temp_parquet)
+        archived += 1
+    if archived:
+        print(f"Archived {archived} snapshot files of {table_name(name)}: {bytes_before / 1024 / 1024:.1f} MB -> {bytes_after / 1024 / 1024:.1f} MB")
+        with open(log_file, 'a') as log:
+            log.write(f"Archived {archived} snapshot files of {table_name(name)} with storage profile {ARCHIVE_STORAGE_PROFILE} "
+                      f"({bytes_before} -> {bytes_after} bytes) at {datetime.now().strftime('%H:%M:%S %Z on %m/%d/%Y')}\n")
+    return archived
+
+# Make a snapshot the live table again by relinking its files (no data is copied)
+def rollback_table(name: str, as_of) -> str:
+    entry = resolve_version(name, as_of)
+    version_path = os.path.join(versions_dir(name), entry["version"])
+    parquet_file = os.path.join(DATA_TABLES_DIR, table_name(name) + '.parquet')
+    live = dataset_dir(parquet_file) if entry["kind"] == "dataset" else parquet_file
+    other = parquet_file if live != parquet_file else dataset_dir(parquet_file)
+    staging = live + "_rollback"
+    # Same lock as ingest, --recluster and --compact, so no commit interleaves with the swap
+    lock_path = acquire_table_lock(os.path.basename(parquet_file))
+    try:
+        if os.path.isdir(staging):
+            shutil.rmtree(staging)
+        if entry["kind"] == "dataset":
+            for rel in entry["files"]:
+                link_or_copy(os.path.join(version_path, rel), os.path.join(staging, rel))
+        else:
+            link_or_copy(os.path.join(version_path, entry["files"][0]), staging)
+        # Swap in the relinked copy. A file replaces a file in one rename; a live directory cannot be replaced
+        # in place, so it is renamed aside just before. The old layout is only removed once the new one is live
+        replaced = []
+        if os.path.isdir(live):
+            replaced.append(os.path.join(DATA_TABLES_DIR, f".{os.path.basename(live)}_replaced"))
+            os.replace(live, replaced[-1])
+        try:
+            os.replace(staging, live)
+        except OSError:
+            if replaced:
+                os.replace(replaced[-1], live)
+            raise
+        # Rolling back across the move to partitions leaves the other layout behind
+        if os.path.exists(other):
+            replaced.append(os.path.join(DATA_TABLES_DIR, f".{os.path.basename(other)}_replaced"))
+            os.replace(other, replaced[-1])
+        for aside in replaced:
+            if os.path.isdir(aside):
+                shutil.rmtree(aside)
+            else:
+                os.remove(aside)
+        snapshot_table(name, source=f"rollback to {entry['version']}")
+    finally:
+        release_table_lock(lock_path)
+    print(f"Rolled back {table_name(name)} to version {entry['version']} ({entry['created_at']})")
+    return entry["version"]
+
+# Old full-copy backups (<table>_YYYYmmdd_HHMMSS.parquet) left in parquet_versions: [(path, table file, created)]
+def legacy_backups() -> List[tuple]:
+    found = []
+    if not os.path.isdir(PARQUET_VERSIONS_DIR):
+        return found
+    for file in sorted(os.listdir(PARQUET_VERSIONS_DIR)):
+        path = os.path.join(PARQUET_VERSIONS_DIR, file)
+        parts = file[:-len('.parquet')].rsplit('_', 2) if file.endswith('.parquet') else []
+        if len(parts) != 3 or not os.path.isfile(path):
+            continue
+        try:
+            created = datetime.strptime(f"{parts[1]}_{parts[2]}", "%Y%m%d_%H%M%S")
+        except ValueError:
+            continue
+        found.append((path, parts[0] + '.parquet', created))
+    return found
+
+# Move the legacy backups into the snapshot layout (--import_legacy_backups). Retention then applies to them
+# like any snapshot, so most are deleted; every version it removes is listed, and with dry_run nothing is
+# moved or deleted. Returns {table file: versions retention removes}
+def import_legacy_backups(dry_run: bool = False) -> Dict[str, List[str]]:
+    imported = {}
+    for path, parquet_name, created in legacy_backups():
+        version = created.strftime("%Y%m%d_%H%M%S_%f")
+        imported.setdefault(parquet_name, []).append({
+            "version": version,
+            "created_at": created.isoformat(timespec="seconds"),
+            "kind": "file",
+            "files": [parquet_name],
+            "source": "legacy backup",
+        })
+        if not dry_run:
+            os.makedirs(os.path.join(versions_dir(parquet_name), version), exist_ok=True)
+            os.replace(path, os.path.join(versions_dir(parquet_name), version, parquet_name))
+    removals = {}
+    for parquet_name, entries in imported.items():
+        versions = sorted(load_versions(parquet_name) + entries, key=lambda entry: entry["created_at"])
+        if dry_run:
+            removals[parquet_name] = retention_removals(parquet_name, versions)
+        else:
+            save_versions(parquet_name, versions)
+            removals[parquet_name] = apply_retention(parquet_name)
+        created = {entry["version"]: entry["created_at"] for entry in versions}
+        kept = len({entry["version"] for entry in entries} - set(removals[parquet_name]))
+        print(f"{table_name(parquet_name)}: {len(entries)} legacy backups {'would be ' if dry_run else ''}imported, {kept} kept; "
+              f"retention {'would remove' if dry_run else 'removed'} {len(removals[parquet_name])} versions"
+              f" (newest per day for the last {SNAPSHOT_KEEP_DAILY} days with a snapshot, per week for the last {SNAPSHOT_KEEP_WEEKLY} such weeks)")
+        for version in removals[parquet_name]:
+            print(f"  {'would remove' if dry_run else 'removed'} {version} ({created[version]})")
+        if not dry_run:
+            with open(log_file, 'a') as log:
+                log.write(f"Imported {len(entries)} legacy backups of {parquet_name}, retention removed {len(removals[parquet_name])} versions: "
+                          f"{', '.join(removals[parquet_name])} at {datetime.now().strftime('%H:%M:%S %Z on %m/%d/%Y')}\n")
+    return removals
+
+# Point lookups: a sidecar index (Data_Tables/_lookup_index/<table>.parquet) maps every value of the
+# lookup columns to the (file, row group) pairs that hold it. Entries carry the file's size and mtime,
+# so files replaced since they were indexed (upserts, rollbacks, reclustering) are re-indexed on use.
+LOOKUP_INDEX_SCHEMA = {
+    "file": pl.Utf8,
+    "mtime_ns": pl.Int64,
+    "size": pl.Int64,
+    "row_group": pl.Int32,
+    "column": pl.Utf8,
+    "value": pl.Utf8,
+}
+
+def lookup_index_path(parquet_name: str) -> str:
+    return os.path.join(LOOKUP_INDEX_DIR, table_name(parquet_name) + '.parquet')
+
+# file_configs options of a table
+def table_options(name: str) -> Dict:
+    for config in file_configs:
+        if table_name(config[2]) == table_name(name):
+            return config[7]
+    raise ValueError(f"Unknown table {table_name(name)}")
+
+# Distinct values of the lookup columns in each row group of one file
+def index_row_groups(path: str, rel: str, columns: List[str]) -> pl.DataFrame:
+    parquet = pq.ParquetFile(path)
+    columns = [col for col in columns if col in parquet.schema_arrow.names]
+    stat = os.stat(path)
+    frames = []
+    for row_group in range(parquet.num_row_groups):
+        group = pl.from_arrow(parquet.read_row_group(row_group, columns=columns))
+        for col in columns:
+            frames.append(group.select(pl.col(col).cast(pl.Utf8).alias("value")).drop_nulls().unique().with_columns(
+                pl.lit(rel).alias("file"),
+                pl.lit(stat.st_mtime_ns, dtype=pl.Int64).alias("mtime_ns"),
+                pl.lit(stat.st_size, dtype=pl.Int64).alias("size"),
+                pl.lit(row_group, dtype=pl.Int32).alias("row_group"),
+                pl.lit(col).alias("column"),
+            ).select(list(LOOKUP_INDEX_SCHEMA)))
+    return pl.concat(frames) if frames else pl.DataFrame(schema=LOOKUP_INDEX_SCHEMA)
+
+# Re-index only the files of a table that are new or changed since the last refresh; returns the index path.
+# The index is sorted by (column, value) so a lookup scan skips all but a few of its own row groups.
+def refresh_lookup_index(parquet_name: str, columns: List[str]) -> Optional[str]:
+    location = table_location(parquet_name)
+    if location is None:
+        return None
+    index_path = lookup_index_path(parquet_name)
+    files = table_files(location)
+    current = pl.DataFrame({
+        "file": list(files),
+        "mtime_ns": [os.stat(path).st_mtime_ns for path in files.values()],
+        "size": [os.stat(path).st_size for path in files.values()],
+    }, schema={"file": pl.Utf8, "mtime_ns": pl.Int64, "size": pl.Int64})
+    indexed = (
+        pl.scan_parquet(index_path).select("file", "mtime_ns", "size").unique().collect()
+        if os.path.exists(index_path) else current.head(0)
+    )
+    fresh = indexed.join(current, on=["file", "mtime_ns", "size"], how="semi")
+    stale = [rel for rel in files if rel not in set(fresh["file"].to_list())]
+    if not stale and fresh.height == indexed.height:
+        return index_path
+    frames = [pl.read_parquet(index_path).join(fresh, on=["file", "mtime_ns", "size"], how="semi")] if fresh.height else []
+    frames += [index_row_groups(files[rel], rel, columns) for rel in stale]
+    index = pl.concat(frames) if frames else pl.DataFrame(schema=LOOKUP_INDEX_SCHEMA)
+    os.makedirs(LOOKUP_INDEX_DIR, exist_ok=True)
+    temp_index = temp_table_path(f"{os.path.basename(index_path)}.{os.getpid()}.tmp")
+    index.sort("column", "value").write_parquet(temp_index, compression="snappy", statistics=True, row_group_size=CLUSTERED_ROW_GROUP_ROWS)
+    publish_file(temp_index, index_path)
+    with open(log_file, 'a') as log:
+        log.write(f"Indexed {len(stale)} files of {table_name(parquet_name)} for lookups ({index.height} index entries) at {datetime.now().strftime('%H:%M:%S %Z on %m/%d/%Y')}\n")
+    return index_path
+
+# All rows of a table for a set of OMS IDs and/or UPCs, reading only the row groups the index says can match
+def lookup_rows(name: str, oms_ids: Optional[list] = None, upcs: Optional[list] = None) -> pl.DataFrame:
+    start = time.perf_counter()
+    lookup_columns = table_options(name).get("lookup_index")
+    if not lookup_columns:
+        raise ValueError(f"Table {table_name(name)} has no lookup_index in file_configs")
+    wanted = {
+        lookup_columns[arg]: [str(value) for value in values]
+        for arg, values in (("oms_ids", oms_ids), ("upcs", upcs)) if values
+    }
+    if not wanted:
+        raise ValueError("lookup_rows needs oms_ids and/or upcs")
+    index_path = refresh_lookup_index(name, list(lookup_columns.values()))
+    if index_path is None:
+        raise FileNotFoundError(f"Table {table_name(name)} does not exist in {DATA_TABLES_DIR}")
+    location = table_location(name)
+    files = table_files(location)
+    hits = pl.concat([
+        pl.scan_parquet(index_path).filter((pl.col("column") == col) & pl.col("value").is_in(values))
+        for col, values in wanted.items()
+    ]).select("file", "row_group").unique().collect()
+    
+    frames = []
+    for (rel,), groups in sorted(hits.partition_by("file", as_dict=True).items()):
+        rows = pl.from_arrow(pq.ParquetFile(files[rel]).read_row_groups(sorted(groups["row_group"].to_list())))
+        rows = rows.filter(pl.any_horizontal([pl.col(col).cast(pl.Utf8).is_in(values) for col, values in wanted.items()]))
+        rows = apply_schema_rules(rows, name, file_schema_version(files[rel])).with_columns(hive_columns(rel))
+        # pyarrow hands dictionary columns back as Categorical; match the stored Enum
+        frames.append(order_weeks(rows))
+    result = pl.concat(frames, how="vertical_relaxed") if frames else read_table(name).head(0).collect()
+    
+    print(f"Lookup on {table_name(name)}: read {hits.height} row groups from {len(frames)} of {len(files)} files, "
+          f"{result.height} rows in {(time.perf_counter() - start) * 1000:.1f} ms")
+    return result
+
+# Rewrite every file of a clustered table in cluster order (files written before clustering was enabled)
+def recluster_table(name: str) -> int:
+    options = table_options(name)
+    if not options.get("cluster_by"):
+        raise ValueError(f"Table {table_name(name)} has no cluster_by in file_configs")
+    location = table_location(name)
+    if location is None:
+        raise FileNotFoundError(f"Table {table_name(name)} does not exist in {DATA_TABLES_DIR}")
+    ensure_baseline_snapshot(name)
+    files = table_files(location)
+    # Every rewritten file is published together once all of them are written (see publish_files)
+    staged = []
+    try:
+        for n, path in enumerate(files.values()):
+            temp_parquet = temp_table_path(f"temp_recluster_{table_name(name)}_{n}.parquet")
+            staged.append((temp_parquet, path))
+            write_table_file(apply_schema_rules(pl.scan_parquet(path), name, file_schema_version(path)), temp_parquet, name, options)
+        publish_files(staged)
+    finally:
+        for temp_parquet, _ in staged:
+            if os.path.exists(temp_parquet):
+                os.remove(temp_parquet)
+    if options.get("lookup_index"):
+        refresh_lookup_index(name, list(options["lookup_index"].values()))
+    snapshot_table(name, source="recluster")
+    print(f"Reclustered {len(files)} files of {table_name(name)} by {options['cluster_by']}")
+    with open(log_file, 'a') as log:
+        log.write(f"Reclustered {len(files)} files of {table_name(name)} by {options['cluster_by']} at {datetime.now().strftime('%H:%M:%S %Z on %m/%d/%Y')}\n")
+    return len(files)
 
 # Memory and CPU tracking functions
 process = psutil.Process()
@@ -338,157 +1754,539 @@ def get_memory_usage() -> float:
 def get_cpu_times():
     return process.cpu_times()
 
-# Extract unique values from input file for search columns
-def get_search_values(df_lazy: pl.LazyFrame, search_columns: List[str]) -> Dict[str, list]:
-    search_conditions = {}
-    if not search_columns:
-        return search_conditions
+# Peak resident memory of this process so far in MB (peak working set on Windows). Span tracking resets the
+# Linux high-water mark that ru_maxrss reports, so the peaks it folded away before a reset count too
+def get_peak_memory() -> float:
+    info = process.memory_info()
+    if hasattr(info, "peak_wset"):
+        return info.peak_wset / (1024 * 1024)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 if resource else info.rss / (1024 * 1024)
+    return max(peak, rss_peak_folded)
+
+# Per-span peak memory. On Linux the process high-water mark (VmHWM) can be reset by writing 5 to
+# /proc/self/clear_refs: every span start and end folds the mark reached since the last reset into each open
+# span and resets it, so a span's peak_rss_mb is the highest RSS while it was open, whatever ran before it.
+# Where the mark cannot be reset, RSS is sampled at span boundaries (a lower bound). Nothing is reset until
+# the first span starts, so importing the module leaves the host process's mark alone.
+rss_peak_folded = 0.0
+# Whether the mark can be reset here: None until the first span tries
+rss_high_water_resettable = None
+
+# VmHWM in MB, or None without /proc
+def read_rss_high_water() -> Optional[float]:
+    try:
+        with open("/proc/self/status", 'r') as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+def reset_rss_high_water() -> bool:
+    try:
+        with open("/proc/self/clear_refs", 'w') as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def fold_span_peaks(spans: List[dict]) -> None:
+    global rss_peak_folded, rss_high_water_resettable
+    high = read_rss_high_water() if rss_high_water_resettable is not False else None
+    high = get_memory_usage() if high is None else high
+    rss_peak_folded = max(rss_peak_folded, high)
+    for span in spans:
+        span["peak_rss_mb"] = max(span.get("peak_rss_mb") or 0.0, high)
+    if rss_high_water_resettable is not False:
+        rss_high_water_resettable = reset_rss_high_water()
+
+# Bytes this process has read and written so far (through any file or socket); zeros where unsupported
+def get_io_bytes() -> tuple:
+    try:
+        io = process.io_counters()
+    except (AttributeError, psutil.Error):
+        return 0, 0
+    return getattr(io, "read_chars", io.read_bytes), getattr(io, "write_chars", io.write_bytes)
+
+# Run telemetry: JSON lines in telemetry.jsonl, one event per finished span. Spans nest (run > ingest >
+# discover/read/transform/change_detection/write/index/backup, run > merge) and record wall and CPU time, the
+# span's own peak RSS (and the process's so far), rows in/out, bytes read/written and rows/sec. Events are buffered and appended in one write per flush.
+TELEMETRY_FILE = os.path.join(BASE_DIR, 'telemetry.jsonl')
+TELEMETRY_FLUSH_EVENTS = 200
+telemetry_buffer = []
+telemetry_stack = []
+telemetry_ids = itertools.count(1)
+
+# Run id and parent span are passed to parallel workers through the environment
+def start_telemetry_run() -> str:
+    os.environ["THD_TELEMETRY_RUN"] = datetime.now().strftime("%Y%m%d_%H%M%S_") + str(os.getpid())
+    os.environ.pop("THD_TELEMETRY_PARENT", None)
+    return os.environ["THD_TELEMETRY_RUN"]
+
+def telemetry_run_id() -> str:
+    return os.environ.get("THD_TELEMETRY_RUN") or start_telemetry_run()
+
+def flush_telemetry() -> None:
+    if not telemetry_buffer:
+        return
+    data = "".join(json.dumps(event, default=str) + "\n" for event in telemetry_buffer).encode()
+    telemetry_buffer.clear()
+    # A single O_APPEND write keeps lines from concurrent workers whole
+    fd = os.open(TELEMETRY_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+# Time a pipeline stage; the yielded span dict takes rows_in / rows_out (and bytes_* to override the
+# process I/O counters) plus any extra attributes before it is emitted
+@contextmanager
+def telemetry_span(stage: str, **attributes):
+    span = {
+        "event": "span",
+        "run_id": telemetry_run_id(),
+        "span_id": f"{os.getpid()}-{next(telemetry_ids)}",
+        "parent_id": telemetry_stack[-1]["span_id"] if telemetry_stack else os.environ.get("THD_TELEMETRY_PARENT"),
+        "stage": stage,
+        "started_at": datetime.now().isoformat(),
+        "rows_in": None,
+        "rows_out": None,
+        "bytes_read": None,
+        "bytes_written": None,
+    }
+    span.update(attributes)
+    # Buffered events are flushed at exit once a span has run (registered here rather than at import)
+    if not telemetry_stack:
+        atexit.unregister(flush_telemetry)
+        atexit.register(flush_telemetry)
+    fold_span_peaks(telemetry_stack)
+    telemetry_stack.append(span)
+    cpu_before = get_cpu_times()
+    read_before, written_before = get_io_bytes()
+    start = time.perf_counter()
+    try:
+        yield span
+        span["status"] = "ok"
+    except BaseException as e:
+        span["status"] = "error"
+        span["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        wall = time.perf_counter() - start
+        cpu_after = get_cpu_times()
+        read_after, written_after = get_io_bytes()
+        fold_span_peaks(telemetry_stack)
+        telemetry_stack.remove(span)
+        span["wall_s"] = round(wall, 6)
+        span["cpu_s"] = round((cpu_after.user - cpu_before.user) + (cpu_after.system - cpu_before.system), 6)
+        span["peak_rss_mb"] = round(span["peak_rss_mb"], 1)
+        span["process_peak_rss_mb"] = round(get_peak_memory(), 1)
+        if span["bytes_read"] is None:
+            span["bytes_read"] = read_after - read_before
+        if span["bytes_written"] is None:
+            span["bytes_written"] = written_after - written_before
+        rows = span["rows_out"] if span["rows_out"] is not None else span["rows_in"]
+        span["rows_per_s"] = round(rows / wall, 1) if rows and wall > 0 else None
+        telemetry_buffer.append(span)
+        if len(telemetry_buffer) >= TELEMETRY_FLUSH_EVENTS or not telemetry_stack:
+            flush_telemetry()
+
+# Batch source column: position of each row's file in the batch (later files win on overlapping keys)
+BATCH_SOURCE_COLUMN = "__batch_source"
+
+# In-memory sources handed to ingest(): {label used in place of a file path: lazy frame}
+memory_sources = {}
+
+# Give an in-memory frame the config's column spec and declared types: text columns go through the same
+# parsers as the strict CSV reader (values that do not parse become null), other columns are cast, and
+# columns already of the declared type are passed through untouched so their Arrow buffers are not copied
+def type_frame(
+    frame: pl.LazyFrame,
+    dtype_dict: Dict[str, DataType],
+    parquet_name: str,
+    include_columns: Optional[List[str]] = None,
+    exclude_columns: Optional[List[str]] = None,
+    prune_stats: Optional[Dict] = None
+) -> pl.LazyFrame:
+    source_schema = frame.collect_schema()
+    kept = select_columns(source_schema.names(), include_columns, exclude_columns)
+    if prune_stats is not None and (include_columns or exclude_columns):
+        prune_stats.update({"columns_total": len(source_schema), "columns_pruned": len(source_schema) - len(kept), "bytes_pruned": 0})
+    columns = []
+    for col, dtype in strict_schema(kept, dtype_dict, parquet_name).items():
+        if dtype is None or source_schema[col] == dtype:
+            columns.append(pl.col(col))
+        elif source_schema[col] == pl.Utf8:
+            columns.append(parse_text(col, dtype).alias(col))
+        else:
+            columns.append(pl.col(col).cast(dtype, strict=False))
+    return frame.select(columns)
+
+# Read a batch of source files as one lazy frame: the config's column spec is applied while parsing, each
+# row is tagged with its file's position in the batch, and the result is brought up to the table's current
+# schema (aliases, casts, derived columns from the registry)
+def read_sources(
+    input_paths: List[str],
+    parquet_file: str,
+    dtype_dict: Dict[str, DataType],
+    is_excel: bool,
+    sheet_name: str,
+    start_row: int,
+    options: Dict,
+    prune_stats: Dict
+) -> pl.LazyFrame:
+    include_columns = options.get("include_columns")
+    exclude_columns = options.get("exclude_columns")
+    frames = []
+    for source_index, path in enumerate(input_paths):
+        if path in memory_sources:
+            frame = type_frame(memory_sources[path], dtype_dict, parquet_file, include_columns, exclude_columns, prune_stats)
+        elif is_excel:
+            frame = read_excel_lazy(
+                path, dtype_dict, sheet_name=sheet_name, start_row=start_row,
+                include_columns=include_columns, exclude_columns=exclude_columns, prune_stats=prune_stats
+            )
+        elif options.get("strict_schema"):
+            frame = read_csv_strict(path, dtype_dict, parquet_file, include_columns, exclude_columns, prune_stats)
+        else:
+            frame = read_csv_lazy(path, dtype_dict, include_columns, exclude_columns, prune_stats)
+        frames.append(frame.with_columns(pl.lit(source_index, dtype=pl.Int32).alias(BATCH_SOURCE_COLUMN)))
+    new_df_lazy = frames[0] if len(frames) == 1 else pl.concat(frames, how="diagonal_relaxed")
+    return apply_schema_rules(flag_unknown_weeks(new_df_lazy), parquet_file)
+
+# Refresh the point-lookup index and record the committed state as a new snapshot version
+def commit_table(parquet_file: str, options: Dict, source_names: str, errors_encountered: List[str]) -> Optional[str]:
+    if options.get("lookup_index"):
+        with telemetry_span("index", table=table_name(parquet_file)):
+            refresh_lookup_index(parquet_file, list(options["lookup_index"].values()))
+    backup_path = None
+    try:
+        with telemetry_span("backup", table=table_name(parquet_file)):
+            backup_path = snapshot_table(parquet_file, source=source_names)
+        print(f"Snapshot of {os.path.basename(parquet_file)} saved as {backup_path}")
+    except Exception as e:
+        print(f"Warning: Failed to snapshot {parquet_file}: {str(e)}")
+        errors_encountered.append(str(e))
+    return backup_path
+
+# Per-file insert/update/unchanged row counts from change detection, added to a batch's file_rows
+def add_change_counts(file_rows: List[Dict], change_counts: Dict[int, dict]) -> None:
+    if not change_counts:
+        return
+    active = [file_row for file_row in file_rows if not file_row["superseded"]]
+    for source_index, file_row in enumerate(active):
+        counts = change_counts.get(source_index, {})
+        file_row["rows_inserted"] = counts.get("insert", 0)
+        file_row["rows_updated"] = counts.get("update", 0)
+        file_row["rows_unchanged"] = counts.get("unchanged", 0)
+
+# Chunked ingest spills to local disk (override with THD_SPILL_DIR, e.g. when the temp drive is small)
+SPILL_DIR = os.environ.get("THD_SPILL_DIR") or os.path.join(tempfile.gettempdir(), 'thd_spill')
+
+# Rows per streamed batch when a table's CSV inputs would not fit the memory budget (MB), None when they fit.
+# Typed Arrow data runs ~2x the (uncompressed) CSV text; a batch gets a quarter of the budget so the per-week split and the
+# spill writer have room beside it.
+def chunk_batch_rows(input_paths: List[str], memory_budget: Optional[float]) -> Optional[int]:
+    if not memory_budget:
+        return None
+    input_mb = sum(source_bytes(path) for path in input_paths) / (1024 * 1024)
+    if input_mb * 2.0 <= memory_budget:
+        return None
+    with open_source(input_paths[0]) as f:
+        sample = f.read(1 << 20)
+    line_bytes = max(len(sample) / max(sample.count(b'\n'), 1), 1.0)
+    return max(10_000, int(memory_budget * 1024 * 1024 / 4 / (line_bytes * 2.0)))
+
+# Chunked ingest for a partitioned table whose inputs would not fit the memory budget: the sources are
+# streamed in bounded batches and spilled to local disk as per-week chunk files, then each fiscal week is
+# resolved (latest file wins), keyed and upserted on its own. Peak memory follows the largest week of
+# input rather than the whole export.
+def process_parquet_chunked(
+    input_paths: List[str],
+    parquet_file: str,
+    dtype_dict: Dict[str, DataType],
+    search_columns: List[str],
+    external_search_conditions: Optional[Dict[str, list]],
+    options: Dict,
+    batch_rows: int
+) -> Dict:
+    memory_before = get_memory_usage()
+    cpu_times_before = get_cpu_times()
+    errors_encountered = []
+    table = table_name(parquet_file)
+    source_names = ", ".join(os.path.basename(path) for path in input_paths)
+    print(f"Inputs of {table} exceed the memory budget: streaming {source_names} in batches of {batch_rows} rows")
+    os.makedirs(SPILL_DIR, exist_ok=True)
+    spill_dir = tempfile.mkdtemp(prefix=f"{table}_", dir=SPILL_DIR)
+    try:
+        # Stream the sources once, splitting every batch by fiscal week into spill files
+        prune_stats = {}
+        chunks = {}
+        rows_read = {}
+        rejected = {}
+        with telemetry_span("read", table=table, files=len(input_paths), chunked=True) as span:
+            read_start = time.perf_counter()
+            new_df_lazy = with_fiscal_partitions(read_sources(input_paths, parquet_file, dtype_dict, False, "Sheet1", 1, options, prune_stats))
+            for n, batch in enumerate(new_df_lazy.collect_batches(chunk_size=batch_rows)):
+                batch = split_rejects(split_unknown_weeks(batch, input_paths), rejected)
+                for source_index, count in batch.group_by(BATCH_SOURCE_COLUMN).len().iter_rows():
+                    rows_read[source_index] = rows_read.get(source_index, 0) + count
+                for key, part in batch.partition_by(PARTITION_COLUMNS, as_dict=True, include_key=False).items():
+                    path = os.path.join(spill_dir, f"{key[0]}_{key[1]}_{n}.parquet")
+                    order_weeks(part).write_parquet(path, compression="lz4")
+                    chunks.setdefault(key, []).append(path)
+            span["rows_out"] = sum(rows_read.values())
+            span["spill_files"] = sum(len(paths) for paths in chunks.values())
+        reject_counts = report_rejects(rejected, input_paths, parquet_file, dtype_dict)
+        print(f"Spilled {sum(rows_read.values())} rows of {source_names} into {len(chunks)} fiscal weeks under {spill_dir}")
+        
+        # Per week: overlapping keys inside a batch keep only the rows from the latest file that has them
+        with telemetry_span("transform", table=table, chunked=True) as span:
+            span["rows_in"] = sum(rows_read.values())
+            incoming = {}
+            rows_kept = dict(rows_read) if len(input_paths) == 1 else {}
+            for key, paths in chunks.items():
+                part_lazy = pl.scan_parquet(paths)
+                if len(input_paths) > 1:
+                    latest = part_lazy.group_by(search_columns).agg(pl.col(BATCH_SOURCE_COLUMN).max())
+                    part_lazy = part_lazy.join(latest, on=search_columns + [BATCH_SOURCE_COLUMN], how="semi", nulls_equal=True)
+                    for source_index, count in part_lazy.group_by(BATCH_SOURCE_COLUMN).len().collect().iter_rows():
+                        rows_kept[source_index] = rows_kept.get(source_index, 0) + count
+                incoming[key] = part_lazy
+            file_rows = [
+                {"file": path, "rows_read": rows_read.get(i, 0), "rows_kept": rows_kept.get(i, 0), "superseded": False, "values_rejected": reject_counts.get(i, 0)}
+                for i, path in enumerate(input_paths)
+            ]
+            new_row_count = sum(rows_kept.values())
+            pruning = prune_report(prune_stats, time.perf_counter() - read_start)
+            
+            # Upsert keys are computed per week during the upsert; the summary shows a sample of values
+            keys = None
+            if external_search_conditions:
+                keys = keys_from_search_conditions(external_search_conditions, search_columns, parquet_file)
+                search_conditions = {col: keys[col].unique().head(6).to_list() for col in keys.columns} if keys.height else {}
+            spilled = [path for paths in chunks.values() for path in paths]
+            # The expectations aggregate over the spilled rows in the same collect as the sample of key values.
+            # Weeks kept as text and Enum weeks spill to different files, so the scan across weeks relaxes week
+            spilled_lazy = pl.concat([pl.scan_parquet(path) for path in spilled], how="vertical_relaxed") if spilled else None
+            samples = [spilled_lazy.select(pl.col(col).drop_nulls().unique().head(6)) for col in search_columns] if spilled and keys is None else []
+            measured_lazy = expectation_frame(spilled_lazy, spilled_lazy, options.get("expectations")) if spilled else None
+            collected = pl.collect_all(samples + ([measured_lazy] if measured_lazy is not None else []))
+            if keys is None:
+                search_conditions = {col: sample[col].to_list() for col, sample in zip(search_columns, collected)}
+            measured = collected[len(samples)] if measured_lazy is not None else None
+            expectation_results = check_expectations(measured, options.get("expectations"), input_paths, parquet_file)
+            for i, file_row in enumerate(file_rows):
+                file_row["expectations"] = expectation_results.get(i, [])
+            span["rows_out"] = new_row_count
+        
+        dataset = dataset_dir(parquet_file)
+        migrate_to_partitions(parquet_file, dataset, dtype_dict, options)
+        upsert = upsert_partition_frames(incoming, dataset, search_columns, keys, options, new_row_count, [os.path.basename(path) for path in input_paths])
+        add_change_counts(file_rows, upsert["change_counts"])
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
     
-    df = df_lazy.select(search_columns).unique().collect()
-    for col in search_columns:
-        values = df[col].drop_nulls().to_list()
-        if values:
-            search_conditions[col] = values
-    return search_conditions
-
-# Process Parquet file: backup, search, remove, append
+    if upsert["partitions_written"]:
+        backup_path = commit_table(parquet_file, options, source_names, errors_encountered)
+    else:
+        backup_path = None
+        print(f"No rows of {table} changed; snapshot skipped")
+    
+    memory_after = get_memory_usage()
+    cpu_times_after = get_cpu_times()
+    
+    return {
+        "memory_used": memory_after - memory_before,
+        "user_time": cpu_times_after.user - cpu_times_before.user,
+        "system_time": cpu_times_after.system - cpu_times_before.system,
+        "search_conditions": search_conditions,
+        "upsert_keys": keys.height if keys is not None else upsert["upsert_keys"],
+        "rows_removed": upsert["rows_removed"],
+        "rows_added": upsert["rows_added"],
+        "final_row_count": upsert["final_row_count"],
+        "backup_path": backup_path if backup_path else "No backup",
+        "pruning": pruning,
+        "file_rows": file_rows,
+        "errors": errors_encountered
+    }
+
+# Process Parquet file: search, remove, append, snapshot. input_path may be a list of source files
+# for the same table: they are read as one batch and committed with a single upsert and snapshot.
 def process_parquet(
-    input_path: str,
+    input_path,
     parquet_file: str,
     dtype_dict: Dict[str, DataType],
     is_excel: bool,
     search_columns: Optional[List[str]],
     external_search_conditions: Optional[Dict[str, list]] = None,
     sheet_name: str = "Sheet1",
-    start_row: int = 1
+    start_row: int = 1,
+    options: Optional[Dict] = None,
+    memory_budget: Optional[float] = None
 ) -> Dict:
+    options = options or {}
     memory_before = get_memory_usage()
     cpu_times_before = get_cpu_times()
     errors_encountered = []
     
-    # Backup existing Parquet file if it exists
-    backup_path = None
-    if os.path.exists(parquet_file):
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        backup_filename = f"{os.path.basename(parquet_file).replace('.parquet', '')}_{timestamp}.parquet"
-        backup_path = os.path.join(PARQUET_VERSIONS_DIR, backup_filename)
-        try:
-            shutil.copy2(parquet_file, backup_path)
-            print(f"Backed up {parquet_file} to {backup_path}")
-        except Exception as e:
-            print(f"Warning: Failed to create backup for {parquet_file} at {backup_path}: {str(e)}")
-            errors_encountered.append(str(e))
-    
-    # Read input data
-    if is_excel:
-        temp_csv = excel_to_csv(input_path, sheet_name=sheet_name, start_row=start_row)
-        new_df_lazy = pl.scan_csv(temp_csv, schema_overrides=dtype_dict, ignore_errors=True)
-    else:
-        new_df_lazy = pl.scan_csv(input_path, schema_overrides=dtype_dict, ignore_errors=True)
-    
-    # Special handling for online_website_anaylsis
-    if os.path.basename(parquet_file) == "online_website_anaylsis.parquet":
-        # Rename column to match existing Parquet
-        new_df_lazy = new_df_lazy.rename({"online product interaction conversion rate ": "online product interaction conversion rate"})
-        new_df_lazy = new_df_lazy.with_columns([
-            pl.col("online product interaction conversion rate").cast(pl.Float32),
-            (pl.col("online pip visits +") * pl.col("online pip conversion rate +")).cast(pl.Float32).alias("order count TY"),
-            (pl.col("online pip visits ly +") * pl.col("online pip conversion rate ly +")).cast(pl.Float32).alias("order count LY")
-        ])
-        new_df = new_df_lazy.collect()
-        print(f"Processed online_website_anaylsis with {new_df.height} rows, added order count TY and LY")
-        with open(log_file, 'a') as log:
-            log.write(f"Processed online_website_anaylsis with {new_df.height} rows, added order count TY and LY at {datetime.now().strftime('%H:%M:%S %Z on %m/%d/%Y')}\n")
-    
-    # Special handling for online_classification
-    elif os.path.basename(parquet_file) == "online_classification.parquet":
-        new_df_lazy = new_df_lazy.with_columns(pl.col("online upc +").cast(pl.Utf8))
-        new_df_lazy = new_df_lazy.filter(pl.col("online upc +").str.len_chars() == 12)
-        new_df_lazy = new_df_lazy.group_by("oms id +").agg(pl.all().first())
-        new_df = new_df_lazy.collect()
-        unique_oms_id_count = new_df["oms id +"].n_unique()
-        print(f"Processed online_classification with {new_df.height} rows, unique oms id + count: {unique_oms_id_count}")
-        with open(log_file, 'a') as log:
-            log.write(f"Processed online_classification with {new_df.height} rows, unique oms id + count: {unique_oms_id_count} at {datetime.now().strftime('%H:%M:%S %Z on %m/%d/%Y')}\n")
-    
-    # Group by UPC for FG Status Report to have one row per UPC
-    elif "FG Status Report" in os.path.basename(input_path):
-        new_df_lazy = new_df_lazy.with_columns(pl.concat_str([pl.col("Basic"), pl.lit("-"), pl.col("Dash")]).alias("Basic-Dash"))
-        new_df_lazy = new_df_lazy.group_by("UPC").agg(pl.all().first())
-        new_df = new_df_lazy.collect()
-        unique_upc_count = new_df["UPC"].n_unique()
-        print(f"Processed FG Status Report with {new_df.height} rows (grouped by UPC, unique UPC count: {unique_upc_count})")
-        with open(log_file, 'a') as log:
-            log.write(f"Processed FG Status Report with {new_df.height} rows (grouped by UPC, unique UPC count: {unique_upc_count}) at {datetime.now().strftime('%H:%M:%S %Z on %m/%d/%Y')}\n")
-        if unique_upc_count != new_df.height or new_df.height < 15000 or new_df.height > 20000:
-            print(f"Warning: Expected ~17822 rows for FG Status Report, got {new_df.height}")
-            with open(log_file, 'a') as log:
-                log.write(f"Warning: Expected ~17822 rows for FG Status Report, got {new_df.height} at {datetime.now().strftime('%H:%M:%S %Z on %m/%d/%Y')}\n")
-    else:
-        new_df = new_df_lazy.collect()
-    
-    new_row_count = new_df.height
+    # Make sure the pre-change state is recoverable; later versions are recorded on commit
+    ensure_baseline_snapshot(parquet_file)
     
-    # Convert existing Parquet file schema for online_sales.parquet if necessary
-    if os.path.basename(parquet_file) == "online_sales.parquet" and os.path.exists(parquet_file):
-        existing_df_lazy = pl.scan_parquet(parquet_file)
-        existing_schema = existing_df_lazy.collect_schema()
-        if existing_schema.get("online return units +") == pl.Int32:
-            print(f"Converting 'online return units +' to Float32 in {parquet_file}")
-            temp_parquet = os.path.join(DATA_TABLES_DIR, f"temp_convert_{os.path.basename(parquet_file)}")
-            existing_df_lazy.with_columns(
-                pl.col("online return units +").cast(pl.Float32)
-            ).sink_parquet(temp_parquet, compression="snappy")
-            os.replace(temp_parquet, parquet_file)
+    # Tables without keys are overwritten, so in a batch only the latest file matters
+    input_paths = [input_path] if isinstance(input_path, str) else list(input_path)
+    superseded = input_paths[:-1] if not search_columns else []
+    input_paths = input_paths[len(superseded):]
+    source_names = ", ".join(os.path.basename(path) for path in input_paths)
     
-    # Get search conditions from input file or use external conditions
-    search_conditions = external_search_conditions if external_search_conditions else get_search_values(new_df_lazy, search_columns)
+    # Large partitioned inputs go through the chunked path when they would not fit the memory budget
+    # (in-memory sources are already resident, so they never are)
+    in_memory = any(path in memory_sources for path in input_paths)
+    batch_rows = chunk_batch_rows(input_paths, memory_budget) if options.get("partition_by") == "fiscal_week" and search_columns and not is_excel and not in_memory else None
+    if batch_rows:
+        return process_parquet_chunked(input_paths, parquet_file, dtype_dict, search_columns, external_search_conditions, options, batch_rows)
     
-    rows_removed = 0
-    final_row_count = new_row_count
-    if search_columns and search_conditions and os.path.exists(parquet_file):
-        existing_df_lazy = pl.scan_parquet(parquet_file)
-        existing_row_count = existing_df_lazy.select(pl.len()).collect().item()
+    # Read input data, applying the config's column spec while parsing; batch files form one lazy source
+    prune_stats = {}
+    with telemetry_span("read", table=table_name(parquet_file), files=len(input_paths)) as span:
+        read_start = time.perf_counter()
+        new_df_lazy = read_sources(input_paths, parquet_file, dtype_dict, is_excel, sheet_name, start_row, options, prune_stats)
+        # Common subplan elimination does not merge Python-side Excel scans; the cache lets the rows and the
+        # expectation aggregates share one pass over the sheet
+        if is_excel:
+            new_df_lazy = new_df_lazy.cache()
+        source_lazy = new_df_lazy
         
-        # Validate search conditions
-        for col in search_conditions.keys():
-            if col not in search_columns:
-                raise ValueError(f"Invalid search column '{col}' for {parquet_file}. Allowed: {search_columns}")
+        # Special handling for online_classification
+        if os.path.basename(parquet_file) == "online_classification.parquet":
+            new_df_lazy = new_df_lazy.with_columns(pl.col("online upc +").cast(pl.Utf8))
+            new_df_lazy = new_df_lazy.filter(pl.col("online upc +").str.len_chars() == 12)
+            new_df_lazy = new_df_lazy.sort(BATCH_SOURCE_COLUMN, descending=True, maintain_order=True)
+            new_df_lazy = new_df_lazy.group_by("oms id +").agg(pl.all().first())
         
-        # Corrected filter: keep rows unless BOTH day and oms id + match
-        if "day" in search_conditions and "oms id +" in search_conditions:
-            day_values = search_conditions["day"]
-            if external_search_conditions and isinstance(day_values[0], str):
-                day_values = [pd.to_datetime(val) for val in day_values]
-            filter_expr = ~(pl.col("day").is_in(day_values) & pl.col("oms id +").is_in(search_conditions["oms id +"]))
-        else:
-            filter_expr = pl.lit(True)
+        # Group by UPC for FG Status Report to have one row per UPC
+        elif "FG Status Report" in os.path.basename(input_paths[-1]):
+            new_df_lazy = new_df_lazy.with_columns(pl.concat_str([pl.col("Basic"), pl.lit("-"), pl.col("Dash")]).alias("Basic-Dash"))
+            new_df_lazy = new_df_lazy.sort(BATCH_SOURCE_COLUMN, descending=True, maintain_order=True)
+            new_df_lazy = new_df_lazy.group_by("UPC").agg(pl.all().first())
         
-        filtered_df_lazy = existing_df_lazy.filter(filter_expr)
-        filtered_row_count = filtered_df_lazy.select(pl.len()).collect().item()
-        rows_removed = existing_row_count - filtered_row_count
+        # The expectations aggregate in the same collect, over the same single read of the sources
+        measured_lazy = expectation_frame(restore_unknown_weeks(source_lazy), restore_unknown_weeks(new_df_lazy), options.get("expectations"))
+        if measured_lazy is not None:
+            new_df, measured = pl.collect_all([new_df_lazy, measured_lazy])
+        else:
+            new_df, measured = new_df_lazy.collect(), None
+        if os.path.basename(parquet_file) == "online_classification.parquet":
+            print(f"Processed online_classification with {new_df.height} rows (one per oms id +)")
+            with open(log_file, 'a') as log:
+                log.write(f"Processed online_classification with {new_df.height} rows at {datetime.now().strftime('%H:%M:%S %Z on %m/%d/%Y')}\n")
+        elif "FG Status Report" in os.path.basename(input_paths[-1]):
+            print(f"Processed FG Status Report with {new_df.height} rows (grouped by UPC)")
+            with open(log_file, 'a') as log:
+                log.write(f"Processed FG Status Report with {new_df.height} rows (grouped by UPC) at {datetime.now().strftime('%H:%M:%S %Z on %m/%d/%Y')}\n")
+        rejected = {}
+        new_df = split_rejects(split_unknown_weeks(new_df, input_paths), rejected)
+        span["rows_out"] = new_df.height
+    expectation_results = check_expectations(measured, options.get("expectations"), input_paths, parquet_file)
+    reject_counts = report_rejects(rejected, input_paths, parquet_file, dtype_dict)
+    
+    with telemetry_span("transform", table=table_name(parquet_file)) as span:
+        span["rows_in"] = new_df.height
+        # Overlapping keys inside a batch: each key keeps only the rows from the latest file that has it
+        rows_read = new_df.group_by(BATCH_SOURCE_COLUMN).len()
+        if len(input_paths) > 1 and search_columns:
+            latest = new_df.group_by(search_columns).agg(pl.col(BATCH_SOURCE_COLUMN).max())
+            new_df = new_df.join(latest, on=search_columns + [BATCH_SOURCE_COLUMN], how="semi", nulls_equal=True)
+        rows_kept = new_df.group_by(BATCH_SOURCE_COLUMN).len()
+        file_rows = [{"file": path, "rows_read": None, "rows_kept": 0, "superseded": True} for path in superseded]
+        for source_index, path in enumerate(input_paths):
+            read = rows_read.filter(pl.col(BATCH_SOURCE_COLUMN) == source_index)["len"]
+            kept = rows_kept.filter(pl.col(BATCH_SOURCE_COLUMN) == source_index)["len"]
+            file_rows.append({
+                "file": path,
+                "rows_read": read.item() if read.len() else 0,
+                "rows_kept": kept.item() if kept.len() else 0,
+                "superseded": False,
+                "values_rejected": reject_counts.get(source_index, 0),
+                "expectations": expectation_results.get(source_index, []),
+            })
+        # Partitioned upserts keep the source column for per-file change counts and drop it on write
+        if options.get("partition_by") != "fiscal_week":
+            new_df = new_df.drop(BATCH_SOURCE_COLUMN)
         
-        # Collect new data and validate schema
-        if new_df.schema != existing_df_lazy.collect_schema():
-            print(f"Schema mismatch detected for {parquet_file}. Attempting to cast to match existing schema.")
-            new_df = new_df.with_columns([
-                pl.col(col).cast(dtype) for col, dtype in existing_df_lazy.collect_schema().items()
-                if col in new_df.columns
-            ])
+        new_row_count = new_df.height
+        pruning = prune_report(prune_stats, time.perf_counter() - read_start)
+        if pruning:
+            print(f"Pruned {pruning['columns_pruned']}/{pruning['columns_total']} columns from {source_names} "
+                  f"(est. {pruning['bytes_saved'] / 1024:.1f} KB and {pruning['time_saved']:.2f} s saved)")
         
-        # Combine filtered existing data with new data
-        combined_df_lazy = pl.concat([filtered_df_lazy, new_df.lazy()], how="vertical_relaxed")
-        temp_parquet = os.path.join(DATA_TABLES_DIR, f"temp_{os.path.basename(parquet_file)}")
-        combined_df_lazy.sink_parquet(temp_parquet, compression="snappy")
-        os.replace(temp_parquet, parquet_file)
-        final_row_count = filtered_row_count + new_row_count
+        # Upsert keys: exact composite keys of the input, or the external search conditions
+        keys = None
+        if search_columns:
+            if external_search_conditions:
+                keys = keys_from_search_conditions(external_search_conditions, search_columns, parquet_file)
+            else:
+                keys = get_upsert_keys(new_df, search_columns)
+        search_conditions = {col: keys[col].unique().head(6).to_list() for col in keys.columns} if keys is not None and keys.height else {}
+        span["rows_out"] = new_row_count
+    
+    rows_removed = 0
+    rows_added = new_row_count
+    final_row_count = new_row_count
+    upsert_key_count = keys.height if keys is not None else 0
+    changed = True
+    if options.get("partition_by") == "fiscal_week":
+        # Partitioned tables: only the fiscal weeks touched by the input are rewritten
+        dataset = dataset_dir(parquet_file)
+        migrate_to_partitions(parquet_file, dataset, dtype_dict, options)
+        upsert = upsert_partitions(new_df, dataset, search_columns, keys if external_search_conditions else None, options, [os.path.basename(path) for path in input_paths])
+        add_change_counts(file_rows, upsert["change_counts"])
+        rows_removed = upsert["rows_removed"]
+        rows_added = upsert["rows_added"]
+        final_row_count = upsert["final_row_count"]
+        changed = upsert["partitions_written"] > 0
+        if not external_search_conditions:
+            upsert_key_count = upsert["upsert_keys"]
+    elif search_conditions and os.path.exists(parquet_file):
+        # One pass over the table: the anti-join streams into the new file, the existing row count and schema
+        # come from the footer, and kept/removed counts follow from the new file's footer
+        with telemetry_span("write", table=table_name(parquet_file)) as span:
+            existing_df_lazy = apply_schema_rules(pl.scan_parquet(parquet_file), parquet_file, file_schema_version(parquet_file))
+            existing_schema = existing_df_lazy.collect_schema()
+            existing_row_count = pq.read_metadata(parquet_file).num_rows
+            if new_df.schema != existing_schema:
+                print(f"Schema mismatch detected for {parquet_file}. Attempting to cast to match existing schema.")
+                # Week labels kept as text do not fit an Enum week; the concat below relaxes both to text
+                new_df = new_df.with_columns([
+                    pl.col(col).cast(dtype) for col, dtype in existing_schema.items()
+                    if col in new_df.columns and not (isinstance(dtype, pl.Enum) and new_df.schema[col] == pl.Utf8)
+                ])
+            filtered_df_lazy = anti_join_keys(existing_df_lazy, keys, existing_schema)
+            combined_df_lazy = pl.concat([filtered_df_lazy, new_df.lazy()], how="vertical_relaxed")
+            temp_parquet = temp_table_path(f"temp_{os.path.basename(parquet_file)}")
+            write_table_file(combined_df_lazy, temp_parquet, parquet_file, options)
+            final_row_count = pq.read_metadata(temp_parquet).num_rows
+            publish_file(temp_parquet, parquet_file)
+            rows_removed = existing_row_count + new_row_count - final_row_count
+            span["rows_in"] = existing_row_count + new_row_count
+            span["rows_out"] = final_row_count
+            span["rows_removed"] = rows_removed
     else:
         # Overwrite mode for no search_columns, no search_conditions, or no existing file
-        new_df_lazy.sink_parquet(parquet_file, compression="snappy")
+        # (written to a temp file first: the live file's inode may be shared with a snapshot)
+        with telemetry_span("write", table=table_name(parquet_file)) as span:
+            temp_parquet = temp_table_path(f"temp_{os.path.basename(parquet_file)}")
+            write_table_file(new_df, temp_parquet, parquet_file, options)
+            publish_file(temp_parquet, parquet_file)
+            span["rows_out"] = new_row_count
     
-    # Clean up temporary CSV if created
-    if is_excel and 'temp_csv' in locals() and os.path.exists(temp_csv):
-        os.remove(temp_csv)
+    # Nothing rewritten (every incoming row unchanged): the latest snapshot already holds this state
+    if changed:
+        backup_path = commit_table(parquet_file, options, source_names, errors_encountered)
+    else:
+        backup_path = None
+        print(f"No rows of {table_name(parquet_file)} changed; snapshot skipped")
     
     memory_after = get_memory_usage()
     cpu_times_after = get_cpu_times()
@@ -498,21 +2296,241 @@ def process_parquet(
         "user_time": cpu_times_after.user - cpu_times_before.user,
         "system_time": cpu_times_after.system - cpu_times_before.system,
         "search_conditions": search_conditions,
+        "upsert_keys": upsert_key_count,
         "rows_removed": rows_removed,
-        "rows_added": new_row_count,
+        "rows_added": rows_added,
         "final_row_count": final_row_count,
         "backup_path": backup_path if backup_path else "No backup",
+        "pruning": pruning,
+        "file_rows": file_rows,
         "errors": errors_encountered
     }
 
-# Main processing
-def main(external_search_conditions: Optional[Dict[str, list]] = None):
-    start_time = time.time()
-    summary = []
-    
-    for i, (prefix, dtype_dict, parquet_name, is_excel, search_columns, sheet_name, start_row) in enumerate(file_configs, 1):
-        print(f"[{i}/{len(file_configs)}] Processing files starting with: {prefix}")
-        file_paths = find_files(prefix, is_excel)
+# FG Status fields carried into merged_classification (joined on the first 11 digits of the online UPC)
+MERGED_FG_COLUMNS = ["UPC", "M P G", "MPG Name", "IPG", "IPG Name", "Prd Mgr", "Basic-Dash"]
+# Tables the FG merge reads, with the key each contributes; in parallel mode it runs as soon as both have committed
+MERGE_INPUTS = {"fg_status.parquet": "UPC", "online_classification.parquet": "oms id +"}
+# Parquet metadata key on merged_classification: size/mtime of the input files it was built from
+MERGE_STATE_KEY = "thd_merge_inputs"
+# merged_classification is not in file_configs; its storage settings live here
+MERGED_CLASSIFICATION_OPTIONS = {"storage_profile": "scan"}
+# Hardlinks of the inputs as of the last merge (live writes replace files, so these keep the old contents)
+MERGE_BASE_DIR = os.path.join(DATA_TABLES_DIR, '_merge_inputs')
+
+# Identity of a merge input file: its size and modification time
+def merge_input_state(path: str) -> Dict:
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+# Input states recorded in the merged file ({} for files written before incremental merging)
+def merged_input_states(merged_parquet: str) -> Dict[str, dict]:
+    if not os.path.exists(merged_parquet):
+        return {}
+    metadata = pq.read_metadata(merged_parquet).metadata or {}
+    return json.loads(metadata.get(MERGE_STATE_KEY.encode(), b"{}"))
+
+# A merge input as of the last merge (None when its base copy is missing or does not match the recorded state)
+def merge_input_base(parquet_name: str, state: Optional[Dict]) -> Optional[pl.LazyFrame]:
+    path = os.path.join(MERGE_BASE_DIR, parquet_name)
+    if not state or not os.path.exists(path) or merge_input_state(path) != state:
+        return None
+    return scan_table_path(path, parquet_name)
+
+# Keep the inputs a merge was built from, for the next run to diff against
+def save_merge_inputs() -> None:
+    for name in MERGE_INPUTS:
+        live_path = os.path.join(DATA_TABLES_DIR, name)
+        base_path = os.path.join(MERGE_BASE_DIR, name)
+        if os.path.exists(base_path) and os.path.samefile(live_path, base_path):
+            continue
+        if os.path.exists(base_path + '.tmp'):
+            os.remove(base_path + '.tmp')
+        link_or_copy(live_path, base_path + '.tmp')
+        os.replace(base_path + '.tmp', base_path)
+
+# The merge's view of each input: classification with its UPC11 join key, FG Status reduced to the merged fields
+def merge_input_frame(frame: pl.LazyFrame, parquet_name: str) -> pl.LazyFrame:
+    if parquet_name == "fg_status.parquet":
+        return frame.select(MERGED_FG_COLUMNS).with_columns(pl.col("UPC").cast(pl.Utf8))
+    return frame.with_columns(pl.col("online upc +").str.slice(0, 11).cast(pl.Utf8).alias("UPC11"))
+
+# Keys whose rows were added, removed or modified between two versions of an input (None if the schema changed)
+def changed_keys(previous: pl.LazyFrame, current: pl.LazyFrame, key: str) -> Optional[pl.Series]:
+    schema = current.collect_schema()
+    if previous.collect_schema() != schema:
+        return None
+    columns = schema.names()
+    added = current.join(previous, on=columns, how="anti", nulls_equal=True).select(key)
+    removed = previous.join(current, on=columns, how="anti", nulls_equal=True).select(key)
+    return pl.concat([added, removed]).unique().collect()[key]
+
+# Join classification rows to their FG Status fields, one row per oms id +
+def merge_rows(classification_lazy: pl.LazyFrame, fg_lazy: pl.LazyFrame) -> pl.DataFrame:
+    merged_df = classification_lazy.join(
+        fg_lazy,
+        left_on="UPC11",
+        right_on="UPC",
+        how="left"
+    ).drop("UPC11").collect()
+    # Ensure 1 row per oms id +
+    duplicate_check = merged_df.group_by("oms id +").agg(pl.len().alias("count")).filter(pl.col("count") > 1)
+    if duplicate_check.height > 0:
+        print(f"Warning: {duplicate_check.height} duplicate oms id + found. Deduplicating by taking first values.")
+        with open(log_file, 'a') as log:
+            log.write(f"Warning: {duplicate_check.height} duplicate oms id + found at {datetime.now().strftime('%H:%M:%S %Z on %m/%d/%Y')}\n")
+        merged_df = merged_df.group_by("oms id +", maintain_order=True).agg(pl.all().first())
+    else:
+        print("Success: One row per unique oms id + in merged rows")
+        with open(log_file, 'a') as log:
+            log.write(f"Success: One row per unique oms id + in merged rows at {datetime.now().strftime('%H:%M:%S %Z on %m/%d/%Y')}\n")
+    return merged_df
+
+# Merge FG Status fields into online_classification as merged_classification.parquet. Maintained
+# incrementally: skipped when neither input changed since the last merge, otherwise only the OMS IDs
+# whose classification row changed or whose UPC's FG Status fields changed are recomputed and upserted.
+# Falls back to a full rebuild when the previous inputs are unavailable or a schema changed.
+def merge_fg_classification(full: bool = False) -> None:
+    with telemetry_span("merge", table="merged_classification", full=full) as span:
+        fg_parquet = os.path.join(DATA_TABLES_DIR, "fg_status.parquet")
+        classification_parquet = os.path.join(DATA_TABLES_DIR, "online_classification.parquet")
+        merged_parquet = os.path.join(DATA_TABLES_DIR, "merged_classification.parquet")
+        if os.path.exists(fg_parquet) and os.path.exists(classification_parquet):
+            if "online upc +" in read_table(classification_parquet).collect_schema():
+                states = {name: merge_input_state(os.path.join(DATA_TABLES_DIR, name)) for name in MERGE_INPUTS}
+                previous_states = merged_input_states(merged_parquet)
+                unchanged = {name for name, state in states.items() if previous_states.get(name) == state}
+                if not full and len(unchanged) == len(MERGE_INPUTS):
+                    print(f"Skipping merge as fg_status and online_classification are unchanged since {merged_parquet} was built")
+                    with open(log_file, 'a') as log:
+                        log.write(f"Skipping merge as inputs are unchanged at {datetime.now().strftime('%H:%M:%S %Z on %m/%d/%Y')}\n")
+                    return
+                inputs = {name: merge_input_frame(read_table(name), name) for name in MERGE_INPUTS}
+                classification_lazy = inputs["online_classification.parquet"]
+                fg_lazy = inputs["fg_status.parquet"]
+                
+                # Changed keys per input: none when unchanged, a diff against its copy from the last merge otherwise
+                changed = {}
+                if not full and previous_states:
+                    for name, key in MERGE_INPUTS.items():
+                        if name in unchanged:
+                            changed[name] = pl.Series(key, [], dtype=inputs[name].collect_schema()[key])
+                            continue
+                        previous = merge_input_base(name, previous_states.get(name))
+                        if previous is not None:
+                            changed[name] = changed_keys(merge_input_frame(previous, name), inputs[name], key)
+                
+                merged_df = None
+                if len(changed) == len(MERGE_INPUTS) and all(keys is not None for keys in changed.values()):
+                    existing = pl.scan_parquet(merged_parquet)
+                    changed_upcs = changed["fg_status.parquet"]
+                    oms_dtype = classification_lazy.collect_schema()["oms id +"]
+                    affected = pl.concat([
+                        changed["online_classification.parquet"].cast(oms_dtype).to_frame("oms id +").lazy(),
+                        classification_lazy.filter(pl.col("UPC11").is_in(changed_upcs.implode())).select("oms id +"),
+                        existing.filter(pl.col("online upc +").str.slice(0, 11).is_in(changed_upcs.implode())).select(pl.col("oms id +").cast(oms_dtype)),
+                    ]).unique().collect()["oms id +"]
+                    recomputed = merge_rows(classification_lazy.filter(pl.col("oms id +").is_in(affected.implode())), fg_lazy)
+                    if existing.collect_schema() == recomputed.schema:
+                        kept = existing.filter(~pl.col("oms id +").is_in(affected.implode())).collect()
+                        merged_df = pl.concat([kept, recomputed])
+                        print(f"Incremental merge: {changed['online_classification.parquet'].len()} changed oms id +, "
+                              f"{changed_upcs.len()} changed FG UPCs, {affected.len()} merged rows recomputed")
+                        with open(log_file, 'a') as log:
+                            log.write(f"Incremental merge recomputed {affected.len()} rows of {merged_parquet} at {datetime.now().strftime('%H:%M:%S %Z on %m/%d/%Y')}\n")
+                if merged_df is None:
+                    print("Full merge: rebuilding merged_classification from fg_status and online_classification")
+                    affected = None
+                    merged_df = merge_rows(classification_lazy, fg_lazy)
+                span["rows_in"] = merged_df.height if affected is None else affected.len()
+                span["rows_out"] = merged_df.height
+                
+                temp_parquet = temp_table_path("temp_merged_classification.parquet")
+                write_table_file(merged_df, temp_parquet, merged_parquet, MERGED_CLASSIFICATION_OPTIONS, metadata={MERGE_STATE_KEY: json.dumps(states)})
+                publish_file(temp_parquet, merged_parquet)
+                save_merge_inputs()
+                # Nothing to snapshot when only the recorded input states moved
+                if affected is None or affected.len():
+                    snapshot_table(merged_parquet, source="fg_status + online_classification")
+                print(f"Merged FG Status Report into online_classification.parquet and saved as {merged_parquet}")
+                print(f"Final merged row count: {merged_df.height}, Unique oms id + count: {merged_df['oms id +'].n_unique()}")
+                print(f"Merged fields from FG Status: M P G, MPG Name, IPG, IPG Name, Prd Mgr, Basic-Dash")
+                with open(log_file, 'a') as log:
+                    log.write(f"Merged FG Status Report into {merged_parquet} with {merged_df.height} rows, unique oms id + count: {merged_df['oms id +'].n_unique()} at {datetime.now().strftime('%H:%M:%S %Z on %m/%d/%Y')}\n")
+                    log.write(f"Merged fields from FG Status: M P G, MPG Name, IPG, IPG Name, Prd Mgr, Basic-Dash\n")
+            else:
+                print("Skipping merge as 'online upc +' not found in online_classification.parquet")
+                with open(log_file, 'a') as log:
+                    log.write(f"Skipping merge as 'online upc +' not found in online_classification.parquet at {datetime.now().strftime('%H:%M:%S %Z on %m/%d/%Y')}\n")
+        else:
+            if not os.path.exists(classification_parquet):
+                print(f"Skipping merge as {classification_parquet} does not exist")
+                with open(log_file, 'a') as log:
+                    log.write(f"Skipping merge as {classification_parquet} does not exist at {datetime.now().strftime('%H:%M:%S %Z on %m/%d/%Y')}\n")
+            if not os.path.exists(fg_parquet):
+                print(f"Skipping merge as {fg_parquet} does not exist")
+                with open(log_file, 'a') as log:
+                    log.write(f"Skipping merge as {fg_parquet} does not exist at {datetime.now().strftime('%H:%M:%S %Z on %m/%d/%Y')}\n")
+
+# Per-target write lock so two processes never write the same table at once
+def acquire_table_lock(parquet_name: str, timeout: float = 3600.0, poll: float = 0.5) -> str:
+    lock_path = os.path.join(DATA_TABLES_DIR, f".{parquet_name}.lock")
+    deadline = time.time() + timeout
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            with os.fdopen(fd, 'w') as f:
+                f.write(str(os.getpid()))
+            return lock_path
+        except FileExistsError:
+            # Clear locks left behind by a crashed run
+            try:
+                with open(lock_path, 'r') as f:
+                    owner = int(f.read().strip() or 0)
+                if owner and not psutil.pid_exists(owner):
+                    os.remove(lock_path)
+                    continue
+            except (OSError, ValueError):
+                pass
+            if time.time() > deadline:
+                raise TimeoutError(f"Timed out waiting for lock on {parquet_name} ({lock_path})")
+            time.sleep(poll)
+
+def release_table_lock(lock_path: str) -> None:
+    if os.path.exists(lock_path):
+        os.remove(lock_path)
+
+# Ingest every pending source file for one file_configs entry (or only the given paths); returns summary
+# items and manifest updates
+def ingest_target(
+    config_index: int,
+    external_search_conditions: Optional[Dict[str, list]] = None,
+    force: bool = False,
+    manifest: Optional[Dict[str, dict]] = None,
+    batch: bool = True,
+    memory_budget: Optional[float] = None,
+    paths: Optional[List[str]] = None
+) -> tuple:
+    prefix, dtype_dict, parquet_name, is_excel, search_columns, sheet_name, start_row, options = file_configs[config_index]
+    with telemetry_span("ingest", table=table_name(parquet_name)) as ingest_span:
+        manifest = load_ingest_manifest() if manifest is None else manifest
+        summary = []
+        manifest_updates = {}
+        print(f"[{config_index + 1}/{len(file_configs)}] Processing files starting with: {prefix}")
+        parquet_file = os.path.join(DATA_TABLES_DIR, parquet_name)
+        pending = []
+        with telemetry_span("discover", table=table_name(parquet_name)) as span:
+            file_paths = find_files(prefix, is_excel) if paths is None else paths
+            for j, file_path in enumerate(file_paths, 1):
+                if not force and is_already_ingested(manifest, file_path, parquet_name):
+                    entry = manifest[os.path.basename(file_path)]
+                    print(f"Skipping file {j}/{len(file_paths)}: {file_path} (already ingested on {entry['committed_at']}, unchanged)")
+                    summary.append({"file": file_path, "parquet_file": parquet_name, "skipped": entry})
+                    manifest_updates[os.path.basename(file_path)] = entry
+                else:
+                    pending.append(file_path)
+            span["rows_in"] = len(file_paths)
+            span["rows_out"] = len(pending)
+        ingest_span["files"] = len(pending)
         if not file_paths and parquet_name != "online_classification.parquet":
             print(f"No {'Excel' if is_excel else 'CSV'} files found starting with {prefix}")
             summary.append({
@@ -522,92 +2540,411 @@ def main(external_search_conditions: Optional[Dict[str, list]] = None):
                 "user_time": 0.0,
                 "system_time": 0.0,
                 "search_conditions": {},
+                "upsert_keys": 0,
                 "rows_removed": 0,
                 "rows_added": 0,
                 "final_row_count": 0,
                 "backup_path": "No backup",
+                "pruning": {},
+                "file_rows": [],
                 "errors": [f"No {'Excel' if is_excel else 'CSV'} files found starting with {prefix}"]
             })
-            continue
+            return summary, manifest_updates
+        if not pending:
+            return summary, manifest_updates
         
-        parquet_file = os.path.join(DATA_TABLES_DIR, parquet_name)
-        if file_paths:
-            for j, file_path in enumerate(file_paths, 1):
-                print(f"Processing file {j}/{len(file_paths)}: {file_path}")
-                usage = process_parquet(file_path, parquet_file, dtype_dict, is_excel, search_columns, external_search_conditions, sheet_name, start_row)
+        # Batched: all pending files are committed together (one upsert, one snapshot); otherwise one commit per file
+        batches = [pending] if batch else [[file_path] for file_path in pending]
+        lock_path = acquire_table_lock(parquet_name)
+        try:
+            for j, batch_paths in enumerate(batches, 1):
+                print(f"Processing {'batch' if len(batch_paths) > 1 else 'file'} {j}/{len(batches)}: {', '.join(batch_paths)}")
+                usage = process_parquet(batch_paths, parquet_file, dtype_dict, is_excel, search_columns, external_search_conditions, sheet_name, start_row, options, memory_budget)
                 
                 summary.append({
-                    "file": file_path,
+                    "file": "; ".join(batch_paths),
                     "parquet_file": parquet_name,
                     "memory_used": usage["memory_used"],
                     "user_time": usage["user_time"],
                     "system_time": usage["system_time"],
                     "search_conditions": usage["search_conditions"],
+                    "upsert_keys": usage["upsert_keys"],
                     "rows_removed": usage["rows_removed"],
                     "rows_added": usage["rows_added"],
                     "final_row_count": usage["final_row_count"],
                     "backup_path": usage["backup_path"],
+                    "pruning": usage["pruning"],
+                    "file_rows": usage["file_rows"],
                     "errors": usage["errors"]
                 })
+                for file_row in usage["file_rows"]:
+                    record_ingest(manifest_updates, file_row["file"], parquet_name, dict(usage, rows_added=file_row["rows_kept"]))
+                ingest_span["rows_in"] = (ingest_span["rows_in"] or 0) + sum(file_row["rows_read"] or 0 for file_row in usage["file_rows"])
+                ingest_span["rows_out"] = (ingest_span["rows_out"] or 0) + usage["rows_added"]
                 
-                print(f"Finished processing {file_path} -> {parquet_name}")
+                print(f"Finished processing {', '.join(batch_paths)} -> {parquet_name}")
+        finally:
+            release_table_lock(lock_path)
+        return summary, manifest_updates
+
+# Ingest rows already in memory (a polars DataFrame or LazyFrame, or a pyarrow Table / RecordBatch) into a
+# file_configs table with the same typing, filtering, upsert, snapshot and merge as a source file. Arrow
+# data is wrapped without copying its buffers and nothing is written to disk before the table itself.
+# There is no source file, so the ingest manifest is not touched. Returns the run summary item.
+#   from online_data_upload import ingest
+#   ingest("online_sales", frame, source="sales API 2025-08-04")
+def ingest(table: str, data, external_search_conditions: Optional[Dict[str, list]] = None, source: str = "ingest()") -> Dict:
+    matches = [config for config in file_configs if table_name(config[2]) == table_name(table)]
+    if not matches:
+        raise ValueError(f"Unknown table {table} (file_configs tables: {', '.join(table_name(config[2]) for config in file_configs)})")
+    prefix, dtype_dict, parquet_name, is_excel, search_columns, sheet_name, start_row, options = matches[0]
+    if isinstance(data, pl.LazyFrame):
+        frame = data
+    elif isinstance(data, pl.DataFrame):
+        frame = data.lazy()
+    else:
+        frame = pl.from_arrow(data, rechunk=False).lazy()
+    # The label stands in for the file name, so it keeps the config prefix that file-specific handling matches on
+    label = f"{prefix} from {source}".replace(os.sep, "_")
+    parquet_file = os.path.join(DATA_TABLES_DIR, parquet_name)
+    telemetry_run_id()
+    with telemetry_span("ingest", table=table_name(parquet_name), files=1) as ingest_span:
+        print(f"Ingesting {source} into {parquet_name}")
+        memory_sources[label] = frame
+        lock_path = acquire_table_lock(parquet_name)
+        try:
+            usage = process_parquet([label], parquet_file, dtype_dict, False, search_columns, external_search_conditions, sheet_name, start_row, options)
+        finally:
+            release_table_lock(lock_path)
+            del memory_sources[label]
+        ingest_span["rows_in"] = sum(file_row["rows_read"] or 0 for file_row in usage["file_rows"])
+        ingest_span["rows_out"] = usage["rows_added"]
+        if parquet_name in MERGE_INPUTS:
+            merge_fg_classification()
+    print(f"Finished ingesting {source} -> {parquet_name}")
+    with open(log_file, 'a') as log:
+        log.write(f"Ingested {source} into {parquet_name} ({usage['rows_added']} rows added) at {datetime.now().strftime('%H:%M:%S %Z on %m/%d/%Y')}\n")
+    return {
+        "file": label,
+        "parquet_file": parquet_name,
+        "memory_used": usage["memory_used"],
+        "user_time": usage["user_time"],
+        "system_time": usage["system_time"],
+        "search_conditions": usage["search_conditions"],
+        "upsert_keys": usage["upsert_keys"],
+        "rows_removed": usage["rows_removed"],
+        "rows_added": usage["rows_added"],
+        "final_row_count": usage["final_row_count"],
+        "backup_path": usage["backup_path"],
+        "pruning": usage["pruning"],
+        "file_rows": usage["file_rows"],
+        "errors": usage["errors"]
+    }
+
+# Rough peak memory (MB) for ingesting a target's pending files, used to pack the worker pool
+def estimate_target_memory(config_index: int) -> float:
+    prefix, _, _, is_excel, _, _, _, _ = file_configs[config_index]
+    # Typed Arrow data runs ~2x the CSV text; xlsx is zip-compressed XML and expands ~10x
+    factor = 10.0 if is_excel else 2.0
+    return sum(source_bytes(path) for path in find_files(prefix, is_excel)) * factor / (1024 * 1024)
+
+# Run independent targets in a process pool, bounded by worker count and memory budget
+def ingest_parallel(
+    external_search_conditions: Optional[Dict[str, list]],
+    force: bool,
+    workers: int,
+    memory_budget: Optional[float],
+    batch: bool = True
+) -> tuple:
+    manifest = load_ingest_manifest()
+    summary = []
+    manifest_updates = {}
+    estimates = {k: estimate_target_memory(k) for k in range(len(file_configs))}
+    # Largest first so the run is bound by the biggest table, not the tail of the queue
+    queue = sorted(estimates, key=lambda k: estimates[k], reverse=True)
+    merge_pending = set(MERGE_INPUTS)
+    merged = False
     
-    # Post-processing for FG Status Report merge into a single file
-    fg_parquet = os.path.join(DATA_TABLES_DIR, "fg_status.parquet")
-    classification_parquet = os.path.join(DATA_TABLES_DIR, "online_classification.parquet")
-    merged_parquet = os.path.join(DATA_TABLES_DIR, "merged_classification.parquet")
-    if os.path.exists(fg_parquet) and os.path.exists(classification_parquet):
-        fg_df = pl.read_parquet(fg_parquet)
-        classification_df = pl.read_parquet(classification_parquet)
-        fg_df = fg_df.select(["UPC", "M P G", "MPG Name", "IPG", "IPG Name", "Prd Mgr", "Basic-Dash"]).with_columns(pl.col("UPC").cast(pl.Utf8))
-        if "online upc +" in classification_df.columns:
-            classification_df = classification_df.with_columns(pl.col("online upc +").str.slice(0, 11).cast(pl.Utf8).alias("UPC11"))
-            merged_df = classification_df.join(
-                fg_df,
-                left_on="UPC11",
-                right_on="UPC",
-                how="left"
-            ).drop("UPC11")
-            # Ensure 1 row per oms id +
-            duplicate_check = merged_df.group_by("oms id +").agg(pl.count().alias("count")).filter(pl.col("count") > 1)
-            if duplicate_check.height > 0:
-                print(f"Warning: {duplicate_check.height} duplicate oms id + found. Deduplicating by taking first values.")
-                with open(log_file, 'a') as log:
-                    log.write(f"Warning: {duplicate_check.height} duplicate oms id + found at {datetime.now().strftime('%H:%M:%S %Z on %m/%d/%Y')}\n")
-                merged_df = merged_df.group_by("oms id +").agg(pl.all().first())
-            else:
-                print("Success: One row per unique oms id + in merged file")
+    # Split the cores between workers so polars thread pools do not oversubscribe
+    os.environ.setdefault("POLARS_MAX_THREADS", str(max(1, (os.cpu_count() or 1) // workers)))
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        running = {}
+        while queue or running:
+            in_flight = sum(estimates[k] for k in running.values())
+            while queue and len(running) < workers:
+                k = queue[0]
+                if running and memory_budget and in_flight + estimates[k] > memory_budget:
+                    break
+                queue.pop(0)
+                running[pool.submit(ingest_target, k, external_search_conditions, force, manifest, batch, memory_budget)] = k
+                in_flight += estimates[k]
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                k = running.pop(future)
+                target_summary, target_manifest = future.result()
+                summary.extend(target_summary)
+                manifest_updates.update(target_manifest)
+                merge_pending.discard(file_configs[k][2])
+            if not merge_pending and not merged:
+                merge_fg_classification()
+                merged = True
+    if not merged:
+        merge_fg_classification()
+    return summary, manifest_updates
+
+# Main processing
+# Compact tables with files at older schema versions in a detached, low-priority process
+def start_background_compaction() -> Optional[int]:
+    if not any(stale_schema_files(table) for table in SCHEMA_REGISTRY):
+        return None
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Online Data Upload.py")
+    with open(log_file, 'a') as log:
+        compaction = subprocess.Popen([sys.executable, script, "--compact", "all"], cwd=os.getcwd(), stdout=subprocess.DEVNULL, stderr=log)
+    try:
+        psutil.Process(compaction.pid).nice(psutil.BELOW_NORMAL_PRIORITY_CLASS if os.name == "nt" else 10)
+    except (psutil.Error, AttributeError):
+        pass
+    print(f"Started background schema compaction (pid {compaction.pid})")
+    return compaction.pid
+
+# Watch mode: a long-running process ingests exports as they land in BASE_DIR, so new data is queryable
+# seconds after the file is saved instead of at the next manual run, and imports and polars' thread pool
+# stay warm between files. Linux uses inotify through libc; elsewhere (or with --poll, e.g. for a network
+# share whose remote writes inotify cannot see) the folder is polled. A file is ingested once its size and
+# mtime have been stable for the settle time, so half-copied exports are never read.
+WATCH_SETTLE_SECONDS = 5.0
+WATCH_POLL_SECONDS = 2.0
+# Full rescans between inotify events catch anything the event queue dropped
+WATCH_RESCAN_SECONDS = 60.0
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+INOTIFY_EVENT = struct.Struct("iIII")
+
+# file_configs entries a source file belongs to (same matching as find_files)
+def configs_for_file(path: str) -> List[int]:
+    name = os.path.basename(path)
+    return [
+        k for k, (prefix, _, _, is_excel, _, _, _, _) in enumerate(file_configs)
+        if name.lower().startswith(prefix.lower()) and name.endswith('.xlsx' if is_excel else CSV_EXTENSIONS)
+    ]
+
+# inotify descriptor watching a directory for written or renamed-in files, or None where unavailable
+def open_inotify(directory: str) -> Optional[int]:
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return None
+        if libc.inotify_add_watch(fd, os.fsencode(directory), IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+            os.close(fd)
+            return None
+        return fd
+    except (OSError, AttributeError):
+        return None
+
+# Names of files with inotify events, waiting up to timeout seconds for the first one
+def read_inotify(fd: int, timeout: float) -> set:
+    names = set()
+    ready, _, _ = select.select([fd], [], [], timeout)
+    if not ready:
+        return names
+    try:
+        data = os.read(fd, 64 * 1024)
+    except BlockingIOError:
+        return names
+    offset = 0
+    while offset + INOTIFY_EVENT.size <= len(data):
+        _, _, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+        name = data[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + length].rstrip(b"\0")
+        if name:
+            names.add(os.fsdecode(name))
+        offset += INOTIFY_EVENT.size + length
+    return names
+
+# Ingest the settled files: one batched commit per table, then the FG merge if one of its inputs changed
+def ingest_settled(ready: List[str], manifest: Dict[str, dict], memory_budget: Optional[float]) -> List[Dict]:
+    by_config = {}
+    for path in ready:
+        for k in configs_for_file(path):
+            by_config.setdefault(k, []).append(path)
+    summary = []
+    start_telemetry_run()
+    with telemetry_span("run", mode="watch", files=len(ready)) as run_span:
+        os.environ["THD_TELEMETRY_PARENT"] = run_span["span_id"]
+        for k, paths in sorted(by_config.items()):
+            target_summary, manifest_updates = ingest_target(k, None, False, manifest, True, memory_budget, sorted(paths))
+            summary.extend(target_summary)
+            manifest.update(manifest_updates)
+            save_ingest_manifest(manifest)
+        if any(file_configs[k][2] in MERGE_INPUTS for k in by_config) and any("skipped" not in item for item in summary):
+            merge_fg_classification()
+        run_span["rows_out"] = sum(item.get("rows_added", 0) for item in summary)
+    return summary
+
+# Run until interrupted, ingesting every export that settles in BASE_DIR (files pending at start included)
+def watch(
+    memory_budget: Optional[float] = None,
+    compact: bool = True,
+    settle: float = WATCH_SETTLE_SECONDS,
+    poll: float = WATCH_POLL_SECONDS,
+    force_poll: bool = False
+) -> None:
+    fd = None if force_poll else open_inotify(BASE_DIR)
+    mode = "inotify" if fd is not None else f"polling every {poll:g} s"
+    print(f"Watching {BASE_DIR} for exports ({mode}, {settle:g} s settle time); Ctrl+C to stop")
+    with open(log_file, 'a') as log:
+        log.write(f"Watch mode started on {BASE_DIR} ({mode}) at {datetime.now().strftime('%H:%M:%S %Z on %m/%d/%Y')}\n")
+    manifest = load_ingest_manifest()
+    # path -> (size, mtime_ns) last handled, and path -> (size, mtime_ns, monotonic time it was first seen that way)
+    handled = {}
+    pending = {}
+    compaction_pid = None
+    last_scan = None
+    try:
+        while True:
+            changed = set()
+            if fd is None or last_scan is None or time.monotonic() - last_scan >= WATCH_RESCAN_SECONDS:
+                changed.update(os.path.join(BASE_DIR, name) for name in os.listdir(BASE_DIR))
+                last_scan = time.monotonic()
+            if fd is not None:
+                changed.update(os.path.join(BASE_DIR, name) for name in read_inotify(fd, min(1.0, settle) if pending else WATCH_RESCAN_SECONDS))
+
+            now = time.monotonic()
+            for path in changed:
+                if not configs_for_file(path):
+                    continue
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    pending.pop(path, None)
+                    continue
+                signature = (stat.st_size, stat.st_mtime_ns)
+                if handled.get(path) == signature:
+                    continue
+                if path not in pending and all(is_already_ingested(manifest, path, file_configs[k][2]) for k in configs_for_file(path)):
+                    handled[path] = signature
+                    continue
+                if pending.get(path, (None, None))[:2] != signature:
+                    pending[path] = signature + (now,)
+
+            # Settled: unchanged for the settle time (a copy still in progress keeps moving size or mtime)
+            ready = []
+            for path, (size, mtime_ns, since) in list(pending.items()):
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    del pending[path]
+                    continue
+                if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                    pending[path] = (stat.st_size, stat.st_mtime_ns, now)
+                elif now - since >= settle:
+                    ready.append(path)
+            if not ready:
+                if fd is None:
+                    time.sleep(min(poll, settle) if pending else poll)
+                continue
+
+            for path in ready:
+                handled[path] = pending.pop(path)[:2]
+            try:
+                for item in ingest_settled(ready, manifest, memory_budget):
+                    if item.get("skipped"):
+                        continue
+                    latency = max(time.time() - max(os.path.getmtime(path) for path in item["file"].split("; ")), 0.0)
+                    print(f"Committed {item['file']} -> {item['parquet_file']}: {item['rows_added']} rows added, "
+                          f"{item['final_row_count']} rows in table, queryable {latency:.1f} s after the file landed")
+                    with open(log_file, 'a') as log:
+                        log.write(f"Watch mode committed {item['file']} -> {item['parquet_file']} ({item['rows_added']} rows, "
+                                  f"{latency:.1f} s after landing) at {datetime.now().strftime('%H:%M:%S %Z on %m/%d/%Y')}\n")
+            except Exception as e:
+                # A bad export must not stop the daemon; it is retried once the file changes again
+                print(f"Error ingesting {', '.join(ready)}: {str(e)}")
                 with open(log_file, 'a') as log:
-                    log.write(f"Success: One row per unique oms id + in merged file at {datetime.now().strftime('%H:%M:%S %Z on %m/%d/%Y')}\n")
-            merged_df.write_parquet(merged_parquet)
-            print(f"Merged FG Status Report into online_classification.parquet and saved as {merged_parquet}")
-            print(f"Final merged row count: {merged_df.height}, Unique oms id + count: {merged_df['oms id +'].n_unique()}")
-            print(f"Merged fields from FG Status: M P G, MPG Name, IPG, IPG Name, Prd Mgr, Basic-Dash")
-            with open(log_file, 'a') as log:
-                log.write(f"Merged FG Status Report into {merged_parquet} with {merged_df.height} rows, unique oms id + count: {merged_df['oms id +'].n_unique()} at {datetime.now().strftime('%H:%M:%S %Z on %m/%d/%Y')}\n")
-                log.write(f"Merged fields from FG Status: M P G, MPG Name, IPG, IPG Name, Prd Mgr, Basic-Dash\n")
+                    log.write(f"Watch mode error ingesting {', '.join(ready)}: {str(e)} at {datetime.now().strftime('%H:%M:%S %Z on %m/%d/%Y')}\n")
+                manifest = load_ingest_manifest()
+
+            compacting = False
+            if compaction_pid:
+                try:
+                    compacting = psutil.Process(compaction_pid).status() != psutil.STATUS_ZOMBIE
+                except psutil.NoSuchProcess:
+                    pass
+            if compact and not compacting:
+                compaction_pid = start_background_compaction()
+    except KeyboardInterrupt:
+        print("Watch mode stopped")
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+def main(
+    external_search_conditions: Optional[Dict[str, list]] = None,
+    force: bool = False,
+    workers: int = 1,
+    memory_budget: Optional[float] = None,
+    compact: bool = True,
+    batch: bool = True
+):
+    start_time = time.time()
+    summary = []
+    start_telemetry_run()
+    with telemetry_span("run", workers=workers, batch=batch, force=force, staging=bool(STAGING_DIR)) as run_span:
+        os.environ["THD_TELEMETRY_PARENT"] = run_span["span_id"]
+        if STAGING_DIR:
+            print(f"Staging table writes in {STAGING_DIR}")
+        manifest = load_ingest_manifest()
+        legacy = legacy_backups()
+        if legacy:
+            print(f"Found {len(legacy)} legacy full-copy backups in {PARQUET_VERSIONS_DIR}, left as they are; "
+                  f"--import_legacy_backups moves them into the snapshot layout (preview with --dry_run)")
+        
+        if workers > 1:
+            summary, manifest_updates = ingest_parallel(external_search_conditions, force, workers, memory_budget, batch)
+            manifest.update(manifest_updates)
+            save_ingest_manifest(manifest)
         else:
-            print("Skipping merge as 'online upc +' not found in online_classification.parquet")
-            with open(log_file, 'a') as log:
-                log.write(f"Skipping merge as 'online upc +' not found in online_classification.parquet at {datetime.now().strftime('%H:%M:%S %Z on %m/%d/%Y')}\n")
-    else:
-        if not os.path.exists(classification_parquet):
-            print(f"Skipping merge as {classification_parquet} does not exist")
-            with open(log_file, 'a') as log:
-                log.write(f"Skipping merge as {classification_parquet} does not exist at {datetime.now().strftime('%H:%M:%S %Z on %m/%d/%Y')}\n")
-        if not os.path.exists(fg_parquet):
-            print(f"Skipping merge as {fg_parquet} does not exist")
-            with open(log_file, 'a') as log:
-                log.write(f"Skipping merge as {fg_parquet} does not exist at {datetime.now().strftime('%H:%M:%S %Z on %m/%d/%Y')}\n")
+            for k in range(len(file_configs)):
+                target_summary, manifest_updates = ingest_target(k, external_search_conditions, force, manifest, batch, memory_budget)
+                summary.extend(target_summary)
+                manifest.update(manifest_updates)
+                save_ingest_manifest(manifest)
+            merge_fg_classification()
+        
+        if compact:
+            start_background_compaction()
+        run_span["rows_in"] = sum(file_row["rows_read"] or 0 for item in summary for file_row in item.get("file_rows", []))
+        run_span["rows_out"] = sum(item.get("rows_added", 0) for item in summary)
     
+    merged_parquet = os.path.join(DATA_TABLES_DIR, "merged_classification.parquet")
     print("\n### Summary ###")
     for item in summary:
         print(f"**File:** {item['file']} -> {item['parquet_file']}")
-        print(f"  Backup: {item['backup_path']}")
+        if item.get("skipped"):
+            print(f"  Skipped: already ingested on {item['skipped']['committed_at']} ({item['skipped']['rows_added']} rows), file unchanged")
+            continue
+        print(f"  Snapshot: {item['backup_path']}")
         if item["errors"]:
             print(f"  Errors: {', '.join(item['errors'])}")
+        if len(item.get("file_rows", [])) > 1 or any("rows_unchanged" in file_row for file_row in item.get("file_rows", [])):
+            for file_row in item["file_rows"]:
+                if file_row["superseded"]:
+                    print(f"    {os.path.basename(file_row['file'])}: superseded by a later file")
+                else:
+                    changes = (f": {file_row['rows_inserted']} inserted, {file_row['rows_updated']} updated, {file_row['rows_unchanged']} unchanged"
+                               if "rows_unchanged" in file_row else "")
+                    rejects = f" ({file_row['values_rejected']} values rejected)" if file_row.get("values_rejected") else ""
+                    print(f"    {os.path.basename(file_row['file'])}: {file_row['rows_read']} rows read, {file_row['rows_kept']} kept{changes}{rejects}")
+        for file_row in item.get("file_rows", []):
+            if file_row.get("expectations"):
+                failed = [check for check in file_row["expectations"] if not check["passed"]]
+                print(f"  Expectations ({os.path.basename(file_row['file'])}): {len(file_row['expectations']) - len(failed)} of {len(file_row['expectations'])} passed"
+                      + "".join(f"; {check['rule']} = {check['value']} (expected {check['expected']})" for check in failed))
         if item["search_conditions"]:
-            print(f"  Search conditions (truncated):")
+            print(f"  Upsert keys: {item['upsert_keys']} ({', '.join(item['search_conditions'])}), values (truncated):")
             for col, values in item["search_conditions"].items():
                 display_values = values[:5] if len(values) > 5 else values
                 print(f"    {col}: {display_values}{'...' if len(values) > 5 else ''}")
@@ -617,6 +2954,10 @@ def main(external_search_conditions: Optional[Dict[str, list]] = None):
         else:
             print(f"  Overwritten: {item['rows_added']} rows written")
             print(f"  Final rows: {item['final_row_count']}")
+        if item["pruning"]:
+            pruning = item["pruning"]
+            print(f"  Columns pruned: {pruning['columns_pruned']} of {pruning['columns_total']} "
+                  f"(est. {pruning['bytes_saved'] / 1024:.1f} KB and {pruning['time_saved']:.2f} s saved)")
         print(f"  Memory used: {item['memory_used']:.2f} MB")
         print(f"  CPU user time: {item['user_time']:.2f} s")
         print(f"  CPU system time: {item['system_time']:.2f} s")
@@ -628,14 +2969,98 @@ def main(external_search_conditions: Optional[Dict[str, list]] = None):
     end_time = time.time()
     total_time = end_time - start_time
     print(f"\n**Total time taken:** {total_time:.2f} seconds")
+    print(f"**Telemetry:** run {telemetry_run_id()} in {TELEMETRY_FILE}")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Convert CSV/Excel to Parquet with search/remove/append")
-    parser.add_argument("--search_conditions", type=str, help="JSON string of search conditions")
+    parser.add_argument("--search_conditions", type=str, help="JSON search conditions over the key columns: {col: [values]} (every combination) or [{col: value}, ...] (exact keys)")
+    parser.add_argument("--force", action="store_true", help="Re-ingest files even if the ingest manifest says they are already loaded")
+    parser.add_argument("--workers", type=int, default=1, help="Ingest independent tables in parallel with this many worker processes (default: 1, sequential)")
+    parser.add_argument("--memory_budget", type=float, help="Memory budget in MB: caps concurrently running tables in parallel mode, and partitioned CSV inputs estimated above it are streamed in bounded batches spilled to local disk")
+    parser.add_argument("--rollback", type=str, help="Table to roll back to its snapshot at --as_of (e.g. online_sales)")
+    parser.add_argument("--as_of", type=str, help="Date or ISO timestamp for --rollback")
+    parser.add_argument("--keep_daily", type=int, help=f"Snapshots kept: newest per day for the last this many days that have a snapshot (default: {SNAPSHOT_KEEP_DAILY})")
+    parser.add_argument("--keep_weekly", type=int, help=f"Snapshots kept: newest per week for the last this many weeks that have a snapshot (default: {SNAPSHOT_KEEP_WEEKLY})")
+    parser.add_argument("--import_legacy_backups", action="store_true", help="Move old <table>_YYYYmmdd_HHMMSS.parquet backups into the snapshot layout and apply retention to them, listing every version removed")
+    parser.add_argument("--dry_run", action="store_true", help="With --import_legacy_backups: only list what would be imported and removed")
+    parser.add_argument("--lookup", type=str, help="Table to print all rows of --oms_ids / --upcs from (e.g. online_sales)")
+    parser.add_argument("--oms_ids", type=int, nargs="+", help="OMS IDs for --lookup")
+    parser.add_argument("--upcs", type=str, nargs="+", help="UPCs for --lookup")
+    parser.add_argument("--recluster", type=str, help="Table to rewrite in cluster order (e.g. online_sales)")
+    parser.add_argument("--compact", type=str, help="Table (or 'all') whose files at older schema versions are rewritten at the current one")
+    parser.add_argument("--archive_snapshots", type=str, help=f"Table (or 'all') whose snapshot-only files are rewritten with the '{ARCHIVE_STORAGE_PROFILE}' storage profile")
+    parser.add_argument("--staging", type=str, nargs="?", const=DEFAULT_STAGING_DIR, help=f"Write table files to this local directory outside the synced warehouse and move them in when each table commits (default: {DEFAULT_STAGING_DIR}; on automatically inside OneDrive)")
+    parser.add_argument("--no_staging", action="store_true", help="Write temp files beside the live tables even inside OneDrive")
+    parser.add_argument("--no_compact", action="store_true", help="Do not start background schema compaction after ingest")
+    parser.add_argument("--full_merge", action="store_true", help="Rebuild merged_classification.parquet from scratch instead of incrementally")
+    parser.add_argument("--no_batch", action="store_true", help="Commit each pending file separately instead of one batched upsert and snapshot per table")
+    parser.add_argument("--watch", action="store_true", help="Keep running and ingest exports as they land in THD Data Warehouse (inotify on Linux, polling elsewhere)")
+    parser.add_argument("--settle_seconds", type=float, default=WATCH_SETTLE_SECONDS, help=f"Watch mode: ingest a file once its size and mtime are unchanged this long (default: {WATCH_SETTLE_SECONDS:g})")
+    parser.add_argument("--poll_seconds", type=float, default=WATCH_POLL_SECONDS, help=f"Watch mode: folder polling interval when inotify is not used (default: {WATCH_POLL_SECONDS:g})")
+    parser.add_argument("--poll", action="store_true", help="Watch mode: poll the folder even where inotify is available (network shares)")
     args = parser.parse_args()
     
+    # Set through the environment too so parallel workers use the same retention
+    if args.keep_daily is not None:
+        SNAPSHOT_KEEP_DAILY = args.keep_daily
+        os.environ["THD_SNAPSHOT_KEEP_DAILY"] = str(args.keep_daily)
+    if args.keep_weekly is not None:
+        SNAPSHOT_KEEP_WEEKLY = args.keep_weekly
+        os.environ["THD_SNAPSHOT_KEEP_WEEKLY"] = str(args.keep_weekly)
+    # Through the environment as well, for parallel workers and background compaction
+    if args.staging or args.no_staging:
+        STAGING_DIR = None if args.no_staging else args.staging
+        online_tables.STAGING_DIR = STAGING_DIR
+        os.environ["THD_STAGING_DIR"] = STAGING_DIR or ""
+    if args.import_legacy_backups:
+        import_legacy_backups(dry_run=args.dry_run)
+        raise SystemExit(0)
+    if args.rollback:
+        if not args.as_of:
+            parser.error("--rollback needs --as_of")
+        rollback_table(args.rollback, args.as_of)
+        raise SystemExit(0)
+    if args.lookup:
+        if not args.oms_ids and not args.upcs:
+            parser.error("--lookup needs --oms_ids and/or --upcs")
+        print(lookup_rows(args.lookup, oms_ids=args.oms_ids, upcs=args.upcs))
+        raise SystemExit(0)
+    if args.recluster:
+        lock_path = acquire_table_lock(table_name(args.recluster) + '.parquet')
+        try:
+            recluster_table(args.recluster)
+        finally:
+            release_table_lock(lock_path)
+        raise SystemExit(0)
+    if args.full_merge:
+        merge_fg_classification(full=True)
+        raise SystemExit(0)
+    if args.compact:
+        for table in (list(SCHEMA_REGISTRY) if args.compact == "all" else [args.compact]):
+            lock_path = acquire_table_lock(table_name(table) + '.parquet')
+            try:
+                compact_table(table)
+            finally:
+                release_table_lock(lock_path)
+        raise SystemExit(0)
+    if args.archive_snapshots:
+        tables = [args.archive_snapshots]
+        if args.archive_snapshots == "all":
+            tables = sorted(os.listdir(PARQUET_VERSIONS_DIR)) if os.path.isdir(PARQUET_VERSIONS_DIR) else []
+        for table in tables:
+            lock_path = acquire_table_lock(table_name(table) + '.parquet')
+            try:
+                archive_snapshots(table)
+            finally:
+                release_table_lock(lock_path)
+        raise SystemExit(0)
+    
+    if args.watch:
+        watch(memory_budget=args.memory_budget, compact=not args.no_compact, settle=args.settle_seconds, poll=args.poll_seconds, force_poll=args.poll)
+        raise SystemExit(0)
+    
     external_search_conditions = None
     if args.search_conditions:
         external_search_conditions = json.loads(args.search_conditions)
     
-    main(external_search_conditions)
\ No newline at end of file
+    main(external_search_conditions, force=args.force, workers=args.workers, memory_budget=args.memory_budget, compact=not args.no_compact, batch=not args.no_batch)
@@ -2,7 +2,7 @@ import os
 import time
 import polars as pl
 from docx import Document
-import re
+from online_tables import read_table, open_snapshot, snapshot_location
 
 # Start the timer
 start_time = time.time()
@@ -12,10 +12,11 @@ BASE_DIR = os.path.join(os.getcwd(), 'THD Data Warehouse')
 DATA_TABLES_DIR = os.path.join(BASE_DIR, 'Data_Tables')
 
 # Define the specific Parquet files created by the previous script
+# online_sales and online_website_anaylsis are fiscal-week partitioned dataset directories
 PARQUET_FILES = [
-    'online_sales.parquet',
+    'online_sales',
     'online_classification.parquet',
-    'online_website_anaylsis.parquet',
+    'online_website_anaylsis',
     'BA_scorecard.parquet',
     'online_stores.parquet',
     'calendar.parquet',
@@ -23,32 +24,6 @@ PARQUET_FILES = [
     'merged_classification.parquet'
 ]
 
-# Function to parse and sort week values
-def parse_and_sort_weeks(week_values):
-    # Regular expression to extract week and year (e.g., "Fiscal Week 17 of 2025")
-    pattern = r'Fiscal Week (\d+) of (\d{4})'
-    
-    # List to store parsed (year, week, original_string) tuples
-    parsed_weeks = []
-    
-    for val in week_values:
-        if val is None:
-            continue
-        match = re.match(pattern, str(val))
-        if match:
-            week = int(match.group(1))
-            year = int(match.group(2))
-            parsed_weeks.append((year, week, val))
-        else:
-            # Handle malformed entries by keeping them as-is (will sort to end)
-            parsed_weeks.append((0, 0, val))
-    
-    # Sort in descending order: first by year, then by week
-    sorted_weeks = sorted(parsed_weeks, key=lambda x: (x[0], x[1]), reverse=True)
-    
-    # Return the original string values in sorted order
-    return [week[2] for week in sorted_weeks]
-
 # Create a Word document
 doc = Document()
 doc.add_heading('Parquet Files Summary', 0)
@@ -56,23 +31,29 @@ doc.add_heading('Parquet Files Summary', 0)
 # Flag to track if any files were processed
 files_processed = False
 
+# Summarize the published version of every table, all as of the same moment
+snapshot = open_snapshot()
+
 # Process each Parquet file
 for file_name in PARQUET_FILES:
-    file_path = os.path.join(DATA_TABLES_DIR, file_name)
+    file_path = snapshot_location(file_name, snapshot)
     
-    if os.path.exists(file_path):
+    if file_path is not None and os.path.exists(file_path):
         try:
-            # Read Parquet file with Polars
-            df = pl.read_parquet(file_path)
+            # Read through read_table so files at older schema versions show the current schema
+            df = read_table(file_name, snapshot=snapshot).collect()
             total_rows = df.height  # Get total number of rows
             doc.add_heading(file_name, level=1)
             doc.add_paragraph(f"Total Rows: {total_rows:,}")
 
             # Check for unique values of 'week' column for specific files
-            if file_name in ['online_sales.parquet', 'online_website_anaylsis.parquet']:
+            if file_name in ['online_sales', 'online_website_anaylsis']:
                 if 'week' in df.columns:
-                    unique_weeks = df['week'].drop_nulls().unique().to_list()
-                    sorted_weeks = parse_and_sort_weeks(unique_weeks)
+                    # fiscal_week_key (yyyyww) is written at ingest and sorts weeks numerically
+                    sorted_weeks = (
+                        df.select('fiscal_week_key', 'week').drop_nulls().unique()
+                        .sort('fiscal_week_key', descending=True)['week'].cast(pl.Utf8).to_list()
+                    )
                     unique_weeks_str = ', '.join(str(val) for val in sorted_weeks)
                     doc.add_paragraph(f"Unique Week Values (Sorted High to Low): {unique_weeks_str if sorted_weeks else 'None'}")
                 else:
@@ -90,7 +71,7 @@ for file_name in PARQUET_FILES:
             for col, dtype in schema.items():
                 row = schema_table.add_row().cells
                 row[0].text = col
-                row[1].text = str(dtype)
+                row[1].text = f"Enum ({len(dtype.categories)} categories)" if isinstance(dtype, pl.Enum) else str(dtype)
 
             # Get sample data (first 2 rows)
             doc.add_paragraph("\nSample Data (First 2 Rows):")
@@ -2,13 +2,14 @@ import polars as pl
 import os
 import argparse
 from datetime import datetime
+from online_tables import scan_table_path, open_snapshot, snapshot_location, DATA_TABLES_DIR
 
 def combine_parquet_files(
     input_dir: str,
     calendar_file: str = 'calendar.parquet',
-    sales_file: str = 'online_sales.parquet',
+    sales_file: str = 'online_sales',
     classification_file: str = 'online_classification.parquet',
-    website_file: str = 'online_website_anaylsis.parquet',
+    website_file: str = 'online_website_anaylsis',
     scorecard_file: str = 'BA_scorecard.parquet',
     stores_file: str = 'online_stores.parquet',
     output_file: str = 'combined_data.parquet'
@@ -20,7 +21,8 @@ def combine_parquet_files(
     
     Args:
         input_dir: Directory containing the input Parquet files.
-        calendar_file, sales_file, etc.: Names of the input Parquet files.
+        calendar_file, sales_file, etc.: Names of the input Parquet files (sales and website are
+            fiscal-week partitioned dataset directories).
         output_file: Name of the output Parquet file.
     
     Returns:
@@ -41,6 +43,11 @@ def combine_parquet_files(
             'scorecard': os.path.join(input_dir, scorecard_file),
             'stores': os.path.join(input_dir, stores_file)
         }
+        # From the warehouse, read the published version of each table so an upload running meanwhile
+        # cannot mix old and new tables into the output
+        if os.path.abspath(input_dir) == os.path.abspath(DATA_TABLES_DIR):
+            snapshot = open_snapshot()
+            file_paths = {key: snapshot_location(os.path.basename(path), snapshot) or path for key, path in file_paths.items()}
 
         # Verify files exist
         for key, path in file_paths.items():
@@ -59,40 +66,36 @@ def combine_parquet_files(
         with open(log_file, 'a') as log:
             log.write(f"Output will be saved to: {output_path} at {datetime.now().strftime('%H:%M:%S %Z')}\n")
 
-        if os.path.exists(output_path):
-            print(f"Deleting existing output file: {output_path} at {datetime.now().strftime('%H:%M:%S %Z')}")
-            with open(log_file, 'a') as log:
-                log.write(f"Deleting existing output file: {output_path} at {datetime.now().strftime('%H:%M:%S %Z')}\n")
-            os.remove(output_path)
-
         # Step 1: Collect unique weeks from calendar
         print(f"Loading calendar.parquet at {datetime.now().strftime('%H:%M:%S %Z')}...")
-        calendar_df = pl.read_parquet(file_paths['calendar'])
+        calendar_df = scan_table_path(file_paths['calendar'], 'calendar').collect()
         weeks = calendar_df['week'].unique().to_list()
         print(f"Found {len(weeks)} unique weeks at {datetime.now().strftime('%H:%M:%S %Z')}")
 
         # Step 2: Load sales and website data for oms id + values
-        print(f"Loading oms id + from online_sales.parquet at {datetime.now().strftime('%H:%M:%S %Z')}...")
-        sales_df = pl.read_parquet(file_paths['sales'])
+        print(f"Loading oms id + from online_sales at {datetime.now().strftime('%H:%M:%S %Z')}...")
+        # scan_table_path resolves the schema registry, so files at older schema versions read like current ones
+        sales_df = scan_table_path(file_paths['sales'], 'online_sales').collect()
         oms_ids_sales = sales_df['oms id +'].unique().to_list()
 
-        print(f"Loading oms id + from online_website_anaylsis.parquet at {datetime.now().strftime('%H:%M:%S %Z')}...")
-        website_df = pl.read_parquet(file_paths['website'])
+        print(f"Loading oms id + from online_website_anaylsis at {datetime.now().strftime('%H:%M:%S %Z')}...")
+        website_df = scan_table_path(file_paths['website'], 'online_website_anaylsis').collect()
         oms_ids_website = website_df['oms id +'].unique().to_list()
 
         # Create base DataFrame from union of sales and website data
         print(f"Creating base DataFrame with week and oms id + combinations from sales and website at {datetime.now().strftime('%H:%M:%S %Z')}...")
-        base_sales = sales_df.lazy().select(['week', 'oms id +']).with_columns(pl.col('week').cast(pl.Utf8)).unique()
-        base_website = website_df.lazy().select(['week', 'oms id +']).with_columns(pl.col('week').cast(pl.Utf8)).unique()
-        base_df = pl.concat([base_sales, base_website], how='vertical').unique().with_columns(pl.col('week').cast(pl.Utf8))
+        # Weeks are matched on the integer fiscal_week_key (yyyyww) written at ingest; the label is carried for output
+        base_sales = sales_df.lazy().select(['fiscal_week_key', 'week', 'oms id +']).with_columns(pl.col('week').cast(pl.Utf8)).unique()
+        base_website = website_df.lazy().select(['fiscal_week_key', 'week', 'oms id +']).with_columns(pl.col('week').cast(pl.Utf8)).unique()
+        base_df = pl.concat([base_sales, base_website], how='vertical').unique()
         print(f"Base DataFrame created with {base_df.collect().height} combinations at {datetime.now().strftime('%H:%M:%S %Z')}")
 
         # Step 3: Prepare sales data without aggregation on fulfillment channels
         print(f"Processing sales data at {datetime.now().strftime('%H:%M:%S %Z')}...")
         sales_df_lazy = (
-            pl.scan_parquet(file_paths['sales'])
+            scan_table_path(file_paths['sales'], 'online_sales')
+            .drop('week')  # The week label comes from the base
             .with_columns([
-                pl.col('week').cast(pl.Utf8),  # Cast week to string
                 pl.col('icr store +').cast(pl.Utf8)  # Cast icr store + to string
             ])
             .filter(pl.col('oms id +').is_in(oms_ids_sales))  # Subset based on sales oms id +
@@ -101,10 +104,10 @@ def combine_parquet_files(
         # Step 4: Prepare website data for distribution
         print(f"Processing website data at {datetime.now().strftime('%H:%M:%S %Z')}...")
         website_df_lazy = (
-            pl.scan_parquet(file_paths['website'])
+            scan_table_path(file_paths['website'], 'online_website_anaylsis')
+            .drop(['fiscal_year', 'fiscal_week', 'week'], strict=False)  # Partition keys (absent outside a partitioned layout) come from the sales side, the week label from the base
             .with_columns([
-                pl.col('week').cast(pl.Utf8),  # Cast week to string
-                pl.col('icr store +').cast(pl.Utf8) if 'icr store +' in pl.scan_parquet(file_paths['website']).collect_schema() else pl.lit(None)  # Cast icr store + if present
+                pl.col('icr store +').cast(pl.Utf8) if 'icr store +' in website_df.columns else pl.lit(None)  # Cast icr store + if present
             ])
             .filter(pl.col('oms id +').is_in(oms_ids_website))  # Subset based on website oms id +
         )
@@ -112,20 +115,20 @@ def combine_parquet_files(
         # Step 5: Join and distribute website metrics
         print(f"Joining data at {datetime.now().strftime('%H:%M:%S %Z')}...")
         # First join sales data to base
-        result_df_lazy = base_df.join(sales_df_lazy, on=['week', 'oms id +'], how='left')
+        result_df_lazy = base_df.join(sales_df_lazy, on=['fiscal_week_key', 'oms id +'], how='left')
 
         # Count sales rows per week and oms id + for distribution
         sales_count = (
-            result_df_lazy.group_by(['week', 'oms id +'])
+            result_df_lazy.group_by(['fiscal_week_key', 'oms id +'])
             .agg(pl.len().alias('sales_row_count'))
-            .select(['week', 'oms id +', 'sales_row_count'])
+            .select(['fiscal_week_key', 'oms id +', 'sales_row_count'])
         )
 
         # Join website data and distribute metrics
         result_df_lazy = result_df_lazy.join(
-            website_df_lazy, on=['week', 'oms id +'], how='left'
+            website_df_lazy, on=['fiscal_week_key', 'oms id +'], how='left'
         ).join(
-            sales_count, on=['week', 'oms id +'], how='left'
+            sales_count, on=['fiscal_week_key', 'oms id +'], how='left'
         ).with_columns([
             pl.when(pl.col('sales_row_count').is_not_null() & pl.col('sales_row_count') > 0)
             .then(pl.col('total_product_interaction_conversion') / pl.col('sales_row_count'))
@@ -194,7 +197,10 @@ def combine_parquet_files(
 
         # Step 6: Write to Parquet
         print(f"Writing to Parquet at {datetime.now().strftime('%H:%M:%S %Z')}...")
-        result_df_lazy.sink_parquet(output_path)
+        # Written beside the output and swapped in, so readers of the previous output never see it missing
+        temp_output_path = output_path + '.tmp'
+        result_df_lazy.sink_parquet(temp_output_path)
+        os.replace(temp_output_path, output_path)
         print(f"Success: Combined data written to {output_path} at {datetime.now().strftime('%H:%M:%S %Z')}")
         with open(log_file, 'a') as log:
             log.write(f"Success: Combined data written to {output_path} at {datetime.now().strftime('%H:%M:%S %Z')}\n")
@@ -216,9 +222,9 @@ def main():
         help="Directory containing the input Parquet files (default: ./THD Data Warehouse/Data_Tables)"
     )
     parser.add_argument("--calendar_file", default="calendar.parquet", help="Calendar Parquet file")
-    parser.add_argument("--sales_file", default="online_sales.parquet", help="Sales Parquet file")
+    parser.add_argument("--sales_file", default="online_sales", help="Sales Parquet dataset (fiscal-week partitioned directory)")
     parser.add_argument("--classification_file", default="online_classification.parquet", help="Classification Parquet file")
-    parser.add_argument("--website_file", default="online_website_anaylsis.parquet", help="Website analysis Parquet file")
+    parser.add_argument("--website_file", default="online_website_anaylsis", help="Website analysis Parquet dataset (fiscal-week partitioned directory)")
     parser.add_argument("--scorecard_file", default="BA_scorecard.parquet", help="Scorecard Parquet file")
     parser.add_argument("--stores_file", default="online_stores.parquet", help="Stores Parquet file")
     parser.add_argument("--output_file", default="combined_data.parquet", help="Output file name (default: combined_data.parquet)")
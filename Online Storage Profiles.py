@@ -0,0 +1,193 @@
+import polars as pl
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+from datetime import datetime
+from typing import Dict, List, Optional
+
+# Storage profile chooser for Online Data Upload.py: rewrites a real table (live, or a snapshot with --as_of)
+# once per candidate in STORAGE_PROFILES and measures file size, write time and the scan time of the
+# report queries Online Weekly Sales Analysis.py runs (recent weeks by OMS ID, weekly trend, point lookups,
+# whole-table reads). Each profile gets a score per workload, the metric relative to the best candidate
+# weighted by what the workload cares about (1.0 = best on every metric); the lowest score is recommended.
+# Scans run warm (the files were just written), best of --repeat runs.
+#
+#   python "Online Storage Profiles.py" --table online_sales                        # scan-heavy live table
+#   python "Online Storage Profiles.py" --table online_sales --as_of 2025-08-04 --workload archive
+#   python "Online Storage Profiles.py" --table merged_classification --profiles default scan
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(os.getcwd(), 'THD Data Warehouse', 'benchmarks')
+
+# Weight of each metric per workload: live report tables are read far more often than written; snapshot
+# files are rewritten once, off the ingest path, then kept for weeks and rarely read
+WORKLOADS = {
+    "scan": {"size": 0.2, "write": 0.1, "scan": 0.7},
+    "ingest": {"size": 0.2, "write": 0.5, "scan": 0.3},
+    "archive": {"size": 0.9, "write": 0.0, "scan": 0.1},
+}
+LOOKUP_SAMPLE = 20
+RECENT_WEEKS = 8
+
+def load_uploader():
+    if SCRIPT_DIR not in sys.path:
+        sys.path.insert(0, SCRIPT_DIR)
+    import online_data_upload
+    return online_data_upload
+
+def directory_bytes(path: str) -> int:
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+# Options the uploader writes the table with (merged_classification is not in file_configs)
+def table_write_options(uploader, name: str) -> Dict:
+    if uploader.table_name(name) == "merged_classification":
+        return uploader.MERGED_CLASSIFICATION_OPTIONS
+    return uploader.table_options(name)
+
+# Report queries for a table, built from the columns it has: {query name: function(LazyFrame) -> LazyFrame}
+def report_queries(frame: pl.LazyFrame, options: Dict) -> Dict:
+    schema = frame.collect_schema()
+    key = (options.get("cluster_by") or ["oms id +"])[0]
+    key = key if key in schema else None
+    measures = [col for col, dtype in schema.items() if dtype.is_numeric() and col != key and not col.startswith("fiscal_")]
+    queries = {"full_read": lambda lf: lf}
+    if "fiscal_week_key" in schema and measures:
+        recent_keys = frame.select(pl.col("fiscal_week_key").unique().sort(descending=True).head(RECENT_WEEKS)).collect()["fiscal_week_key"]
+        first_key = recent_keys.min()
+        group = [key] if key else ["fiscal_week_key"]
+        queries["recent_weeks"] = lambda lf: (
+            lf.filter((pl.col("fiscal_week_key") >= first_key) & (pl.col(measures[0]) > 0)).group_by(group).agg(pl.col(measures).sum())
+        )
+        queries["weekly_trend"] = lambda lf: lf.group_by("fiscal_week_key").agg(pl.col(measures).sum())
+    if key:
+        sample = frame.select(pl.col(key).drop_nulls().unique()).collect()[key]
+        sample = sample.sample(min(LOOKUP_SAMPLE, sample.len()), seed=0)
+        queries["point_lookup"] = lambda lf: lf.filter(pl.col(key).is_in(sample.implode()))
+    return queries
+
+# Rewrite every file of the table under out_dir with one profile; returns write seconds
+def write_candidate(uploader, name: str, files: Dict[str, str], out_dir: str, options: Dict, profile: str) -> float:
+    start = time.perf_counter()
+    for rel, path in files.items():
+        target = os.path.join(out_dir, rel)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        frame = uploader.apply_schema_rules(pl.scan_parquet(path), name, uploader.file_schema_version(path))
+        uploader.write_table_file(frame, target, name, {**options, "storage_profile": profile})
+    return time.perf_counter() - start
+
+# Best-of-repeat wall time of each query against a candidate copy
+def time_queries(location: str, is_dataset: bool, queries: Dict, repeat: int) -> Dict[str, float]:
+    timings = {}
+    for query, build in queries.items():
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            build(pl.scan_parquet(location, hive_partitioning=is_dataset)).collect()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings[query] = best
+    return timings
+
+# Add one score per workload to each result: weighted metric relative to the best candidate
+def score_profiles(results: List[Dict]) -> None:
+    best = {metric: min(result[f"{metric}_s" if metric != "size" else "bytes"] for result in results) or 1e-9 for metric in ("size", "write", "scan")}
+    for result in results:
+        relative = {
+            "size": result["bytes"] / best["size"],
+            "write": result["write_s"] / best["write"],
+            "scan": result["scan_s"] / best["scan"],
+        }
+        result["scores"] = {workload: sum(weight * relative[metric] for metric, weight in weights.items()) for workload, weights in WORKLOADS.items()}
+
+def main(table: str, profiles: Optional[List[str]] = None, workload: str = "scan", as_of: Optional[str] = None,
+         repeat: int = 3, output: Optional[str] = None) -> Dict:
+    uploader = load_uploader()
+    profiles = profiles or list(uploader.STORAGE_PROFILES)
+    unknown = [profile for profile in profiles if profile not in uploader.STORAGE_PROFILES]
+    if unknown:
+        raise SystemExit(f"Unknown storage profiles: {', '.join(unknown)} (defined: {', '.join(uploader.STORAGE_PROFILES)})")
+    if as_of:
+        location = uploader.version_location(table, uploader.resolve_version(table, as_of))
+    else:
+        location = uploader.table_location(table)
+    if location is None:
+        raise SystemExit(f"Table {uploader.table_name(table)} does not exist in {uploader.DATA_TABLES_DIR}")
+    is_dataset = os.path.isdir(location)
+    files = uploader.table_files(location)
+    options = table_write_options(uploader, table)
+    current = uploader.storage_profile_name(options)
+    queries = report_queries(uploader.scan_table_path(location, table), options)
+    print(f"Benchmarking {len(profiles)} storage profiles on {uploader.table_name(table)} ({len(files)} files, "
+          f"{directory_bytes(location) / 1024 / 1024:.1f} MB, current profile '{current}'); queries: {', '.join(queries)}")
+
+    results = []
+    scratch = tempfile.mkdtemp(prefix="thd_storage_", dir=RESULTS_DIR if os.path.isdir(RESULTS_DIR) else None)
+    try:
+        for profile in profiles:
+            out_dir = os.path.join(scratch, profile)
+            write_s = write_candidate(uploader, table, files, out_dir, options, profile)
+            candidate = out_dir if is_dataset else os.path.join(out_dir, next(iter(files)))
+            timings = time_queries(candidate, is_dataset, queries, repeat)
+            results.append({
+                "profile": profile,
+                "settings": uploader.STORAGE_PROFILES[profile],
+                "bytes": directory_bytes(candidate),
+                "write_s": write_s,
+                "scan_s": sum(timings.values()),
+                "queries": timings,
+            })
+            shutil.rmtree(out_dir, ignore_errors=True)
+            print(f"  {profile}: {results[-1]['bytes'] / 1024 / 1024:.1f} MB, write {write_s:.2f} s, "
+                  + ", ".join(f"{query} {seconds * 1000:.0f} ms" for query, seconds in timings.items()))
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    score_profiles(results)
+    ranked = sorted(results, key=lambda result: result["scores"][workload])
+    print(f"\nScores for the {workload} workload (1.0 = best on every metric; weights {WORKLOADS[workload]}):")
+    for result in ranked:
+        print(f"  {result['profile']:<16} {result['scores'][workload]:.2f}{'  (current)' if result['profile'] == current else ''}")
+    recommended = ranked[0]["profile"]
+    if recommended == current:
+        print(f"\nRecommended: keep '{current}'")
+    elif uploader.table_name(table) == "merged_classification":
+        print(f"\nRecommended: '{recommended}'; set MERGED_CLASSIFICATION_OPTIONS = {{\"storage_profile\": \"{recommended}\"}}")
+    elif workload == "archive":
+        print(f"\nRecommended: '{recommended}'; set ARCHIVE_STORAGE_PROFILE = \"{recommended}\" and run --archive_snapshots")
+    else:
+        print(f"\nRecommended: '{recommended}'; add \"storage_profile\": \"{recommended}\" to the table's file_configs options "
+              f"(existing files are rewritten by --recluster or the next upsert of each partition)")
+
+    report = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "table": uploader.table_name(table),
+        "as_of": as_of,
+        "workload": workload,
+        "current": current,
+        "recommended": recommended,
+        "polars": pl.__version__,
+        "results": results,
+    }
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    output = output or os.path.join(RESULTS_DIR, f"storage_{uploader.table_name(table)}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark storage profiles against a table and recommend one")
+    parser.add_argument("--table", type=str, required=True, help="Table to benchmark (e.g. online_sales)")
+    parser.add_argument("--profiles", type=str, nargs="+", help="STORAGE_PROFILES entries to compare (default: all)")
+    parser.add_argument("--workload", type=str, default="scan", choices=list(WORKLOADS), help="What the recommendation optimizes for (default: scan)")
+    parser.add_argument("--as_of", type=str, help="Benchmark the table's snapshot at this date or ISO timestamp instead of the live table")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per query; the fastest counts (default: 3)")
+    parser.add_argument("--output", type=str, help="Results file (default: THD Data Warehouse/benchmarks/storage_<table>_<timestamp>.json)")
+    args = parser.parse_args()
+    main(args.table, profiles=args.profiles, workload=args.workload, as_of=args.as_of, repeat=args.repeat, output=args.output)
@@ -0,0 +1,273 @@
+import polars as pl
+import numpy as np
+import openpyxl
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+from typing import Dict, List, Optional
+
+# Ingest benchmark for Online Data Upload.py: synthetic sources for every file_configs prefix at 1x/10x/100x
+# of today's volume, each ingested in a fresh process (overwrite, and upsert for keyed tables) so peak RSS
+# belongs to the ingest alone. Results go to a JSON file that later runs can be compared against.
+# Runs offline on plain Linux: no source data, network or Windows components are needed.
+#
+#   python "Online Upload Benchmark.py"                                    # every prefix at 1x, 10x and 100x
+#   python "Online Upload Benchmark.py" --scales 1 10 --prefixes pythononlinesales
+#   python "Online Upload Benchmark.py" --compare "THD Data Warehouse/benchmarks/results_20250825_090000.json"
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(os.getcwd(), 'THD Data Warehouse', 'benchmarks')
+
+# Rows per source at 1x: the August 2025 loads (process.log, Data_Tables) for classification, scorecard,
+# stores, calendar and FG status; sales and website are four weeks of rows for ~1,800 and ~7,000 OMS IDs
+BASE_ROWS = {
+    "pythononlinewebsiteanalysis": 50_000,
+    "pythononlinesales": 150_000,
+    "pythononlineclassification": 21_251,
+    "BA_VendorContentScorecard": 3_215,
+    "onlinestores": 32_278,
+    "PythonCalendar_Full": 26,
+    "FG Status Report": 17_819,
+}
+# A worksheet holds at most 1,048,576 rows; larger Excel scales are capped and flagged in the results
+EXCEL_MAX_ROWS = 1_048_000
+# Fiscal 2025 week 1 starts on Monday 2025-02-03; base files cover weeks 1-4, upsert deltas restate week 4 and add week 5
+FISCAL_YEAR_START = np.datetime64('2025-02-03')
+BASE_DAYS = (0, 28)
+DELTA_DAYS = (21, 14)
+STRING_POOL_SIZE = 50
+
+# The uploader, imported only once the working directory is set (its table paths derive from the cwd)
+def load_uploader():
+    if SCRIPT_DIR not in sys.path:
+        sys.path.insert(0, SCRIPT_DIR)
+    import online_data_upload
+    return online_data_upload
+
+# Source header per column: the registry's alias rules map export names to table names, so emit the export name
+def source_headers(uploader, parquet_name: str, columns: List[str]) -> Dict[str, str]:
+    headers = {col: col for col in columns}
+    for entry in uploader.SCHEMA_REGISTRY.get(uploader.table_name(parquet_name), []):
+        for rule in entry["rules"]:
+            for old, new in rule.get("alias", {}).items():
+                if new in headers:
+                    headers[new] = old
+    return headers
+
+# Synthetic rows shaped like the export. Keyed sources cycle day fastest within each OMS ID, so a delta
+# file generated over an overlapping day range replaces part of the base file's keys.
+def synthetic_frame(prefix: str, dtype_dict: Dict, rows: int, day_offset: int = 0, day_span: int = 28, seed: int = 0) -> pl.DataFrame:
+    rng = np.random.default_rng(seed)
+    index = np.arange(rows)
+    # Sales has a row per fulfillment channel for each (day, oms id); classification repeats each OMS ID
+    rows_per_key = 3 if prefix in ("pythononlinesales", "pythononlineclassification") else 1
+    key_index = index // rows_per_key
+    days = day_offset + key_index % day_span
+    oms_ids = 100_000_000 + (key_index // day_span if "day" in dtype_dict else key_index)
+    columns = {}
+    for col, dtype in dtype_dict.items():
+        if col == "day":
+            columns[col] = pl.Series(FISCAL_YEAR_START + days.astype('timedelta64[D]')).cast(pl.Datetime("us"))
+        elif col == "week":
+            weeks = index % 52 + 1 if "day" not in dtype_dict else days // 7 + 1
+            columns[col] = pl.select(pl.format("Fiscal Week {} of 2025", pl.Series(weeks))).to_series()
+        elif col in ("oms id +", "OMSID"):
+            columns[col] = pl.Series(oms_ids)
+        elif "upc" in col.lower():
+            upcs = 500_000_000_000 + index if prefix == "FG Status Report" else oms_ids
+            columns[col] = pl.Series(upcs).cast(pl.Utf8).str.zfill(12)
+        elif col == "icr store +":
+            columns[col] = pl.Series(rng.integers(100, 2_100, rows)).cast(pl.Utf8)
+        elif dtype in (pl.Int32, pl.Int64):
+            columns[col] = pl.Series(rng.integers(0, 1_000, rows))
+        elif dtype in (pl.Float32, pl.Float64):
+            columns[col] = pl.Series(np.round(rng.random(rows) * 100, 2))
+        else:
+            pool = pl.Series([f"{col.strip(' +#')[:20] or 'blank'} {k}" for k in range(STRING_POOL_SIZE)])
+            columns[col] = pool.gather(rng.integers(0, STRING_POOL_SIZE, rows))
+    return pl.DataFrame(columns)
+
+# Write a synthetic source where the uploader's find_files looks for it; returns the path
+def write_source(uploader, config_index: int, rows: int, label: str, day_range=BASE_DAYS, seed: int = 0) -> str:
+    prefix, dtype_dict, parquet_name, is_excel, _, sheet_name, start_row, _ = uploader.file_configs[config_index]
+    df = synthetic_frame(prefix, dtype_dict, rows, day_offset=day_range[0], day_span=day_range[1], seed=seed)
+    headers = source_headers(uploader, parquet_name, df.columns)
+    if not is_excel:
+        path = os.path.join(uploader.BASE_DIR, f"{prefix}_{label}.csv")
+        df.rename(headers).write_csv(path)
+        return path
+    path = os.path.join(uploader.BASE_DIR, f"{prefix}_{label}.xlsx")
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet(sheet_name or "Sheet1")
+    # Report preamble above the header row, as in the scorecard export
+    for _ in range(start_row - 1):
+        sheet.append(["Report preamble"])
+    # Blank header cells: the uploader reads repeats of them as _duplicated_N, which the spec prunes
+    sheet.append([None if col == "" or col.startswith("_duplicated_") else headers[col] for col in df.columns])
+    for row in df.iter_rows():
+        sheet.append(list(row))
+    workbook.save(path)
+    return path
+
+# Total size of the files under a directory
+def directory_bytes(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+# Bytes this process has written (all write calls, including the parquet sinks and snapshots' manifests)
+def bytes_written() -> int:
+    import psutil
+    io = psutil.Process().io_counters()
+    return getattr(io, "write_chars", io.write_bytes)
+
+# Child process: ingest whatever sources are pending for one config in the current directory and print the measurements
+def run_case(config_index: int) -> None:
+    uploader = load_uploader()
+    parquet_name = uploader.file_configs[config_index][2]
+    written_before = bytes_written()
+    start = time.perf_counter()
+    summary, manifest_updates = uploader.ingest_target(config_index)
+    wall = time.perf_counter() - start
+    manifest = uploader.load_ingest_manifest()
+    manifest.update(manifest_updates)
+    uploader.save_ingest_manifest(manifest)
+    processed = [item for item in summary if not item.get("skipped")]
+    rows = sum(item.get("rows_added", 0) for item in processed)
+    print(json.dumps({
+        "wall_s": wall,
+        "rows": rows,
+        "rows_per_s": rows / wall if wall else 0.0,
+        # The uploader's telemetry resets the kernel's high-water mark per span; it keeps the process-wide peak
+        "peak_rss_mb": uploader.get_peak_memory(),
+        "bytes_written": bytes_written() - written_before,
+        "table_bytes": directory_bytes(uploader.DATA_TABLES_DIR),
+        "final_row_count": processed[-1]["final_row_count"] if processed else 0,
+        "errors": [error for item in processed for error in item.get("errors", [])],
+        "parquet_file": parquet_name,
+    }))
+
+# Run one child in workdir and return its JSON line
+def run_child(workdir: str, config_index: int) -> Dict:
+    completed = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--run_case", str(config_index)],
+        cwd=workdir, capture_output=True, text=True
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(f"Benchmark case failed:\n{completed.stderr[-2000:]}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+# One benchmark case in a scratch warehouse: upsert mode first loads a base file (not measured), then
+# ingests a delta that restates the last base week and adds a new one
+def benchmark_case(uploader, config_index: int, scale: int, mode: str) -> Dict:
+    prefix, _, parquet_name, is_excel, _, _, start_row, _ = uploader.file_configs[config_index]
+    rows = BASE_ROWS[prefix] * scale
+    capped = is_excel and rows + start_row > EXCEL_MAX_ROWS
+    rows = min(rows, EXCEL_MAX_ROWS - start_row) if is_excel else rows
+    workdir = tempfile.mkdtemp(prefix="thd_benchmark_")
+    try:
+        os.makedirs(os.path.join(workdir, 'THD Data Warehouse', 'Data_Tables'))
+        os.makedirs(os.path.join(workdir, 'THD Data Warehouse', 'parquet_versions'))
+        base_dir = uploader.BASE_DIR
+        uploader.BASE_DIR = os.path.join(workdir, 'THD Data Warehouse')
+        try:
+            if mode == "upsert":
+                write_source(uploader, config_index, rows, "base", BASE_DAYS, seed=1)
+                run_child(workdir, config_index)
+                source = write_source(uploader, config_index, rows // 2, "delta", DELTA_DAYS, seed=2)
+            else:
+                source = write_source(uploader, config_index, rows, "full", BASE_DAYS, seed=1)
+        finally:
+            uploader.BASE_DIR = base_dir
+        result = run_child(workdir, config_index)
+        result.update({
+            "prefix": prefix,
+            "scale": scale,
+            "mode": mode,
+            "source_rows": rows if mode == "overwrite" else rows // 2,
+            "source_bytes": os.path.getsize(source),
+            "excel_rows_capped": capped,
+        })
+        return result
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+# Print a comparison against an earlier results file (matched on prefix, scale and mode)
+def compare_results(current: List[Dict], baseline_path: str) -> None:
+    with open(baseline_path, 'r') as f:
+        baseline = {(r["prefix"], r["scale"], r["mode"]): r for r in json.load(f)["results"]}
+    print(f"\n### Compared with {baseline_path} ###")
+    for result in current:
+        before = baseline.get((result["prefix"], result["scale"], result["mode"]))
+        if before is None:
+            print(f"{result['prefix']} {result['scale']}x {result['mode']}: no baseline")
+            continue
+        wall_change = (result["wall_s"] / before["wall_s"] - 1) * 100 if before["wall_s"] else 0.0
+        rss_change = (result["peak_rss_mb"] / before["peak_rss_mb"] - 1) * 100 if before["peak_rss_mb"] else 0.0
+        print(f"{result['prefix']} {result['scale']}x {result['mode']}: wall {before['wall_s']:.2f} -> {result['wall_s']:.2f} s ({wall_change:+.1f}%), "
+              f"peak RSS {before['peak_rss_mb']:.0f} -> {result['peak_rss_mb']:.0f} MB ({rss_change:+.1f}%)")
+
+def main(prefixes: Optional[List[str]] = None, scales: Optional[List[int]] = None, modes: Optional[List[str]] = None,
+         output: Optional[str] = None, compare: Optional[str] = None) -> str:
+    uploader = load_uploader()
+    scales = scales or [1, 10, 100]
+    modes = modes or ["overwrite", "upsert"]
+    results = []
+    for config_index, config in enumerate(uploader.file_configs):
+        prefix, search_columns = config[0], config[4]
+        if prefixes and prefix not in prefixes:
+            continue
+        for scale in scales:
+            for mode in modes:
+                # Upsert only differs from overwrite for tables with a composite key
+                if mode == "upsert" and not search_columns:
+                    continue
+                print(f"Benchmarking {prefix} at {scale}x ({mode})...")
+                result = benchmark_case(uploader, config_index, scale, mode)
+                results.append(result)
+                print(f"  {result['rows']:,} rows in {result['wall_s']:.2f} s ({result['rows_per_s']:,.0f} rows/s), "
+                      f"peak RSS {result['peak_rss_mb']:.0f} MB, {result['bytes_written'] / (1024 * 1024):.1f} MB written"
+                      f"{' (Excel rows capped)' if result['excel_rows_capped'] else ''}")
+                if result["errors"]:
+                    print(f"  Errors: {', '.join(result['errors'])}")
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    output = output or os.path.join(RESULTS_DIR, f"results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SCRIPT_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    with open(output, 'w') as f:
+        json.dump({
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "commit": commit,
+            "host": platform.node(),
+            "python": platform.python_version(),
+            "polars": pl.__version__,
+            "cpu_count": os.cpu_count(),
+            "results": results,
+        }, f, indent=2)
+    print(f"\nResults written to {output}")
+    if compare:
+        compare_results(results, compare)
+    return output
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark Online Data Upload ingest on synthetic sources")
+    parser.add_argument("--prefixes", type=str, nargs="+", help="file_configs prefixes to benchmark (default: all)")
+    parser.add_argument("--scales", type=int, nargs="+", help="Multiples of today's volume (default: 1 10 100)")
+    parser.add_argument("--modes", type=str, nargs="+", choices=["overwrite", "upsert"], help="Ingest paths to run (default: both)")
+    parser.add_argument("--output", type=str, help="Results file (default: THD Data Warehouse/benchmarks/results_<timestamp>.json)")
+    parser.add_argument("--compare", type=str, help="Earlier results file to compare this run against")
+    parser.add_argument("--run_case", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case is not None:
+        run_case(args.run_case)
+    else:
+        main(args.prefixes, args.scales, args.modes, args.output, args.compare)
@@ -0,0 +1,154 @@
+import polars as pl
+import os
+import sys
+import json
+import argparse
+
+# Slowest stages of the last N upload runs, from the JSON-lines telemetry Online Data Upload.py writes to
+# THD Data Warehouse/telemetry.jsonl. Each stage/table row shows its typical and latest wall time so a
+# stage that got slower in the latest run stands out.
+#
+#   python "Online Upload Telemetry.py"                          # top 15 stages over the last 10 runs
+#   python "Online Upload Telemetry.py" --runs 30 --stage write --table online_sales
+#   python "Online Upload Telemetry.py" --run 20250825_090000_4242  # span tree of one run
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Telemetry file of the warehouse in the current directory (same location rules as the uploader)
+def telemetry_file() -> str:
+    if SCRIPT_DIR not in sys.path:
+        sys.path.insert(0, SCRIPT_DIR)
+    import online_data_upload
+    return online_data_upload.TELEMETRY_FILE
+
+# Span events as a frame; unreadable lines (a run killed mid-write) are skipped
+def load_spans(path: str) -> pl.DataFrame:
+    events = []
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if event.get("event") == "span":
+                events.append({
+                    "run_id": event["run_id"],
+                    "span_id": event["span_id"],
+                    "parent_id": event.get("parent_id"),
+                    "stage": event["stage"],
+                    "table": event.get("table") or "",
+                    "started_at": event["started_at"],
+                    "status": event.get("status", "ok"),
+                    "wall_s": event.get("wall_s") or 0.0,
+                    "cpu_s": event.get("cpu_s") or 0.0,
+                    "peak_rss_mb": event.get("peak_rss_mb") or 0.0,
+                    "rows_out": event.get("rows_out"),
+                    "bytes_read": event.get("bytes_read") or 0,
+                    "bytes_written": event.get("bytes_written") or 0,
+                })
+    return pl.DataFrame(events, schema={
+        "run_id": pl.Utf8, "span_id": pl.Utf8, "parent_id": pl.Utf8, "stage": pl.Utf8, "table": pl.Utf8,
+        "started_at": pl.Utf8, "status": pl.Utf8, "wall_s": pl.Float64, "cpu_s": pl.Float64,
+        "peak_rss_mb": pl.Float64, "rows_out": pl.Int64, "bytes_read": pl.Int64, "bytes_written": pl.Int64,
+    })
+
+# Runs oldest to newest by their first span
+def run_order(spans: pl.DataFrame) -> list:
+    return spans.group_by("run_id").agg(pl.col("started_at").min()).sort("started_at")["run_id"].to_list()
+
+# Per stage/table over the given runs: wall time per run (median, max, latest), CPU, peak RSS, rows/sec
+# and the latest run's wall time relative to the median of the runs before it. Peak RSS is each span's own
+# high-water mark on Linux; elsewhere it is sampled at span boundaries and can miss short spikes
+def slowest_stages(spans: pl.DataFrame, runs: list) -> pl.DataFrame:
+    per_run = (
+        spans.filter(pl.col("run_id").is_in(runs) & (pl.col("stage") != "run"))
+        .group_by("stage", "table", "run_id")
+        .agg(
+            pl.col("wall_s").sum(),
+            pl.col("cpu_s").sum(),
+            pl.col("peak_rss_mb").max(),
+            pl.col("rows_out").sum(),
+            pl.len().alias("calls"),
+            (pl.col("status") == "error").sum().alias("errors"),
+        )
+        .join(pl.DataFrame({"run_id": runs, "run_index": list(range(len(runs)))}), on="run_id")
+    )
+    latest_index = len(runs) - 1
+    return (
+        per_run.group_by("stage", "table")
+        .agg(
+            pl.col("run_id").n_unique().alias("runs"),
+            pl.col("calls").sum(),
+            pl.col("wall_s").median().alias("median_s"),
+            pl.col("wall_s").max().alias("max_s"),
+            pl.col("wall_s").filter(pl.col("run_index") == latest_index).sum().alias("latest_s"),
+            pl.col("wall_s").filter(pl.col("run_index") < latest_index).median().alias("previous_median_s"),
+            pl.col("cpu_s").median().alias("cpu_s"),
+            pl.col("peak_rss_mb").max(),
+            (pl.col("rows_out").sum() / pl.col("wall_s").sum()).alias("rows_per_s"),
+            pl.col("errors").sum(),
+        )
+        .with_columns((pl.col("latest_s") / pl.col("previous_median_s")).alias("latest_vs_median"))
+        .sort("median_s", descending=True)
+    )
+
+# Indented span tree of one run
+def print_run(spans: pl.DataFrame, run_id: str) -> None:
+    run_spans = spans.filter(pl.col("run_id") == run_id).sort("started_at")
+    children = {}
+    for span in run_spans.iter_rows(named=True):
+        children.setdefault(span["parent_id"], []).append(span)
+    span_ids = set(run_spans["span_id"])
+    def show(span, depth):
+        rows = f", {span['rows_out']} rows" if span["rows_out"] is not None else ""
+        status = "" if span["status"] == "ok" else f"  [{span['status']}]"
+        print(f"{'  ' * depth}{span['stage']} {span['table']}: {span['wall_s']:.3f} s wall, {span['cpu_s']:.3f} s CPU, "
+              f"{span['peak_rss_mb']:.0f} MB peak{rows}{status}")
+        for child in children.get(span["span_id"], []):
+            show(child, depth + 1)
+    for parent_id, roots in children.items():
+        if parent_id is None or parent_id not in span_ids:
+            for span in roots:
+                show(span, 0)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print the slowest upload stages across recent runs")
+    parser.add_argument("--runs", type=int, default=10, help="Number of most recent runs to include (default: 10)")
+    parser.add_argument("--top", type=int, default=15, help="Number of stages to print (default: 15)")
+    parser.add_argument("--stage", type=str, help="Only this stage (discover, read, transform, change_detection, write, index, backup, merge, ingest)")
+    parser.add_argument("--table", type=str, help="Only this table (e.g. online_sales)")
+    parser.add_argument("--threshold", type=float, default=1.5, help="Flag stages whose latest run took this many times their previous median (default: 1.5)")
+    parser.add_argument("--min_seconds", type=float, default=0.5, help="Ignore stages faster than this in the latest run when flagging (default: 0.5)")
+    parser.add_argument("--run", type=str, help="Print the span tree of this run instead")
+    parser.add_argument("--file", type=str, help="Telemetry file (default: THD Data Warehouse/telemetry.jsonl)")
+    args = parser.parse_args()
+
+    path = args.file or telemetry_file()
+    if not os.path.exists(path):
+        raise SystemExit(f"No telemetry found at {path}; run Online Data Upload.py first")
+    spans = load_spans(path)
+    runs = run_order(spans)
+    if not runs:
+        raise SystemExit(f"No spans recorded in {path}")
+    if args.run:
+        print_run(spans, args.run)
+        raise SystemExit(0)
+
+    if args.stage:
+        spans = spans.filter(pl.col("stage") == args.stage)
+    if args.table:
+        spans = spans.filter(pl.col("table") == args.table)
+    recent = runs[-args.runs:]
+    stages = slowest_stages(spans, recent)
+
+    print(f"Slowest stages over the last {len(recent)} runs ({recent[0]} .. {recent[-1]})")
+    pl.Config.set_tbl_rows(args.top)
+    pl.Config.set_tbl_cols(-1)
+    pl.Config.set_tbl_width_chars(200)
+    pl.Config.set_float_precision(3)
+    print(stages.head(args.top))
+    regressions = stages.filter((pl.col("latest_vs_median") > args.threshold) & (pl.col("latest_s") >= args.min_seconds))
+    if regressions.height:
+        print(f"\nSlower in the latest run ({recent[-1]}) than {args.threshold}x their previous median:")
+        for row in regressions.iter_rows(named=True):
+            print(f"  {row['stage']} {row['table']}: {row['latest_s']:.3f} s vs median {row['previous_median_s']:.3f} s ({row['latest_vs_median']:.1f}x)")
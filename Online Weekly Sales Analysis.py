@@ -14,6 +14,7 @@ import threading
 import psutil
 import gc
 import traceback
+from online_tables import read_table, open_snapshot
 
 # Debug flag: Set to False to send email
 test_mode = False
@@ -66,17 +67,23 @@ def progress_indicator(stop_event, operation):
 try:
     print_progress("Loading data lazily...")
     start_time = time.time()
-    sales = pl.scan_parquet(os.path.join(DATA_DIR, 'Data_Tables', 'online_sales.parquet'))
-    # Filter to recent 8 weeks and non-zero sales
-    sales = sales.filter(pl.col('online sales $ +') > 0).filter(
-        pl.col('week').cast(pl.Utf8).str.contains(r'Fiscal Week (?:[1-8]) of 2025')
-    )
-    print_progress("Scanned and filtered online_sales.parquet")
-    website = pl.scan_parquet(os.path.join(DATA_DIR, 'Data_Tables', 'online_website_anaylsis.parquet'))
-    print_progress("Scanned online_website_anaylsis.parquet")
-    classification = pl.scan_parquet(os.path.join(DATA_DIR, 'Data_Tables', 'merged_classification.parquet'))
+    # One published version of every table, resolved now: an upload running meanwhile cannot mix old and new tables
+    snapshot = open_snapshot()
+    # read_table resolves the schema registry, so files at older schema versions read like current ones
+    sales = read_table('online_sales', snapshot=snapshot)
+    # Filter to the 8 most recent fiscal weeks in the table (across year boundaries) and non-zero sales. The
+    # partition columns come from the file paths, so finding the weeks reads no rows, and the partition filter
+    # skips other weeks' files entirely
+    partition_key = pl.col('fiscal_year') * 100 + pl.col('fiscal_week')
+    window_keys = sales.select(partition_key.alias('fiscal_week_key')).unique().collect()['fiscal_week_key'].sort(descending=True).head(8)
+    sales = sales.filter(partition_key.is_in(window_keys.implode())).filter(pl.col('online sales $ +') > 0)
+    print_progress(f"Sales window: fiscal weeks {window_keys.min()} to {window_keys.max()}")
+    print_progress("Scanned and filtered online_sales")
+    website = read_table('online_website_anaylsis', snapshot=snapshot)
+    print_progress("Scanned online_website_anaylsis")
+    classification = read_table('merged_classification', snapshot=snapshot)
     print_progress("Scanned merged_classification.parquet")
-    stores = pl.scan_parquet(os.path.join(DATA_DIR, 'Data_Tables', 'online_stores.parquet'))
+    stores = read_table('online_stores', snapshot=snapshot)
     # Pre-filter stores to reduce join size
     stores = stores.filter(pl.col('icr store +').is_not_null())
     print_progress("Scanned and filtered online_stores.parquet")
@@ -163,34 +170,13 @@ del sales, classification, stores
 gc.collect()
 print_progress("Cleared temporary variables.")
 
-# Extract week number and year
-def extract_week(df, df_name):
-    try:
-        print_progress(f"Extracting week and year for {df_name}...")
-        return df.with_columns(
-            pl.col('week').cast(pl.Utf8).str.extract(r'Fiscal Week (\d+) of (\d+)').cast(pl.Int32).alias('week_num'),
-            pl.col('week').cast(pl.Utf8).str.extract(r'Fiscal Week \d+ of (\d+)').cast(pl.Int32).alias('year')
-        )
-    except Exception as e:
-        error_msg = f"Failed to extract week for {df_name}: {str(e)}\n{traceback.format_exc()}"
-        print_progress(error_msg)
-        logging.error(error_msg)
-        raise
-
-print_progress("Extracting week for sales_full...")
-sales_full = extract_week(sales_full, "sales_full")
-print_progress("sales_full week extraction complete.")
-
-print_progress("Extracting week for website_class...")
-website_class = extract_week(website_class, "website_class")
-print_progress("website_class week extraction complete.")
-
-# Find most recent week
+# Find most recent week: fiscal_week_key (yyyyww) is written at ingest, so no label parsing is needed
 try:
     print_progress("Identifying recent week...")
-    recent_week = sales_full['week'].max()
-    recent_week_num = sales_full.filter(pl.col('week') == recent_week)['week_num'].unique()[0]
-    recent_year = sales_full.filter(pl.col('week') == recent_week)['year'].unique()[0]
+    recent_week_key = sales_full['fiscal_week_key'].max()
+    recent_week = sales_full.filter(pl.col('fiscal_week_key') == recent_week_key)['week'].cast(pl.Utf8)[0]
+    recent_week_num = recent_week_key % 100
+    recent_year = recent_week_key // 100
     logging.info(f"Most recent week: {recent_week}, Week Number: {recent_week_num}, Year: {recent_year}")
     print_progress(f"Recent week identified: {recent_week}")
 except Exception as e:
@@ -205,7 +191,7 @@ print_progress(f"Safe recent_week for files: {recent_week_safe}")
 
 # Recent week analysis
 print_progress("Filtering recent sales...")
-recent_sales = sales_full.filter((pl.col('week_num') == recent_week_num) & (pl.col('year') == recent_year))
+recent_sales = sales_full.filter(pl.col('fiscal_week_key') == recent_week_key)
 print_progress("Recent sales filtered.")
 
 # Aggregate sales data by key dimensions
@@ -285,21 +271,17 @@ def get_trend(df, weeks_back, group_by=None):
     try:
         print_progress(f"Computing {weeks_back}-week trend...")
         start_time = time.time()
-        min_week = recent_week_num - weeks_back + 1 if weeks_back > 0 else 1
-        trend_df = df.filter((pl.col('week_num') >= min_week) & (pl.col('year') == recent_year))
-        if group_by:
-            trend_df = trend_df.group_by(['week', *group_by]).agg(
-                ty_sales=pl.col('online sales $ +').sum(),
-                ly_sales=pl.col('online sales $ ly +').sum()
-            )
-        else:
-            trend_df = df.group_by('week').agg(
-                ty_sales=pl.col('online sales $ +').sum(),
-                ly_sales=pl.col('online sales $ ly +').sum()
-            )
+        # Last weeks_back weeks up to the recent week, across year boundaries
+        trend_keys = df.filter(pl.col('fiscal_week_key') <= recent_week_key)['fiscal_week_key'].unique().sort(descending=True).head(weeks_back)
+        trend_df = df.filter(pl.col('fiscal_week_key').is_in(trend_keys))
+        trend_df = trend_df.group_by(['fiscal_week_key', 'week', *(group_by or [])]).agg(
+            ty_sales=pl.col('online sales $ +').sum(),
+            ly_sales=pl.col('online sales $ ly +').sum()
+        )
         logging.info(f"Computed trend for {weeks_back} weeks")
         print_progress(f"{weeks_back}-week trend computed in {time.time() - start_time:.2f} seconds.")
-        return trend_df.sort('week')
+        # Plain string labels in key order for plotting
+        return trend_df.sort('fiscal_week_key').with_columns(pl.col('week').cast(pl.Utf8))
     except Exception as e:
         error_msg = f"Failed to compute trend for {weeks_back} weeks: {str(e)}\n{traceback.format_exc()}"
         print_progress(error_msg)
@@ -317,7 +299,7 @@ conv_ty = None
 conv_ly = None
 try:
     print_progress("Calculating conversion rates...")
-    recent_website = website_class.filter((pl.col('week_num') == recent_week_num) & (pl.col('year') == recent_year))
+    recent_website = website_class.filter(pl.col('fiscal_week_key') == recent_week_key)
     ty_visits = recent_website['online pip visits +'].sum()
     ly_visits = recent_website['online pip visits ly +'].sum()
     conv_ty = (recent_website['order count TY'].sum() / (ty_visits if ty_visits != 0 else 1)) * 100
@@ -0,0 +1,13 @@
+# Importable name for "Online Data Upload.py" (a file name with spaces cannot be imported).
+# Other scripts can use its write API, e.g.:
+#   from online_data_upload import ingest
+#   ingest("online_sales", frame)  # polars DataFrame/LazyFrame or pyarrow Table
+# Importing it runs the uploader's setup (warehouse directories). Scripts that only read tables import
+# online_tables instead:
+#   from online_tables import read_table
+#   sales = read_table("online_sales", as_of="2025-08-04")
+import os
+
+_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Online Data Upload.py")
+with open(_SCRIPT, "r", encoding="utf-8") as _f:
+    exec(compile(_f.read(), _SCRIPT, "exec"))
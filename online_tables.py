@@ -0,0 +1,311 @@
+import polars as pl
+import pyarrow.parquet as pq
+import os
+import psutil
+import json
+import shutil
+import tempfile
+import atexit
+import errno
+from datetime import datetime, timedelta
+from typing import Dict, Optional, List
+
+# Read side of the THD Data Warehouse: table locations, the schema registry, snapshots and reader pins.
+# Reports import this module instead of the uploader; importing it creates no directories, resets nothing and
+# registers no exit hooks ("Online Data Upload.py" builds its writes on the same functions). E.g.:
+#   from online_tables import read_table, open_snapshot
+#   snapshot = open_snapshot()
+#   sales = read_table("online_sales", snapshot=snapshot)
+#   sales_then = read_table("online_sales", as_of="2025-08-04")
+
+# Warehouse paths, relative to the working directory
+BASE_DIR = os.path.join(os.getcwd(), 'THD Data Warehouse')
+DATA_TABLES_DIR = os.path.join(BASE_DIR, 'Data_Tables')
+PARQUET_VERSIONS_DIR = os.path.join(BASE_DIR, 'parquet_versions')
+CURRENT_MANIFEST = os.path.join(DATA_TABLES_DIR, '_current.json')
+READER_PINS_DIR = os.path.join(DATA_TABLES_DIR, '_readers')
+
+# Staging: the OneDrive client uploads every file that appears in the synced warehouse folder, temp files
+# included. With a staging directory, table files are written to local scratch outside the synced tree and
+# only moved into the warehouse when their table commits (see publish_file). On by default when BASE_DIR is
+# inside OneDrive; THD_STAGING_DIR sets the directory ("" turns staging off)
+ONEDRIVE_ROOTS = [os.path.normcase(os.environ[var]) for var in ("OneDrive", "OneDriveCommercial", "OneDriveConsumer") if os.environ.get(var)]
+DEFAULT_STAGING_DIR = os.path.join(tempfile.gettempdir(), 'thd_staging')
+STAGING_DIR = os.environ.get("THD_STAGING_DIR", DEFAULT_STAGING_DIR if any(os.path.normcase(BASE_DIR).startswith(root + os.sep) for root in ONEDRIVE_ROOTS) else "") or None
+
+# Fiscal-week labels: "Fiscal Week 8 of 2025" -> fiscal_week_key 202508
+FISCAL_WEEK_PATTERN = r'Fiscal Week (\d+) of (\d{4})'
+
+# Ordered week labels: sorting, max() and comparisons on the Enum follow (year, week) instead of the string.
+# Labels it does not list (other years, other spellings) are kept as Utf8 text rather than rejected; a fiscal
+# week's rows share one label, so each partition is written wholly as one type or the other
+FISCAL_WEEK_ENUM = pl.Enum([f"Fiscal Week {week} of {year}" for year in range(2020, 2040) for week in range(1, 54)])
+
+# Week labels in column col all listed by the Enum dtype (reads that one column when frame is lazy)
+def labels_in_enum(frame, col: str, dtype: pl.Enum) -> bool:
+    labels = frame.select(pl.col(col).cast(pl.Utf8).drop_nulls().unique())
+    if isinstance(labels, pl.LazyFrame):
+        labels = labels.collect()
+    return bool(labels[col].is_in(dtype.categories.implode()).all())
+
+# fiscal_week_key is yyyyww (e.g. 202508), parsed once from the week label
+WEEK_KEY_EXPR = (
+    pl.col("week").cast(pl.Utf8).str.extract(FISCAL_WEEK_PATTERN, 2).cast(pl.Int32) * 100
+    + pl.col("week").cast(pl.Utf8).str.extract(FISCAL_WEEK_PATTERN, 1).cast(pl.Int32)
+)
+
+# Schema registry: versioned schemas per table, oldest first. Each version lists the rules that bring data
+# written under earlier versions up to it. Rules are resolved lazily wherever a source or a table file is
+# scanned, so a schema change is a registry edit: old files are cast and projected on read, and compaction
+# (--compact) rewrites them at the current version later. Rules only touch data that needs them.
+#   {"alias": {old_name: column}}   rename (source headers and files written under the old name)
+#   {"cast": {column: dtype}}
+#   {"add": {column: expression}}   computed from the row's other columns when the column is missing
+WEEK_KEY_RULES = [{"add": {"fiscal_week_key": WEEK_KEY_EXPR}}, {"cast": {"week": FISCAL_WEEK_ENUM}}]
+SCHEMA_REGISTRY = {
+    "online_sales": [
+        {"version": 1, "rules": []},
+        {"version": 2, "rules": [{"cast": {"online return units +": pl.Float32}}]},
+        {"version": 3, "rules": WEEK_KEY_RULES},
+    ],
+    "online_website_anaylsis": [
+        {"version": 1, "rules": [
+            {"alias": {"online product interaction conversion rate ": "online product interaction conversion rate"}},
+            {"cast": {"online product interaction conversion rate": pl.Float32}},
+        ]},
+        {"version": 2, "rules": [{"add": {
+            "order count TY": (pl.col("online pip visits +") * pl.col("online pip conversion rate +")).cast(pl.Float32),
+            "order count LY": (pl.col("online pip visits ly +") * pl.col("online pip conversion rate ly +")).cast(pl.Float32),
+        }}]},
+        {"version": 3, "rules": WEEK_KEY_RULES},
+    ],
+    "calendar": [
+        {"version": 1, "rules": []},
+        {"version": 2, "rules": WEEK_KEY_RULES},
+    ],
+}
+SCHEMA_VERSION_KEY = "thd_schema_version"
+
+# Current schema version of a table (0 for tables without registry entries)
+def schema_version(parquet_name: str) -> int:
+    versions = SCHEMA_REGISTRY.get(table_name(parquet_name), [])
+    return versions[-1]["version"] if versions else 0
+
+# Schema version a table file was written at, from its parquet metadata (0 when written before the registry)
+def file_schema_version(path: str) -> int:
+    metadata = pq.read_metadata(path).metadata or {}
+    return int(metadata.get(SCHEMA_VERSION_KEY.encode(), b"0"))
+
+# Bring a frame written at from_version up to the table's current schema (lazy: nothing is read here, except
+# the one column an Enum cast checks the labels of)
+def apply_schema_rules(frame, parquet_name: str, from_version: int = 0):
+    for entry in SCHEMA_REGISTRY.get(table_name(parquet_name), []):
+        if entry["version"] <= from_version:
+            continue
+        for rule in entry["rules"]:
+            schema = frame.collect_schema()
+            if "alias" in rule:
+                renames = {old: new for old, new in rule["alias"].items() if old in schema and new not in schema}
+                if renames:
+                    frame = frame.rename(renames)
+            elif "cast" in rule:
+                frame = frame.with_columns([
+                    # Categorical -> Enum goes through the string labels; labels the Enum lacks stay text
+                    (pl.col(col).cast(pl.Utf8).cast(dtype) if labels_in_enum(frame, col, dtype) else pl.col(col).cast(pl.Utf8))
+                    if isinstance(dtype, pl.Enum) else pl.col(col).cast(dtype)
+                    for col, dtype in rule["cast"].items() if col in schema and schema[col] != dtype
+                ])
+            elif "add" in rule:
+                frame = frame.with_columns([
+                    expr.alias(col) for col, expr in rule["add"].items()
+                    if col not in schema and all(root in schema for root in expr.meta.root_names())
+                ])
+    return frame
+
+# Temporary file that will replace a warehouse file: under STAGING_DIR when staging, else in Data_Tables
+def temp_table_path(name: str) -> str:
+    if STAGING_DIR:
+        os.makedirs(STAGING_DIR, exist_ok=True)
+        return os.path.join(STAGING_DIR, f"{os.getpid()}_{name}")
+    return os.path.join(DATA_TABLES_DIR, name)
+
+# Move a written temp file over its live path with one rename. A staged file on another volume than the
+# warehouse cannot be renamed in, so it is copied beside the live path first and that copy is renamed
+def publish_file(temp_path: str, live_path: str) -> None:
+    os.makedirs(os.path.dirname(live_path), exist_ok=True)
+    try:
+        os.replace(temp_path, live_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copyfile(temp_path, live_path + '.tmp')
+        os.replace(live_path + '.tmp', live_path)
+        os.remove(temp_path)
+
+# Tables live in Data_Tables as a single file or a fiscal-week partitioned dataset directory
+def dataset_dir(parquet_file: str) -> str:
+    return parquet_file[:-len('.parquet')] if parquet_file.endswith('.parquet') else parquet_file
+
+def table_name(parquet_name: str) -> str:
+    return os.path.basename(parquet_name).replace('.parquet', '')
+
+# Live location of a table: the partitioned dataset directory, the single file, or None
+def table_location(parquet_name: str) -> Optional[str]:
+    parquet_file = os.path.join(DATA_TABLES_DIR, table_name(parquet_name) + '.parquet')
+    dataset = dataset_dir(parquet_file)
+    if os.path.isdir(dataset):
+        return dataset
+    if os.path.exists(parquet_file):
+        return parquet_file
+    return None
+
+# Parquet files of a live table location as {path relative to the location: absolute path}
+def table_files(location: str) -> Dict[str, str]:
+    if not os.path.isdir(location):
+        return {os.path.basename(location): location}
+    return {
+        os.path.relpath(os.path.join(root, name), location): os.path.join(root, name)
+        for root, _, names in sorted(os.walk(location)) for name in sorted(names) if name.endswith('.parquet')
+    }
+
+def versions_dir(parquet_name: str) -> str:
+    return os.path.join(PARQUET_VERSIONS_DIR, table_name(parquet_name))
+
+def load_versions(parquet_name: str) -> List[dict]:
+    manifest_path = os.path.join(versions_dir(parquet_name), 'versions.json')
+    if not os.path.exists(manifest_path):
+        return []
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+# Version in effect at as_of: a datetime, an ISO timestamp, or a date (meaning end of that day)
+def resolve_version(parquet_name: str, as_of) -> dict:
+    if isinstance(as_of, str):
+        as_of = datetime.fromisoformat(as_of) + (timedelta(days=1) - timedelta(microseconds=1) if len(as_of) == 10 else timedelta(0))
+    candidates = [entry for entry in load_versions(parquet_name) if datetime.fromisoformat(entry["created_at"]) <= as_of]
+    if not candidates:
+        raise ValueError(f"No snapshot of {table_name(parquet_name)} exists at or before {as_of}")
+    return candidates[-1]
+
+# Hive partition columns encoded in a file's path relative to its dataset (fiscal_year=2025/fiscal_week=8/...)
+def hive_columns(rel: str) -> List[pl.Expr]:
+    parts = [part.split("=", 1) for part in os.path.dirname(rel).split(os.sep) if "=" in part]
+    return [pl.lit(int(value), dtype=pl.Int64).alias(col) for col, value in parts]
+
+# Lazily scan a table stored at path (a dataset directory or a single file), resolving the schema registry:
+# when every file is at the current version this is one plain scan, otherwise each older file is cast and
+# projected to the current schema on read
+def scan_table_path(path: str, name: str) -> pl.LazyFrame:
+    files = table_files(path)
+    current = schema_version(name)
+    versions = {rel: file_schema_version(file_path) for rel, file_path in files.items()}
+    # Partitions of weeks kept as text sit beside Enum ones; one scan needs every file at the same week type
+    week_types = {str(pl.read_parquet_schema(file_path).get("week")) for file_path in files.values()}
+    if all(version >= current for version in versions.values()) and len(week_types) <= 1:
+        return pl.scan_parquet(path, hive_partitioning=os.path.isdir(path))
+    frames = [
+        apply_schema_rules(pl.scan_parquet(file_path), name, versions[rel]).with_columns(hive_columns(rel))
+        for rel, file_path in files.items()
+    ]
+    return pl.concat(frames, how="diagonal_relaxed")
+
+# Path of a snapshot version: its dataset directory, or its single file
+def version_location(parquet_name: str, entry: Dict) -> str:
+    version_path = os.path.join(versions_dir(parquet_name), entry["version"])
+    return version_path if entry["kind"] == "dataset" else os.path.join(version_path, entry["files"][0])
+
+# Published versions: Data_Tables/_current.json maps every table to its latest committed snapshot version.
+# Each commit publishes with one atomic replace (writers serialize on a short lock; readers never lock).
+# Readers resolve the whole map once with open_snapshot() and read only those immutable version
+# directories, so a report running during an upload sees every table as of one moment, never a torn mix.
+def load_current_manifest() -> Dict[str, dict]:
+    if not os.path.exists(CURRENT_MANIFEST):
+        return {}
+    with open(CURRENT_MANIFEST, 'r') as f:
+        return json.load(f)
+
+# Versions pinned by this process's snapshots, written to _readers/<pid>.json so retention keeps them
+reader_pins = {}
+
+def pin_snapshot(snapshot: Dict[str, dict]) -> None:
+    # Registered on the first pin (once: unregister drops an earlier registration), not at import
+    atexit.unregister(release_snapshot_pins)
+    atexit.register(release_snapshot_pins)
+    for name, entry in snapshot.items():
+        reader_pins.setdefault(name, set()).add(entry["version"])
+    os.makedirs(READER_PINS_DIR, exist_ok=True)
+    pin_path = os.path.join(READER_PINS_DIR, f"{os.getpid()}.json")
+    temp_pin = temp_table_path(f"reader_pin_{os.getpid()}.json.tmp")
+    with open(temp_pin, 'w') as f:
+        json.dump({name: sorted(versions) for name, versions in reader_pins.items()}, f)
+    publish_file(temp_pin, pin_path)
+
+def release_snapshot_pins() -> None:
+    reader_pins.clear()
+    pin_path = os.path.join(READER_PINS_DIR, f"{os.getpid()}.json")
+    if os.path.exists(pin_path):
+        os.remove(pin_path)
+
+# Versions of a table pinned by running readers; pins left behind by dead processes are cleared
+def pinned_versions(parquet_name: str) -> set:
+    pinned = set()
+    if not os.path.isdir(READER_PINS_DIR):
+        return pinned
+    for file in os.listdir(READER_PINS_DIR):
+        pin_path = os.path.join(READER_PINS_DIR, file)
+        if not file.endswith('.json'):
+            continue
+        try:
+            if not psutil.pid_exists(int(file[:-len('.json')])):
+                os.remove(pin_path)
+                continue
+            with open(pin_path, 'r') as f:
+                pinned.update(json.load(f).get(table_name(parquet_name), []))
+        except (OSError, ValueError):
+            continue
+    return pinned
+
+# Consistent view of every published table for a reader, resolved once: {table: version entry}.
+# Tables never published through the manifest fall back to their newest snapshot.
+def open_snapshot(attempts: int = 5) -> Dict[str, dict]:
+    for _ in range(attempts):
+        snapshot = load_current_manifest()
+        if os.path.isdir(PARQUET_VERSIONS_DIR):
+            for name in sorted(os.listdir(PARQUET_VERSIONS_DIR)):
+                if name not in snapshot and os.path.isdir(os.path.join(PARQUET_VERSIONS_DIR, name)):
+                    versions = load_versions(name)
+                    if versions:
+                        snapshot[name] = versions[-1]
+        pin_snapshot(snapshot)
+        # Retention may have dropped a version between reading the manifest and pinning it: resolve again
+        missing = [name for name, entry in snapshot.items() if not os.path.exists(version_location(name, entry))]
+        if not missing:
+            return snapshot
+    raise FileNotFoundError(f"Published versions of {', '.join(missing)} are missing from {PARQUET_VERSIONS_DIR}")
+
+# Location of a table in a reader snapshot (None when the table is not in it)
+def snapshot_location(name: str, snapshot: Dict[str, dict]) -> Optional[str]:
+    entry = snapshot.get(table_name(name))
+    return version_location(name, entry) if entry else None
+
+# Lazily read a table: live, from a reader snapshot (see open_snapshot), or as it was at as_of
+# (time travel through the snapshots)
+def read_table(name: str, as_of=None, snapshot: Optional[Dict[str, dict]] = None) -> pl.LazyFrame:
+    if snapshot is not None:
+        location = snapshot_location(name, snapshot)
+        if location is None:
+            raise FileNotFoundError(f"Table {table_name(name)} has no published version in {CURRENT_MANIFEST}")
+        return scan_table_path(location, name)
+    if as_of is None:
+        location = table_location(name)
+        if location is None:
+            raise FileNotFoundError(f"Table {table_name(name)} does not exist in {DATA_TABLES_DIR}")
+        return scan_table_path(location, name)
+    return scan_table_path(version_location(name, resolve_version(name, as_of)), name)
+
+# Table files written at an older schema version than the registry's current one (live, or at location)
+def stale_schema_files(name: str, location: Optional[str] = None) -> List[str]:
+    location = location or table_location(name)
+    if location is None or not schema_version(name):
+        return []
+    return [path for path in table_files(location).values() if file_schema_version(path) < schema_version(name)]
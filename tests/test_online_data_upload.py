@@ -0,0 +1,379 @@
+import gzip
+import importlib
+import importlib.util
+import os
+import sys
+import zipfile
+
+import polars as pl
+import pytest
+
+# Behavior checks for Online Data Upload.py, each against a fresh warehouse in a temporary directory.
+#
+#   python -m pytest -q tests
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The uploader and online_tables resolve THD Data Warehouse from the working directory at import, so each
+# warehouse gets its own copy of both
+def load_uploader(directory, monkeypatch):
+    os.makedirs(directory, exist_ok=True)
+    monkeypatch.chdir(directory)
+    monkeypatch.setenv("THD_STAGING_DIR", "")
+    for var in ("THD_TELEMETRY_RUN", "THD_TELEMETRY_PARENT", "THD_SNAPSHOT_KEEP_DAILY", "THD_SNAPSHOT_KEEP_WEEKLY"):
+        monkeypatch.delenv(var, raising=False)
+    monkeypatch.syspath_prepend(REPO_DIR)
+    monkeypatch.delitem(sys.modules, "online_tables", raising=False)
+    spec = importlib.util.spec_from_file_location("online_data_upload", os.path.join(REPO_DIR, "online_data_upload.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+@pytest.fixture
+def uploader(tmp_path, monkeypatch):
+    module = load_uploader(tmp_path, monkeypatch)
+    yield module
+    module.release_snapshot_pins()
+
+def config_index(uploader, parquet_name: str) -> int:
+    return next(k for k, config in enumerate(uploader.file_configs) if config[2] == parquet_name)
+
+# Sales export rows keyed on (day, oms id +), as text the way the CSV arrives
+def sales_rows(rows: list) -> pl.DataFrame:
+    return pl.DataFrame(
+        [(f"{day}T00:00:00.000000", week, f"{oms_id:012d}", str(oms_id), f"{sales:.2f}") for day, week, oms_id, sales in rows],
+        schema=["day", "week", "online upc +", "oms id +", "online sales $ +"],
+        orient="row",
+    )
+
+def test_upsert_replaces_matching_keys_and_keeps_the_rest(uploader):
+    index = config_index(uploader, "online_sales.parquet")
+    first = os.path.join(uploader.BASE_DIR, "pythononlinesales_1.csv")
+    sales_rows([
+        ("2025-02-03", "Fiscal Week 1 of 2025", 1, 10.0),
+        ("2025-02-03", "Fiscal Week 1 of 2025", 2, 20.0),
+        ("2025-02-03", "Fiscal Week 1 of 2025", 3, 30.0),
+        ("2025-02-10", "Fiscal Week 2 of 2025", 1, 40.0),
+    ]).write_csv(first)
+    uploader.ingest_target(index, paths=[first])
+
+    # Same key (2025-02-03, 2) replaced, a new key added; (2025-02-03, 1), (2025-02-03, 3) and the same
+    # oms id on another day are untouched
+    second = os.path.join(uploader.BASE_DIR, "pythononlinesales_2.csv")
+    sales_rows([
+        ("2025-02-03", "Fiscal Week 1 of 2025", 2, 25.0),
+        ("2025-02-03", "Fiscal Week 1 of 2025", 4, 50.0),
+    ]).write_csv(second)
+    summary, _ = uploader.ingest_target(index, paths=[second])
+
+    table = uploader.read_table("online_sales").select(
+        pl.col("day").dt.date().cast(pl.Utf8), "oms id +", "online sales $ +"
+    ).sort("day", "oms id +").collect()
+    assert table.rows() == [
+        ("2025-02-03", 1, 10.0),
+        ("2025-02-03", 2, 25.0),
+        ("2025-02-03", 3, 30.0),
+        ("2025-02-03", 4, 50.0),
+        ("2025-02-10", 1, 40.0),
+    ]
+    assert summary[0]["final_row_count"] == 5
+
+# FG Status rows for the given UPC11 -> (M P G, Dash) pairs, as the report arrives
+def fg_rows(rows: dict) -> pl.DataFrame:
+    return pl.DataFrame(
+        [(upc, mpg, f"{mpg} name", "IPG1", "IPG1 name", "PM1", "100", dash) for upc, (mpg, dash) in rows.items()],
+        schema=["UPC", "M P G", "MPG Name", "IPG", "IPG Name", "Prd Mgr", "Basic", "Dash"],
+        orient="row",
+    )
+
+# Classification rows for the given oms id + -> (UPC11, classification) pairs; the export carries the 12-digit UPC
+def classification_rows(rows: dict) -> pl.DataFrame:
+    return pl.DataFrame(
+        [(str(oms_id), upc + "0", classification) for oms_id, (upc, classification) in rows.items()],
+        schema=["oms id +", "online upc +", "online classification +"],
+        orient="row",
+    )
+
+def test_incremental_merge_matches_full_merge(uploader, capsys):
+    fg = {"10000000001": ("M1", "01"), "10000000002": ("M2", "02"), "10000000003": ("M3", "03")}
+    classification = {1: ("10000000001", "Online only"), 2: ("10000000002", "Shared"), 3: ("10000000003", "Shared"), 4: ("10000000001", "Shared")}
+    uploader.ingest("fg_status", fg_rows(fg))
+    uploader.ingest("online_classification", classification_rows(classification))
+
+    # One classification row moves to another UPC, and one UPC's FG fields change (reaching oms id 1 and 4)
+    classification[3] = ("10000000002", "Online only")
+    uploader.ingest("online_classification", classification_rows(classification))
+    fg["10000000001"] = ("M9", "09")
+    uploader.ingest("fg_status", fg_rows(fg))
+    assert capsys.readouterr().out.count("Incremental merge:") == 2
+
+    incremental = uploader.read_table("merged_classification").sort("oms id +").collect()
+    uploader.merge_fg_classification(full=True)
+    assert "Full merge:" in capsys.readouterr().out
+    full = uploader.read_table("merged_classification").sort("oms id +").collect()
+    assert incremental.equals(full)
+    assert full.filter(pl.col("oms id +").is_in([1, 4]))["M P G"].to_list() == ["M9", "M9"]
+    assert full.filter(pl.col("oms id +") == 3)["Basic-Dash"].to_list() == ["100-02"]
+
+def test_pinned_snapshot_survives_retention(uploader):
+    uploader.ingest("online_classification", classification_rows({1: ("10000000001", "Online only")}))
+    snapshot = uploader.open_snapshot()
+    pinned = snapshot["online_classification"]["version"]
+    uploader.ingest("online_classification", classification_rows({1: ("10000000001", "Shared"), 2: ("10000000002", "Shared")}))
+
+    # Keeping no days or weeks leaves only the newest version and the reader's pin
+    uploader.apply_retention("online_classification.parquet", keep_daily=0, keep_weekly=0)
+    assert pinned in [entry["version"] for entry in uploader.load_versions("online_classification")]
+    assert os.path.isdir(os.path.join(uploader.versions_dir("online_classification"), pinned))
+    table = uploader.read_table("online_classification", snapshot=snapshot).select("oms id +", "online classification +").collect()
+    assert table.rows() == [(1, "Online only")]
+
+    uploader.release_snapshot_pins()
+    assert pinned in uploader.apply_retention("online_classification.parquet", keep_daily=0, keep_weekly=0)
+    assert not os.path.exists(os.path.join(uploader.versions_dir("online_classification"), pinned))
+
+def test_week_labels_outside_the_enum_are_kept_as_text(uploader):
+    index = config_index(uploader, "online_sales.parquet")
+    path = os.path.join(uploader.BASE_DIR, "pythononlinesales_1.csv")
+    sales_rows([
+        ("2019-02-04", "Fiscal Week 1 of 2019", 1, 10.0),
+        ("2025-02-03", "Fiscal Week 1 of 2025", 1, 20.0),
+    ]).write_csv(path)
+    uploader.ingest_target(index, paths=[path])
+
+    # The 2019 week keeps its label and key as text; the 2025 partition still stores the ordered Enum
+    table = uploader.read_table("online_sales").select(pl.col("week").cast(pl.Utf8), "fiscal_week_key").sort("fiscal_week_key").collect()
+    assert table.rows() == [("Fiscal Week 1 of 2019", 201901), ("Fiscal Week 1 of 2025", 202501)]
+    known = uploader.partition_path(uploader.dataset_dir(os.path.join(uploader.DATA_TABLES_DIR, "online_sales.parquet")), 2025, 1)
+    assert pl.read_parquet_schema(known)["week"] == uploader.FISCAL_WEEK_ENUM
+
+def test_online_tables_import_has_no_side_effects(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.syspath_prepend(REPO_DIR)
+    monkeypatch.delitem(sys.modules, "online_tables", raising=False)
+    online_tables = importlib.import_module("online_tables")
+    assert online_tables.BASE_DIR == os.path.join(str(tmp_path), "THD Data Warehouse")
+    assert os.listdir(tmp_path) == []
+
+# Partition file of each fiscal week -> inode; every rewrite publishes a new file, so an unchanged inode is an untouched partition
+def partition_inodes(uploader, parquet_name: str) -> dict:
+    dataset = uploader.dataset_dir(os.path.join(uploader.DATA_TABLES_DIR, parquet_name))
+    return {key: os.stat(path).st_ino for key, path in uploader.list_partitions(dataset).items()}
+
+def test_upsert_rewrites_only_the_affected_partitions(uploader):
+    index = config_index(uploader, "online_sales.parquet")
+    first = os.path.join(uploader.BASE_DIR, "pythononlinesales_1.csv")
+    sales_rows([
+        ("2025-02-03", "Fiscal Week 1 of 2025", 1, 10.0),
+        ("2025-02-10", "Fiscal Week 2 of 2025", 1, 20.0),
+        ("2025-02-17", "Fiscal Week 3 of 2025", 1, 30.0),
+    ]).write_csv(first)
+    uploader.ingest_target(index, paths=[first])
+    before = partition_inodes(uploader, "online_sales.parquet")
+    assert sorted(before) == [(2025, 1), (2025, 2), (2025, 3)]
+
+    second = os.path.join(uploader.BASE_DIR, "pythononlinesales_2.csv")
+    sales_rows([("2025-02-10", "Fiscal Week 2 of 2025", 1, 25.0)]).write_csv(second)
+    summary, _ = uploader.ingest_target(index, paths=[second])
+
+    after = partition_inodes(uploader, "online_sales.parquet")
+    assert [key for key in before if after[key] != before[key]] == [(2025, 2)]
+    assert summary[0]["rows_removed"] == 1
+    table = uploader.read_table("online_sales").select("fiscal_week", "online sales $ +").sort("fiscal_week").collect()
+    assert table.rows() == [(1, 10.0), (2, 25.0), (3, 30.0)]
+
+def test_rollback_restores_a_version_and_retention_keeps_the_newest_per_day_and_week(uploader):
+    uploader.ingest("online_classification", classification_rows({1: ("10000000001", "Online only")}))
+    first = uploader.load_versions("online_classification")[-1]
+    # Retention keeps one version per day; a reader's pin keeps the first one beside the newer one
+    uploader.open_snapshot()
+    uploader.ingest("online_classification", classification_rows({1: ("10000000001", "Shared"), 2: ("10000000002", "Shared")}))
+
+    assert uploader.rollback_table("online_classification", first["created_at"]) == first["version"]
+    table = uploader.read_table("online_classification").select("oms id +", "online classification +").collect()
+    assert table.rows() == [(1, "Online only")]
+    # The rollback is itself a new version, so the rolled-back state stays recoverable
+    assert uploader.load_versions("online_classification")[-1]["source"] == f"rollback to {first['version']}"
+
+    # Monday-Wednesday of one ISO week and Friday-Saturday of the next, two versions on Saturday
+    created = ["2025-03-03T09:00", "2025-03-04T09:00", "2025-03-05T09:00", "2025-03-14T09:00", "2025-03-15T09:00", "2025-03-15T17:00"]
+    versions = [{"version": f"v{k}", "created_at": at} for k, at in enumerate(created)]
+    # Two days keep Friday and Saturday's later version; one week adds nothing older
+    assert uploader.retention_removals("online_classification", versions, keep_daily=2, keep_weekly=1) == ["v0", "v1", "v2", "v4"]
+    # Two weeks also keep the first week's newest (Wednesday)
+    assert uploader.retention_removals("online_classification", versions, keep_daily=2, keep_weekly=2) == ["v0", "v1", "v4"]
+    assert uploader.retention_removals("online_classification", versions, keep_daily=0, keep_weekly=0) == ["v0", "v1", "v2", "v3", "v4"]
+
+def test_chunked_ingest_matches_in_memory_ingest(tmp_path, monkeypatch, capsys):
+    weeks = [("2025-02-03", "Fiscal Week 1 of 2025"), ("2025-02-10", "Fiscal Week 2 of 2025"), ("2025-02-17", "Fiscal Week 3 of 2025")]
+    base = sales_rows([(day, week, oms_id, 1.0) for day, week in weeks[:2] for oms_id in range(1, 2001)])
+    # Two files in one batch, more rows than one streamed batch; their keys overlap each other and the table
+    update = sales_rows([(day, week, oms_id, 2.0) for day, week in weeks for oms_id in range(1001, 9001)])
+    restate = sales_rows([(weeks[1][0], weeks[1][1], oms_id, 3.0) for oms_id in range(1, 1501)])
+
+    tables = {}
+    summaries = {}
+    for mode, memory_budget in (("in_memory", None), ("chunked", 0.0001)):
+        uploader = load_uploader(tmp_path / mode, monkeypatch)
+        index = config_index(uploader, "online_sales.parquet")
+        paths = []
+        for n, frame in enumerate((base, update, restate), 1):
+            paths.append(os.path.join(uploader.BASE_DIR, f"pythononlinesales_{n}.csv"))
+            frame.write_csv(paths[-1])
+        uploader.ingest_target(index, paths=paths[:1])
+        summary, _ = uploader.ingest_target(index, paths=paths[1:], memory_budget=memory_budget)
+        summaries[mode] = {field: summary[0][field] for field in ("rows_removed", "rows_added", "final_row_count")}
+        tables[mode] = uploader.read_table("online_sales").drop("week").sort("day", "oms id +").collect()
+    assert "exceed the memory budget" in capsys.readouterr().out
+
+    assert tables["chunked"].equals(tables["in_memory"])
+    assert summaries["chunked"] == summaries["in_memory"]
+    assert tables["chunked"].height == 2 * 2000 + 3 * 8000 - 2 * 1000
+    # The later file wins the keys both files carry
+    week_two = tables["chunked"].filter(pl.col("fiscal_week") == 2, pl.col("oms id +") <= 1500)
+    assert week_two["online sales $ +"].unique().to_list() == [3.0]
+
+def test_unchanged_reingest_writes_nothing_and_restatements_reach_the_change_log(uploader):
+    index = config_index(uploader, "online_sales.parquet")
+    rows = [
+        ("2025-02-03", "Fiscal Week 1 of 2025", 1, 10.0),
+        ("2025-02-03", "Fiscal Week 1 of 2025", 2, 20.0),
+        ("2025-02-10", "Fiscal Week 2 of 2025", 1, 30.0),
+    ]
+    first = os.path.join(uploader.BASE_DIR, "pythononlinesales_1.csv")
+    sales_rows(rows).write_csv(first)
+    uploader.ingest_target(index, paths=[first])
+    versions = uploader.load_versions("online_sales")
+    before = partition_inodes(uploader, "online_sales.parquet")
+
+    # The same rows again under a new name: nothing is rewritten and no snapshot is taken
+    again = os.path.join(uploader.BASE_DIR, "pythononlinesales_2.csv")
+    sales_rows(rows).write_csv(again)
+    summary, _ = uploader.ingest_target(index, paths=[again])
+    assert summary[0]["rows_added"] == 0
+    assert summary[0]["backup_path"] == "No backup"
+    assert summary[0]["file_rows"][0]["rows_unchanged"] == 3
+    assert partition_inodes(uploader, "online_sales.parquet") == before
+    assert uploader.load_versions("online_sales") == versions
+    assert not os.path.exists(os.path.join(uploader.CHANGE_LOG_DIR, "online_sales"))
+
+    # One restated value: only its key is written, and the change log holds its old and new rows
+    rows[1] = ("2025-02-03", "Fiscal Week 1 of 2025", 2, 25.0)
+    restated = os.path.join(uploader.BASE_DIR, "pythononlinesales_3.csv")
+    sales_rows(rows).write_csv(restated)
+    summary, _ = uploader.ingest_target(index, paths=[restated])
+    assert summary[0]["rows_added"] == 1
+    assert (summary[0]["file_rows"][0]["rows_updated"], summary[0]["file_rows"][0]["rows_unchanged"]) == (1, 2)
+    assert summary[0]["backup_path"] != "No backup"
+    change_log = pl.read_parquet(os.path.join(uploader.CHANGE_LOG_DIR, "online_sales", "*.parquet"))
+    assert change_log.select("change", "oms id +", "online sales $ +", "source_file").sort("change", descending=True).rows() == [
+        ("before", 2, 20.0, None),
+        ("after", 2, 25.0, "pythononlinesales_3.csv"),
+    ]
+
+def test_strict_reader_sends_bad_values_to_the_rejects_sidecar(uploader):
+    index = config_index(uploader, "online_sales.parquet")
+    path = os.path.join(uploader.BASE_DIR, "pythononlinesales_1.csv")
+    sales_rows([
+        ("2025-02-03", "Fiscal Week 1 of 2025", 1, 10.0),
+        ("2025-02-03", "Fiscal Week 1 of 2025", 2, 20.0),
+        ("2025-02-03", "Fiscal Week 1 of 2025", 3, 30.0),
+    ]).with_columns(
+        pl.when(pl.col("oms id +") == "2").then(pl.lit("n/a")).otherwise(pl.col("online sales $ +")).alias("online sales $ +")
+    ).write_csv(path)
+    summary, _ = uploader.ingest_target(index, paths=[path])
+
+    rejects = pl.read_parquet(os.path.join(uploader.REJECTS_DIR, "online_sales", "*.parquet"))
+    # Header on line 1, so the second data row is line 3
+    assert rejects.select("file", "line", "column", "value").rows() == [("pythononlinesales_1.csv", 3, "online sales $ +", "n/a")]
+    assert summary[0]["file_rows"][0]["values_rejected"] == 1
+    # The row itself still loads, with the bad value as null
+    table = uploader.read_table("online_sales").select("oms id +", "online sales $ +").sort("oms id +").collect()
+    assert table.rows() == [(1, 10.0), (2, None), (3, 30.0)]
+
+def test_gzip_and_zip_sources_match_the_plain_csv(tmp_path, monkeypatch):
+    frame = sales_rows([
+        (day, week, oms_id, oms_id * 1.5)
+        for day, week in (("2025-02-03", "Fiscal Week 1 of 2025"), ("2025-02-10", "Fiscal Week 2 of 2025")) for oms_id in range(1, 301)
+    ])
+    tables = {}
+    for extension in (".csv", ".csv.gz", ".zip"):
+        uploader = load_uploader(tmp_path / extension.replace(".", "_"), monkeypatch)
+        path = os.path.join(uploader.BASE_DIR, f"pythononlinesales_1{extension}")
+        if extension == ".csv.gz":
+            with gzip.open(path, "wb") as f:
+                frame.write_csv(f)
+        elif extension == ".zip":
+            # Split across two members, read as one source
+            with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+                archive.writestr("part_1.csv", frame.head(250).write_csv())
+                archive.writestr("part_2.csv", frame.tail(350).write_csv())
+        else:
+            frame.write_csv(path)
+        summary, _ = uploader.ingest_target(config_index(uploader, "online_sales.parquet"), paths=[path])
+        assert summary[0]["errors"] == []
+        tables[extension] = uploader.read_table("online_sales").with_columns(pl.col("week").cast(pl.Utf8)).sort("day", "oms id +").collect()
+
+    assert tables[".csv"].height == 600
+    assert tables[".csv.gz"].equals(tables[".csv"])
+    assert tables[".zip"].equals(tables[".csv"])
+
+def test_ingest_accepts_polars_frames_and_arrow_tables(uploader):
+    from_polars = sales_rows([
+        ("2025-02-03", "Fiscal Week 1 of 2025", 1, 10.0),
+        ("2025-02-03", "Fiscal Week 1 of 2025", 2, 20.0),
+    ])
+    summary = uploader.ingest("online_sales", from_polars, source="sales API")
+    assert summary["rows_added"] == 2
+    # An Arrow table upserts like any other source: key (2025-02-03, 2) is replaced
+    from_arrow = sales_rows([
+        ("2025-02-03", "Fiscal Week 1 of 2025", 2, 25.0),
+        ("2025-02-10", "Fiscal Week 2 of 2025", 3, 30.0),
+    ]).to_arrow()
+    summary = uploader.ingest("online_sales", from_arrow, source="sales API")
+    assert summary["final_row_count"] == 3
+
+    table = uploader.read_table("online_sales").select(pl.col("week").cast(pl.Utf8), "oms id +", "online sales $ +").sort("oms id +").collect()
+    assert table.rows() == [
+        ("Fiscal Week 1 of 2025", 1, 10.0),
+        ("Fiscal Week 1 of 2025", 2, 25.0),
+        ("Fiscal Week 2 of 2025", 3, 30.0),
+    ]
+    assert table.schema["oms id +"] == pl.Int32
+    # No source file, so the ingest manifest is untouched
+    assert not os.path.exists(uploader.INGEST_MANIFEST)
+
+def test_compaction_publishes_all_rewritten_files_or_none(uploader, monkeypatch):
+    index = config_index(uploader, "online_sales.parquet")
+    path = os.path.join(uploader.BASE_DIR, "pythononlinesales_1.csv")
+    sales_rows([
+        ("2025-02-03", "Fiscal Week 1 of 2025", 1, 10.0),
+        ("2025-02-10", "Fiscal Week 2 of 2025", 1, 20.0),
+    ]).write_csv(path)
+    uploader.ingest_target(index, paths=[path])
+    # Mark both partitions as written at the previous schema version
+    dataset = uploader.dataset_dir(os.path.join(uploader.DATA_TABLES_DIR, "online_sales.parquet"))
+    for file_path in uploader.list_partitions(dataset).values():
+        pl.read_parquet(file_path).drop("fiscal_week_key").write_parquet(file_path, metadata={uploader.SCHEMA_VERSION_KEY: "2"})
+    before = partition_inodes(uploader, "online_sales.parquet")
+
+    # A write failing on the second file leaves the first one unpublished
+    write_table_file = uploader.write_table_file
+    written = []
+    def failing_write(frame, temp_path, *args, **kwargs):
+        if written:
+            raise OSError("disk full")
+        written.append(temp_path)
+        write_table_file(frame, temp_path, *args, **kwargs)
+    monkeypatch.setattr(uploader, "write_table_file", failing_write)
+    with pytest.raises(OSError):
+        uploader.compact_table("online_sales")
+    assert partition_inodes(uploader, "online_sales.parquet") == before
+    assert not os.path.exists(written[0])
+    assert len(uploader.stale_schema_files("online_sales")) == 2
+
+    monkeypatch.setattr(uploader, "write_table_file", write_table_file)
+    assert uploader.compact_table("online_sales") == 2
+    assert uploader.stale_schema_files("online_sales") == []
+    table = uploader.read_table("online_sales").select("fiscal_week_key", "online sales $ +").sort("fiscal_week_key").collect()
+    assert table.rows() == [(202501, 10.0), (202502, 20.0)]